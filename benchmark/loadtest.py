@@ -0,0 +1,345 @@
+"""
+End-to-end load test of the web API service.
+
+Starts local stand-ins for the login, patient, CDN and classifier services,
+starts the service against them, and drives simulated Gradio clients through
+login, patient list, search, open patient and classify. Reports the latency
+percentiles of every step and the throughput as JSON.
+
+Usage:
+    python benchmark/loadtest.py --clients 20 --iterations 5 --output results.json
+    python benchmark/loadtest.py --workers 4 --session-store redis --clients 50
+    python benchmark/loadtest.py --url http://127.0.0.1:8082 --clients 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+import httpx
+import websockets
+import stubs
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+services = ['login', 'patient', 'cdn', 'classifier']
+steps = ['session', 'login', 'search', 'open_patient', 'select_image', 'classify', 'close_patient']
+
+
+class StepError(Exception):
+    pass
+
+
+class Client:
+    """
+    A simulated browser tab, speaking the Gradio queue protocol. Every event is
+    sent over its own websocket, like the Gradio frontend does.
+    """
+
+    def __init__(self, url, fn_indices, results, names=None):
+        """
+        Parameters:
+        url (str): The url of the service
+        fn_indices (dict): The fn_index of every step, by api name
+        results (dict): The latencies and errors of every step, by name
+        names (list): The names of every patient to search for, None to search the first page
+        """
+        self.url = url
+        self.fn_indices = fn_indices
+        self.results = results
+        self.names = names
+        self.session_hash = uuid.uuid4().hex[:11]
+
+    async def call(self, step, data, event_data=None):
+        """
+        Run an event and record its latency
+
+        Parameters:
+        step (str): The api name of the event
+        data (list): The inputs of the event
+        event_data (dict): The select event data, if any
+
+        Returns:
+        list: The outputs of the event
+        """
+        fn_index = self.fn_indices[step]
+        start = time.perf_counter()
+        try:
+            output = await self._call(fn_index, data, event_data)
+        except Exception:
+            self.results[step]['errors'] += 1
+            raise
+        self.results[step]['latencies'].append(time.perf_counter() - start)
+        return output
+
+    async def _call(self, fn_index, data, event_data):
+        async with websockets.connect(self.url.replace('http', 'ws', 1) + '/queue/join', max_size=None) as ws:
+            async for message in ws:
+                message = json.loads(message)
+                if message['msg'] == 'send_hash':
+                    await ws.send(json.dumps({'fn_index': fn_index, 'session_hash': self.session_hash}))
+                elif message['msg'] == 'send_data':
+                    await ws.send(json.dumps({'fn_index': fn_index,
+                                              'session_hash': self.session_hash,
+                                              'data': data,
+                                              'event_data': event_data}))
+                elif message['msg'] == 'queue_full':
+                    raise StepError('queue full')
+                elif message['msg'] == 'process_completed':
+                    if not message.get('success'):
+                        raise StepError(str(message.get('output')))
+                    return message['output']['data']
+        raise StepError('connection closed')
+
+    async def run(self, iterations, flows):
+        """
+        Open the interface and run the flow the given number of times
+
+        Parameters:
+        iterations (int): The number of flows to run
+        flows (dict): The completed and failed flow counters
+        """
+        try:
+            session_id = (await self.call('session', []))[0]
+        except Exception:
+            flows['failed'] += iterations
+            return
+
+        for _ in range(iterations):
+            try:
+                await self.flow(session_id)
+                flows['completed'] += 1
+            except Exception:
+                flows['failed'] += 1
+
+    async def flow(self, session_id):
+        """
+        Login, search, open a patient, classify an image and go back
+        """
+        outputs = await self.call('login', [session_id, 'doctor', 'password', 'Name', 'Ascending'])
+        patients = outputs[3]
+        if not isinstance(patients, dict) or not patients.get('data'):
+            raise StepError('no patients')
+
+        # Searching the whole list covers the patients on pages not loaded yet
+        names = self.names or [patient[0] for patient in patients['data']]
+        query = random.choice(names)
+        patients = (await self.call('search', [session_id, query, 'Name']))[0]
+
+        row = random.randrange(len(patients['data']))
+        await self.call('open_patient', [session_id, patients],
+                        {'index': [row, 0], 'value': patients['data'][row][0]})
+        await self.call('select_image', [session_id], {'index': 0, 'value': None})
+        await self.call('classify', [session_id])
+        await self.call('close_patient', [session_id])
+
+
+def percentile(values, p):
+    """
+    Get a percentile with the nearest rank method
+
+    Parameters:
+    values (list): The sorted values
+    p (float): The percentile, 0 to 100
+
+    Returns:
+    float: The value at the percentile, None if there are no values
+    """
+    if not values:
+        return None
+    rank = max(1, int(round(p / 100 * len(values) + 0.5)))
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(results, duration):
+    """
+    Get the latency percentiles and throughput of every step
+
+    Parameters:
+    results (dict): The latencies and errors of every step, by name
+    duration (float): The wall time of the run in seconds
+
+    Returns:
+    dict: The summary of every step, latencies in milliseconds
+    """
+    summary = {}
+    for step in steps:
+        latencies = sorted(results[step]['latencies'])
+        summary[step] = {'count': len(latencies),
+                         'errors': results[step]['errors'],
+                         'per_second': round(len(latencies) / duration, 2),
+                         'mean_ms': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None}
+        for p in (50, 95, 99):
+            value = percentile(latencies, p)
+            summary[step]['p' + str(p) + '_ms'] = round(value * 1000, 1) if value is not None else None
+        summary[step]['max_ms'] = round(latencies[-1] * 1000, 1) if latencies else None
+    return summary
+
+
+def parse_overrides(values, cast):
+    """
+    Parse repeated SERVICE=VALUE arguments
+
+    Returns:
+    dict: The values, by service
+    """
+    overrides = {}
+    for value in values or []:
+        service, _, setting = value.partition('=')
+        if service not in services:
+            raise SystemExit('Unknown service ' + service + ', expected one of ' + ', '.join(services))
+        overrides[service] = cast(setting)
+    return overrides
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_service(backends, args):
+    """
+    Start the service against the stand-ins
+
+    Returns:
+    subprocess.Popen: The service process
+    str: The url of the service
+    """
+    if os.path.exists(os.path.join(repo_dir, '.env')):
+        print('WARNING: .env found, its values override the load test settings', file=sys.stderr)
+
+    port = free_port()
+    env = dict(os.environ,
+               APP_PORT=str(port),
+               LOG_LEVEL=args.log_level,
+               LOGIN_API_ADDRESS=backends['login'].address,
+               PATIENT_API_ADDRESS=backends['patient'].address,
+               CLASSIFIER_API_ADDRESS=backends['classifier'].address,
+               WEB_WORKERS=str(args.workers),
+               PYTHONUNBUFFERED='1')
+    if 'sessions' in backends:
+        env['SESSION_STORE'] = backends['sessions'].url
+    elif args.session_store != 'default':
+        env['SESSION_STORE'] = args.session_store
+    if not args.result_cache:
+        # Every classify should reach the classifier stand-in
+        env.update(RESULT_CACHE_ENTRIES='0', RESULT_CACHE_DIR='None')
+
+    # Keep stdout for the report
+    process = subprocess.Popen([sys.executable, 'main.py'], cwd=repo_dir, env=env, stdout=sys.stderr)
+    return process, 'http://127.0.0.1:' + str(port)
+
+
+def wait_for_config(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = httpx.get(url + '/config', timeout=5)
+            if response.status_code == 200:
+                return response.json()
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise SystemExit('Service at ' + url + ' did not start within ' + str(timeout) + 's')
+
+
+async def run_clients(url, fn_indices, args):
+    results = {step: {'latencies': [], 'errors': 0} for step in steps}
+    flows = {'completed': 0, 'failed': 0}
+
+    async def start(i, client):
+        # Spread the clients over the ramp up time
+        await asyncio.sleep(args.ramp_up * i / max(1, args.clients))
+        await client.run(args.iterations, flows)
+
+    # The patients of the started stand-in are known, a running service is searched by its first page
+    names = None if args.url else [patient['Name'] for patient in stubs.make_patients(args.patients)]
+    clients = [Client(url, fn_indices, results, names) for _ in range(args.clients)]
+    started = time.perf_counter()
+    await asyncio.gather(*[start(i, client) for i, client in enumerate(clients)])
+    return results, flows, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='Drive an already running service instead of starting one with stand-ins')
+    parser.add_argument('--clients', type=int, default=10, help='Simulated clients running at once')
+    parser.add_argument('--iterations', type=int, default=5, help='Flows run by every client')
+    parser.add_argument('--ramp-up', type=float, default=0, help='Seconds over which clients are started')
+    parser.add_argument('--patients', type=int, default=200, help='Patients served by the patient stand-in')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Latency of every stand-in')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Max random latency added on top')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of stand-in requests that fail')
+    parser.add_argument('--latency', action='append', metavar='SERVICE=MS', help='Latency of one stand-in, repeatable')
+    parser.add_argument('--errors', action='append', metavar='SERVICE=RATE', help='Error rate of one stand-in, repeatable')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes of the started service')
+    parser.add_argument('--session-store', default='default', choices=['default', 'memory', 'sqlite', 'redis'],
+                        help='Session store of the started service, redis starts a local stand-in')
+    parser.add_argument('--result-cache', action='store_true', help='Keep the classification result cache enabled')
+    parser.add_argument('--startup-timeout', type=float, default=60, help='Seconds to wait for the service to start')
+    parser.add_argument('--log-level', default='WARNING', help='Log level of the started service')
+    parser.add_argument('--output', help='Write the JSON report to a file instead of stdout')
+    args = parser.parse_args()
+
+    latencies = parse_overrides(args.latency, float)
+    error_rates = parse_overrides(args.errors, float)
+    faults = {service: stubs.Faults(latencies.get(service, args.latency_ms),
+                                    args.jitter_ms,
+                                    error_rates.get(service, args.error_rate))
+              for service in services}
+
+    backends, process = {}, None
+    try:
+        if args.url:
+            url = args.url.rstrip('/')
+        else:
+            backends = stubs.start_stubs(faults, args.patients)
+            if args.session_store == 'redis':
+                backends['sessions'] = stubs.RespStub().start()
+            process, url = start_service(backends, args)
+
+        config = wait_for_config(url, args.startup_timeout)
+        fn_indices = {dependency.get('api_name'): i for i, dependency in enumerate(config['dependencies'])}
+        missing = [step for step in steps if step != 'session' and step not in fn_indices]
+        if missing or 'new_session' not in fn_indices:
+            raise SystemExit('Service does not expose the events ' + ', '.join(missing or ['new_session']))
+        fn_indices['session'] = fn_indices['new_session']
+
+        results, flows, duration = asyncio.run(run_clients(url, fn_indices, args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        for backend in backends.values():
+            backend.stop()
+
+    report = {'revision': git_revision(),
+              'config': {key: value for key, value in vars(args).items() if key != 'output'},
+              'duration_s': round(duration, 2),
+              'flows': dict(flows, per_second=round(flows['completed'] / duration, 2)),
+              'steps': summarize(results, duration),
+              'backends': {name: backend.stats() for name, backend in backends.items()}}
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
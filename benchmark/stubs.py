@@ -0,0 +1,479 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from PIL import Image
+
+resources_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'interfaces', 'resources')
+
+first_names = ["John", "Jane", "Greg", "Alice", "Thomas", "Nicole", "Adam", "Keith", "Ian", "Maria"]
+last_names = ["Doe", "Smith", "Johnson", "Williams", "Brown", "Jones", "Miller", "Davis", "Garcia", "Rodriguez"]
+
+labels = {
+    'Melanocytic nevi': 0.85,
+    'Dermatofibroma': 0.27,
+    'Benign keratosis-like lesions': 0.12,
+    'Basal cell carcinoma': 0.03,
+    'Actinic keratoses': 0.002,
+    'Vascular lesions': 0.001
+}
+
+
+class Faults:
+    """
+    Latency and error injection of a stub
+    """
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0):
+        """
+        Parameters:
+        latency_ms (float): The latency added to every request
+        jitter_ms (float): The max random latency added on top
+        error_rate (float): The fraction of requests answered with a 503
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+    def apply(self):
+        """
+        Sleep for the injected latency
+
+        Returns:
+        bool: True if the request should fail
+        """
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        return random.random() < self.error_rate
+
+
+class StubServer:
+    """
+    A backend stand-in running on its own thread, counting the requests it
+    served and the errors it injected
+    """
+
+    def __init__(self, name, handler, faults, **options):
+        """
+        Parameters:
+        name (str): The name of the service
+        handler (type): The StubHandler subclass answering requests
+        faults (Faults): The latency and errors to inject
+        **options: Service specific options, available to the handler
+        """
+        self.name = name
+        self.faults = faults
+        self.options = options
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name=name, daemon=True)
+
+    @property
+    def address(self):
+        host, port = self._server.server_address
+        return host + ':' + str(port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def record(self, error):
+        with self._lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            return {'address': self.address,
+                    'requests': self.requests,
+                    'errors': self.errors}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Base handler, subclasses implement route
+    """
+
+    # Keep connections alive, the service pools its backend connections
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+
+        stub = self.server.stub
+        if stub.faults.apply():
+            stub.record(True)
+            self.send(503, b'{"error": "injected"}')
+            return
+
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        status, payload, headers = self.route(method, url.path, query, body)
+        stub.record(status >= 500)
+        self.send(status, payload, headers)
+
+    def route(self, method, path, query, body):
+        """
+        Answer a request
+
+        Returns:
+        tuple: The status, the body and the extra headers
+        """
+        return 404, b'{}', {}
+
+    def send(self, status, payload, headers=None, content_type='application/json'):
+        if isinstance(payload, (dict, list)):
+            payload = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class LoginHandler(StubHandler):
+    """
+    GET /api/v1/signin, every user with a password is let in
+    """
+
+    def route(self, method, path, query, body):
+        if path != '/api/v1/signin':
+            return 404, {}, {}
+        return 200, {'success': bool(query.get('password_hash')), 'name': query.get('username', '')}, {}
+
+
+class PatientHandler(StubHandler):
+    """
+    GET /api/v1/patients, paged, sorted and searched, with ETag revalidation
+    """
+
+    def route(self, method, path, query, body):
+        if path != '/api/v1/patients':
+            return 404, {}, {}
+
+        patients = self.server.stub.options['patients']
+        etag = '"' + hashlib.sha1(str(len(patients)).encode('utf-8')).hexdigest() + '"'
+        sort_by = query.get('sort', 'Name')
+        descending = query.get('order') == 'desc'
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 25))
+
+        # The ETag covers the whole list, so any page of it can be revalidated
+        page_etag = etag[:-1] + '-' + sort_by + '-' + str(descending) + '-' + str(offset) + '-' + str(limit) + '"'
+        headers = {'ETag': page_etag}
+
+        # Searches are case insensitive substring matches on one column, not revalidated
+        search = query.get('search')
+        if search is not None:
+            column = query.get('search_column', 'Name')
+            patients = [patient for patient in patients
+                        if search.strip().casefold() in str(patient.get(column, '')).casefold()]
+            headers = {}
+        elif self.headers.get('If-None-Match') == page_etag:
+            return 304, b'', headers
+
+        ordered = sorted(patients, key=lambda patient: patient.get(sort_by, patient['Name']), reverse=descending)
+        return 200, {'patients': ordered[offset:offset + limit], 'total': len(patients)}, headers
+
+
+class CdnHandler(StubHandler):
+    """
+    GET /api/v1/notes/<reference id> and GET /images/<image id>.jpg
+    """
+
+    def route(self, method, path, query, body):
+        match = re.fullmatch(r'/api/v1/notes/(\d+)', path)
+        if match:
+            return 200, {'notes': 'Notes of patient ' + match.group(1)}, {}
+
+        match = re.fullmatch(r'/images/(\w+)\.jpg', path)
+        if match:
+            try:
+                with open(os.path.join(resources_dir, match.group(1) + '.jpg'), 'rb') as f:
+                    return 200, f.read(), {'Content-Type': 'image/jpeg'}
+            except OSError:
+                pass
+        return 404, {}, {}
+
+
+class ClassifierHandler(StubHandler):
+    """
+    POST /api/v1/classify, one result per uploaded image
+    """
+
+    def route(self, method, path, query, body):
+        if method != 'POST' or path != '/api/v1/classify':
+            return 404, {}, {}
+
+        count = body.count(b'name="images"')
+        attribution = self.server.stub.options['attribution']
+        return 200, {'results': [{'labels': labels, 'attribution': attribution} for _ in range(count)]}, {}
+
+
+class RespStub:
+    """
+    In-memory stand-in for a Redis server, speaking enough of the protocol
+    for the shared session store
+    """
+
+    def __init__(self, name='sessions'):
+        """
+        Parameters:
+        name (str): The name of the service
+        """
+        self.name = name
+        self.requests = 0
+        self.errors = 0
+        self.data = {}
+        self.expires = {}
+        self.lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), RespHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name=name, daemon=True)
+
+    @property
+    def address(self):
+        host, port = self._server.server_address
+        return host + ':' + str(port)
+
+    @property
+    def url(self):
+        return 'redis://' + self.address + '/0'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {'address': self.address,
+                    'requests': self.requests,
+                    'errors': self.errors,
+                    'keys': len(self.data)}
+
+    def execute(self, command, args):
+        """
+        Run a command
+
+        Parameters:
+        command (str): The upper case command name
+        args (list): The arguments, as bytes
+
+        Returns:
+        object: The reply, an Exception for error replies
+        """
+        with self.lock:
+            self.requests += 1
+            now = time.time()
+            for key in [key for key, expires in self.expires.items() if expires <= now]:
+                self.data.pop(key, None)
+                del self.expires[key]
+
+            handler = getattr(self, 'command_' + command.lower(), None)
+            if handler is None:
+                self.errors += 1
+                return Exception('ERR unknown command ' + command)
+            try:
+                return handler(*args)
+            except (TypeError, ValueError) as e:
+                self.errors += 1
+                return Exception('ERR ' + str(e))
+
+    def command_ping(self):
+        return 'PONG'
+
+    def command_select(self, db):
+        return 'OK'
+
+    def command_auth(self, password):
+        return 'OK'
+
+    def command_del(self, *keys):
+        removed = 0
+        for key in keys:
+            removed += key in self.data
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return removed
+
+    def command_expire(self, key, seconds):
+        if key not in self.data:
+            return 0
+        self.expires[key] = time.time() + int(seconds)
+        return 1
+
+    def command_hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def command_hset(self, key, field, value):
+        values = self.data.setdefault(key, {})
+        added = field not in values
+        values[field] = value
+        return int(added)
+
+    def command_hdel(self, key, *fields):
+        values = self.data.get(key, {})
+        removed = sum(values.pop(field, None) is not None for field in fields)
+        if key in self.data and not values:
+            self.command_del(key)
+        return removed
+
+    def command_hgetall(self, key):
+        return [item for field, value in self.data.get(key, {}).items() for item in (field, value)]
+
+    def command_hincrby(self, key, field, amount):
+        values = self.data.setdefault(key, {})
+        values[field] = str(int(values.get(field, 0)) + int(amount)).encode('ascii')
+        return int(values[field])
+
+    def command_zadd(self, key, score, member):
+        members = self.data.setdefault(key, {})
+        added = member not in members
+        members[member] = float(score)
+        return int(added)
+
+    def command_zscore(self, key, member):
+        score = self.data.get(key, {}).get(member)
+        return repr(score).encode('ascii') if score is not None else None
+
+    def command_zcard(self, key):
+        return len(self.data.get(key, {}))
+
+    def command_zrem(self, key, *members):
+        values = self.data.get(key, {})
+        return sum(values.pop(member, None) is not None for member in members)
+
+    def command_zrange(self, key, start, stop):
+        ordered = sorted(self.data.get(key, {}).items(), key=lambda item: item[1])
+        stop = int(stop)
+        return [member for member, _ in ordered[int(start):None if stop == -1 else stop + 1]]
+
+    def command_zrangebyscore(self, key, low, high):
+        low = float('-inf') if low == b'-inf' else float(low)
+        high = float('inf') if high == b'+inf' else float(high)
+        ordered = sorted(self.data.get(key, {}).items(), key=lambda item: item[1])
+        return [member for member, score in ordered if low <= score <= high]
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """
+    Reads RESP commands and writes their replies, pipelining included
+    """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if not line.startswith(b'*'):
+                continue
+
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+
+            reply = self.server.stub.execute(args[0].decode('utf-8').upper(), args[1:])
+            self.wfile.write(encode_reply(reply))
+
+
+def encode_reply(reply):
+    if isinstance(reply, Exception):
+        return b'-' + str(reply).encode('utf-8') + b'\r\n'
+    if isinstance(reply, str):
+        return b'+' + reply.encode('utf-8') + b'\r\n'
+    if isinstance(reply, int):
+        return b':' + str(reply).encode('ascii') + b'\r\n'
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, list):
+        return b'*' + str(len(reply)).encode('ascii') + b'\r\n' + b''.join(encode_reply(item) for item in reply)
+    return b'$' + str(len(reply)).encode('ascii') + b'\r\n' + reply + b'\r\n'
+
+
+def make_patients(count):
+    """
+    Generate a deterministic patient list
+
+    Parameters:
+    count (int): The number of patients
+
+    Returns:
+    list: The patients, as returned by the patient API
+    """
+    patients = []
+    for i in range(count):
+        patients.append({'Name': first_names[i % len(first_names)] + ' ' + last_names[(i // len(first_names)) % len(last_names)],
+                         'Reference ID': 1000 + i,
+                         'Samples': 1 + i % 20,
+                         'Date': '2021-%02d-%02d' % (1 + i % 12, 1 + i % 28)})
+    return patients
+
+
+def make_attribution(size=224):
+    """
+    Encode a placeholder attribution image the way the classifier API does
+
+    Parameters:
+    size (int): The width and height of the image
+
+    Returns:
+    str: The base64 encoded PNG
+    """
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), (200, 60, 60)).save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def start_stubs(faults, patients=200):
+    """
+    Start every backend stand-in
+
+    Parameters:
+    faults (dict): The Faults of each service, by name
+    patients (int): The number of patients the patient API serves
+
+    Returns:
+    dict: The running StubServers, by name
+    """
+    return {'login': StubServer('login', LoginHandler, faults['login']).start(),
+            'patient': StubServer('patient', PatientHandler, faults['patient'],
+                                  patients=make_patients(patients)).start(),
+            'cdn': StubServer('cdn', CdnHandler, faults['cdn']).start(),
+            'classifier': StubServer('classifier', ClassifierHandler, faults['classifier'],
+                                     attribution=make_attribution()).start()}
@@ -1,6 +1,24 @@
+import interfaces.aio as aio
+import interfaces.metrics as metrics
+import interfaces.assets as assets
+import interfaces.backend as backend
+import interfaces.resp as resp
+import interfaces.imagecache as imagecache
+import interfaces.encoding as encoding
+import interfaces.uploads as uploads
+import interfaces.resultcache as resultcache
+import interfaces.searchindex as searchindex
+import interfaces.patientcache as patientcache
+import interfaces.sessions as sessions
+import interfaces.tiers as tiers
+import interfaces.prefetch as prefetch
+import interfaces.inference as inference
+import interfaces.classifier as classifier
 import interfaces.login as login
 import interfaces.patient as patient
 import interfaces.forgotpassword as forgotpassword
 import interfaces.accountcreate as accountcreate
 import interfaces.classification as classification
+import interfaces.router as router
+import interfaces.workers as workers
 from interfaces.softcustom import SoftCustom
\ No newline at end of file
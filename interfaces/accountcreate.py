@@ -1,9 +1,11 @@
 import gradio as gr
-import requests
+import httpx
 import logging
 import hashlib
 import re
-import os
+import interfaces.aio as aio
+import interfaces.backend as backend
+import interfaces.tiers as tiers
 
 log = logging.getLogger('web-api')
 
@@ -28,11 +30,11 @@ def setup(acc_creation_col, login_col):
         sign_up_btn = gr.Button("Sign Up")
 
         # TODO, refactor so it uses the same reset as cancel, conditionaly
-        sign_up_btn.click(sign_up, inputs=[username_txt, passwd_txt, c_passwd_txt, user_email_txt, name_txt], outputs=[login_col, acc_creation_col, username_txt, passwd_txt, c_passwd_txt, user_email_txt, name_txt])
+        sign_up_btn.click(tiers.backend_io(sign_up), inputs=[username_txt, passwd_txt, c_passwd_txt, user_email_txt, name_txt], outputs=[login_col, acc_creation_col, username_txt, passwd_txt, c_passwd_txt, user_email_txt, name_txt])
         cancel_btn = gr.Button("Cancel", elem_id="linkbutton", variant="secondary", size="sm",)
         cancel_btn.click(reset, outputs=[login_col, acc_creation_col, username_txt, passwd_txt, c_passwd_txt, user_email_txt, name_txt])
 
-def sign_up(username, passw, c_passwd, user_email, name):
+async def sign_up(username, passw, c_passwd, user_email, name):
     """
     Signs up the user
 
@@ -53,6 +55,7 @@ def sign_up(username, passw, c_passwd, user_email, name):
 
     """
     log.info("Signing up user")
+    ctx = aio.event_context()
 
     # TODO, return dict, allws us to skip out on updating values.
     # Check if any of the inputs are empty
@@ -72,15 +75,8 @@ def sign_up(username, passw, c_passwd, user_email, name):
 
     # Encrypt the password
     encrypted_passw = hashlib.sha256(passw.encode('utf-8')).hexdigest()
-    print(encrypted_passw)
 
-    # Get the login api address from env
-    address = os.getenv("LOGIN_API_ADDRESS")
-    if address is None:
-        log.warning("LOGIN_API_ADDRESS not specified in env, defaulting to 127.0.0.1:8084")
-        address = '127.0.0.1:8084'
-
-    if (address == 'None'):
+    if backend.login_api_bypassed():
         log.warning("Bypassing login API")
         success = True
         name = 'Admin'
@@ -88,10 +84,12 @@ def sign_up(username, passw, c_passwd, user_email, name):
         # Send the create account request
         try:
             log.debug("Sending create account request for username and passwd: " + username + ", " + encrypted_passw)
-            response = requests.post('http://' + address + '/api/v1/create-account', 
+            response = await backend.login_api('POST', '/api/v1/create-account', 
                                 params={'username': username, 'password_hash': encrypted_passw, 'email': user_email, 'name': name})
             
-        except requests.exceptions.ConnectionError:
+        except gr.Error:
+            raise # Deadline or circuit breaker, already clear
+        except httpx.ConnectError:
             raise gr.Error("Login API connection error")
         except Exception as e:
             raise gr.Error("Login API error: " + str(e))
@@ -105,6 +103,7 @@ def sign_up(username, passw, c_passwd, user_email, name):
             raise gr.Error("Login API response not ok: " + str(response))
 
     # Inform user of create account status
+    aio.restore_event_context(ctx)
     if success:
         gr.Info("Account creation successful")
         return gr.update(visible=True), gr.update(visible=False), gr.update(value=None), gr.update(value=None), gr.update(value=None), gr.update(value=None), gr.update(value=None)
@@ -0,0 +1,45 @@
+import asyncio
+import functools
+from gradio import context
+
+
+def run_blocking(fn, *args):
+    """
+    Run a blocking function in the default executor so it does not stall the
+    event loop the async handlers run on
+
+    Parameters:
+    fn (callable): The blocking function to run
+    *args: The arguments to pass to the function
+
+    Returns:
+    asyncio.Future: The future to await for the result
+    """
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(None, functools.partial(fn, *args))
+
+
+def event_context():
+    """
+    Capture the gradio event an async handler is running for. Gradio keeps this
+    in a thread local, which other handlers on the same event loop overwrite
+    while we are awaiting, so capture it before the first await.
+
+    Returns:
+    tuple: The blocks and event id, or None if called outside of gradio
+    """
+    if not hasattr(context.thread_data, "blocks"):
+        return None
+    return context.thread_data.blocks, context.thread_data.event_id
+
+
+def restore_event_context(ctx):
+    """
+    Restore a captured gradio event so gr.Info and gr.Warning reach the right
+    user after an await
+
+    Parameters:
+    ctx (tuple): The context returned from event_context
+    """
+    if ctx is not None:
+        context.thread_data.blocks, context.thread_data.event_id = ctx
@@ -0,0 +1,221 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+from fastapi import Request
+from fastapi.responses import Response
+import brotli
+from gradio.themes.utils import fonts
+
+log = logging.getLogger('web-api')
+
+interfaces_dir = os.path.dirname(os.path.abspath(__file__))
+resources_dir = os.path.join(interfaces_dir, 'resources')
+fonts_dir = os.path.join(resources_dir, 'fonts')
+
+# Bundled assets are served from the path gradio puts in front of file
+# parameters, such as button icons, so those can point at them too
+prefix = 'bundle/'
+route = '/file=' + prefix + '{name}'
+
+cache_control = 'public, max-age=31536000, immutable'
+
+mimetypes.add_type('font/woff2', '.woff2')
+mimetypes.add_type('font/woff', '.woff')
+
+# The css, icons and fonts served by the service, set up in setup
+bundle = None
+
+
+def setup():
+    """
+    Bundle the css, icons and fonts with content-hashed names. Should be called
+    once at startup, before the theme and interface are built.
+    """
+    global bundle
+
+    bundle = Bundle()
+    bundle.add_file(os.path.join(interfaces_dir, 'main.css'))
+    for directory in (resources_dir, fonts_dir):
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(('.svg', '.woff2', '.woff')):
+                bundle.add_file(os.path.join(directory, name))
+
+    log.info("Bundled " + str(len(bundle.names)) + " assets, " + str(bundle.size() // 1024) + "KB")
+
+
+def path(name):
+    """
+    Get the path of a bundled asset, for gradio parameters taking a file path
+
+    Parameters:
+    name (str): The file name of the asset
+
+    Returns:
+    str: The content-hashed path, or the path on disk if it is not bundled
+    """
+    if bundle is None or name not in bundle.names:
+        return os.path.relpath(os.path.join(resources_dir, name))
+    return prefix + bundle.names[name]
+
+
+def url(name):
+    """
+    Get the url of a bundled asset, relative to the root of the app
+
+    Parameters:
+    name (str): The file name of the asset
+
+    Returns:
+    str: The content-hashed url
+    """
+    return 'file=' + path(name)
+
+
+def import_css(name):
+    """
+    Get css importing a bundled stylesheet. Passed as the css of the interface,
+    it keeps its place in the cascade while the browser caches the file.
+
+    Parameters:
+    name (str): The file name of the stylesheet
+
+    Returns:
+    str: The css
+    """
+    return '@import url("' + url(name) + '");\n'
+
+
+def mount(app):
+    """
+    Add the bundled asset route to the app gradio launched, ahead of gradio's
+    own file route
+
+    Parameters:
+    app (fastapi.FastAPI): The app
+    """
+    @app.get(route)
+    def asset_route(name: str, request: Request):
+        asset = bundle.assets.get(name)
+        if asset is None:
+            return Response(status_code=404)
+        return asset.response(request.headers.get('accept-encoding', ''),
+                              request.headers.get('if-none-match'))
+
+    app.router.routes.insert(0, app.router.routes.pop())
+
+
+class Asset:
+    """
+    A bundled file with its precompressed variants
+    """
+
+    def __init__(self, content, media_type, digest):
+        """
+        Parameters:
+        content (bytes): The file content
+        media_type (str): The content type
+        digest (str): The content hash, used as the ETag
+        """
+        self.content = content
+        self.media_type = media_type
+        self.etag = '"' + digest + '"'
+        self.variants = {}
+
+        # Fonts and images are usually compressed already, only keep variants that help
+        candidates = [('br', lambda data: brotli.compress(data, quality=11)),
+                      ('gzip', lambda data: gzip.compress(data, 9, mtime=0))]
+        for encoding, compress in candidates:
+            compressed = compress(content)
+            if len(compressed) < len(content) * 0.9:
+                self.variants[encoding] = compressed
+
+    def response(self, accept_encoding, if_none_match):
+        """
+        Answer a request for the asset
+
+        Parameters:
+        accept_encoding (str): The Accept-Encoding header of the request
+        if_none_match (str): The If-None-Match header of the request
+
+        Returns:
+        fastapi.Response: The asset, in the smallest encoding the client accepts
+        """
+        headers = {'Cache-Control': cache_control, 'ETag': self.etag, 'Vary': 'Accept-Encoding'}
+        if if_none_match == self.etag:
+            return Response(status_code=304, headers=headers)
+
+        accepted = [part.split(';')[0].strip() for part in accept_encoding.split(',')]
+        for encoding, content in self.variants.items():
+            if encoding in accepted:
+                headers['Content-Encoding'] = encoding
+                return Response(content, media_type=self.media_type, headers=headers)
+        return Response(self.content, media_type=self.media_type, headers=headers)
+
+
+class Bundle:
+    """
+    The assets served by the service, by content-hashed name. A changed file
+    gets a new name, so every name can be cached forever.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.assets = {}
+
+    def add(self, name, content, media_type=None):
+        """
+        Add an asset
+
+        Parameters:
+        name (str): The file name of the asset
+        content (bytes): The content
+        media_type (str): The content type, guessed from the name if None
+
+        Returns:
+        str: The content-hashed name
+        """
+        digest = hashlib.sha256(content).hexdigest()[:16]
+        stem, extension = os.path.splitext(name)
+        hashed = stem + '.' + digest + extension
+        if hashed not in self.assets:
+            media_type = media_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            self.assets[hashed] = Asset(content, media_type, digest)
+        self.names[name] = hashed
+        return hashed
+
+    def add_file(self, file_path):
+        with open(file_path, 'rb') as f:
+            return self.add(os.path.basename(file_path), f.read())
+
+    def size(self):
+        return sum(len(asset.content) for asset in self.assets.values())
+
+
+class LocalFont(fonts.Font):
+    """
+    A font served from the bundle instead of Google Fonts, so the page makes
+    no request to another origin. Every weight found as
+    <name without spaces>-<weight>.woff2 in the fonts resources is served.
+    """
+
+    def stylesheet(self):
+        prefix = self.name.replace(' ', '') + '-'
+        faces = []
+        for file_name in sorted(bundle.names if bundle is not None else []):
+            weight = file_name[len(prefix):-len('.woff2')]
+            if file_name.startswith(prefix) and file_name.endswith('.woff2') and weight.isdigit():
+                # Relative to the stylesheet, which is bundled next to the font
+                faces.append("@font-face {font-family: '" + self.name + "'; font-style: normal; " +
+                             "font-weight: " + weight + "; font-display: swap; " +
+                             "src: url('" + bundle.names[file_name] + "') format('woff2');}")
+        if not faces:
+            raise ValueError("The " + self.name + " font is not bundled, add " + prefix + "<weight>.woff2 files to " +
+                             fonts_dir)
+
+        name = self.name.replace(' ', '') + '.css'
+        bundle.add(name, '\n'.join(faces).encode('utf-8'), 'text/css')
+        return url(name)
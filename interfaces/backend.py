@@ -0,0 +1,428 @@
+import asyncio
+import os
+import logging
+import random
+import time
+import gradio as gr
+import httpx
+import interfaces.metrics as metrics
+
+log = logging.getLogger('web-api')
+
+# Resolved once by setup(), shared by every interface
+login_api_address = None
+classifier_api_address = None
+patient_api_address = None
+limits = None
+client = None
+
+# Resilience of backend calls, set from env in setup. Deadlines are the total
+# time a call may take over all of its attempts, by service and by endpoint.
+deadlines = {}
+retries = 2
+backoff = 0.1
+breakers = {}
+
+services = {'login': 'Login', 'patient': 'Patient', 'classifier': 'Classifier'}
+
+# Requests that can be sent again, as they have no side effects or never left
+idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+unsent_errors = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+retry_statuses = (502, 503, 504)
+
+retry_count = metrics.Counter('webapi_backend_retries_total',
+                              'Backend API calls sent again after a failure', ('service',))
+
+
+def setup():
+    """
+    Resolve backend config from env. Should be called once at startup, after
+    the .env has been loaded.
+    """
+    global login_api_address, classifier_api_address, patient_api_address, limits
+
+    # Get the login api address from env
+    login_api_address = os.getenv("LOGIN_API_ADDRESS")
+    if login_api_address is None:
+        log.warning("LOGIN_API_ADDRESS not specified in env, defaulting to 127.0.0.1:8084")
+        login_api_address = '127.0.0.1:8084'
+
+    # Get the classifier api address from env
+    classifier_api_address = os.getenv("CLASSIFIER_API_ADDRESS")
+    if classifier_api_address is None:
+        log.warning("CLASSIFIER_API_ADDRESS not specified in env, defaulting to None")
+        classifier_api_address = 'None'
+
+    # Get the patient api address from env
+    patient_api_address = os.getenv("PATIENT_API_ADDRESS")
+    if patient_api_address is None:
+        log.warning("PATIENT_API_ADDRESS not specified in env, defaulting to None")
+        patient_api_address = 'None'
+
+    max_connections = get_int_env("BACKEND_MAX_CONNECTIONS", 256)
+    max_keepalive = get_int_env("BACKEND_MAX_KEEPALIVE", 32)
+    limits = httpx.Limits(max_connections=max_connections,
+                          max_keepalive_connections=max_keepalive,
+                          keepalive_expiry=30)
+
+    log.info("Backend pool: " + str(max_connections) + " connections, " + str(max_keepalive) + " kept alive")
+
+    setup_resilience()
+
+
+def setup_resilience():
+    """
+    Resolve the deadlines, retries and circuit breakers of backend calls from env
+    """
+    global retries, backoff, breakers
+
+    deadlines.clear()
+    for service, default in (('login', 5000), ('patient', 5000), ('classifier', 30000)):
+        deadlines[service] = get_int_env(service.upper() + "_API_DEADLINE_MS", default) / 1000
+
+    # Endpoint overrides, e.g. /api/v1/signin=3000,/api/v1/classify=60000
+    for entry in os.getenv("BACKEND_ENDPOINT_DEADLINES_MS", "").split(","):
+        path, _, value = entry.strip().partition("=")
+        if not path:
+            continue
+        try:
+            deadlines[path] = int(value) / 1000
+        except ValueError:
+            log.warning("Invalid deadline in BACKEND_ENDPOINT_DEADLINES_MS: " + entry)
+
+    retries = get_int_env("BACKEND_RETRIES", 2)
+    backoff = get_int_env("BACKEND_BACKOFF_MS", 100) / 1000
+    failures = get_int_env("BREAKER_FAILURES", 5)
+    reset_timeout = get_int_env("BREAKER_RESET_SECONDS", 30)
+    breakers = {service: CircuitBreaker(service, failures, reset_timeout) for service in services}
+
+    metrics.Callback('webapi_backend_circuit_state', 'Circuit breaker of a backend API, 0 closed, 1 half open, 2 open',
+                     ('service',), lambda: [((name,), breaker.state_value()) for name, breaker in breakers.items()])
+    metrics.Callback('webapi_backend_circuit_opened_total', 'Times the circuit breaker of a backend API opened',
+                     ('service',), lambda: [((name,), breaker.opened) for name, breaker in breakers.items()],
+                     kind='counter')
+
+    log.info("Backend deadlines: " + ", ".join(name + " " + str(seconds) + "s" for name, seconds in deadlines.items()) +
+             ", " + str(retries) + " retries, breakers open after " + str(failures) + " failures for " +
+             str(reset_timeout) + "s")
+
+
+def get_int_env(name, default):
+    """
+    Get an integer from env, falling back to the default if missing or invalid
+
+    Parameters:
+    name (str): The name of the env variable
+    default (int): The value to use if the env variable is not usable
+
+    Returns:
+    int: The value of the env variable
+    """
+    value = os.getenv(name)
+    if value is None:
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        log.warning(name + " is not a valid integer, defaulting to " + str(default))
+        return default
+
+
+def get_client():
+    """
+    Get the shared async client, creating it on first use so it is bound to
+    the event loop gradio runs the handlers on
+
+    Returns:
+    httpx.AsyncClient: The shared client
+    """
+    global client
+
+    if limits is None:
+        setup()
+
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(limits=limits, timeout=None)
+    return client
+
+
+def login_api_bypassed():
+    """
+    Check if the login API should be bypassed
+
+    Returns:
+    bool: True if LOGIN_API_ADDRESS is set to None
+    """
+    return login_api_address == 'None'
+
+
+async def login_api(method, path, params=None):
+    """
+    Send a request to the login API over the shared client
+
+    Parameters:
+    method (str): The HTTP method to use
+    path (str): The path of the endpoint, e.g. /api/v1/signin
+    params (dict): The query parameters to send
+
+    Returns:
+    httpx.Response: The response from the login API
+    """
+    return await request('login', method, login_api_address, path, params=params)
+
+
+def classifier_api_bypassed():
+    """
+    Check if the classifier API should be bypassed
+
+    Returns:
+    bool: True if CLASSIFIER_API_ADDRESS is set to None
+    """
+    return classifier_api_address == 'None'
+
+
+async def classifier_api(method, path, files=None):
+    """
+    Send a request to the classifier API over the shared client
+
+    Parameters:
+    method (str): The HTTP method to use
+    path (str): The path of the endpoint, e.g. /api/v1/classify
+    files (list): The multipart files to send
+
+    Returns:
+    httpx.Response: The response from the classifier API
+    """
+    # Classifying has no side effects, so it is safe to send again
+    return await request('classifier', method, classifier_api_address, path, idempotent=True, files=files)
+
+
+def patient_api_bypassed():
+    """
+    Check if the patient API should be bypassed
+
+    Returns:
+    bool: True if PATIENT_API_ADDRESS is set to None
+    """
+    return patient_api_address == 'None'
+
+
+async def patient_api(method, path, params=None, headers=None):
+    """
+    Send a request to the patient API over the shared client
+
+    Parameters:
+    method (str): The HTTP method to use
+    path (str): The path of the endpoint, e.g. /api/v1/patients
+    params (dict): The query parameters to send
+    headers (dict): Extra headers to send, e.g. If-None-Match
+
+    Returns:
+    httpx.Response: The response from the patient API
+    """
+    return await request('patient', method, patient_api_address, path, params=params, headers=headers)
+
+
+async def request(service, method, address, path, idempotent=None, **kwargs):
+    """
+    Send a request over the shared client, within the deadline of the endpoint.
+    Failed attempts are retried with jittered backoff if the request can safely
+    be sent again, and the circuit breaker of the service fails calls fast
+    while the service is down.
+
+    Parameters:
+    service (str): The name of the backend API, used in metrics
+    method (str): The HTTP method to use
+    address (str): The address of the backend API
+    path (str): The path of the endpoint
+    idempotent (bool): True if the request can be retried after it was sent, by method if None
+    **kwargs: Passed on to httpx
+
+    Returns:
+    httpx.Response: The response from the backend API
+    """
+    if limits is None:
+        setup()
+    if idempotent is None:
+        idempotent = method in idempotent_methods
+
+    breaker = breakers[service]
+    budget = deadlines.get(path, deadlines[service])
+    deadline = time.monotonic() + budget
+    attempt = 0
+    while True:
+        token = breaker.allow()
+        if token is None:
+            metrics.backend_requests.inc(service=service, endpoint=path, status='circuit_open')
+            raise gr.Error(services[service] + " API is unavailable, please try again in a moment")
+
+        response, error = None, None
+        try:
+            response = await send(service, method, address, path, deadline - time.monotonic(), **kwargs)
+        except (httpx.TransportError, asyncio.TimeoutError) as e:
+            error = e
+        finally:
+            # Cancelled, the attempt says nothing about the service
+            if response is None and error is None:
+                breaker.release(token)
+
+        failed = error is not None or response.status_code >= 500
+        breaker.record(token, not failed)
+        if error is None and not (idempotent and response.status_code in retry_statuses):
+            return response
+
+        attempt += 1
+        delay = random.uniform(0, backoff * 2 ** attempt)
+        retryable = idempotent or isinstance(error, unsent_errors)
+        if not retryable or attempt > retries or time.monotonic() + delay >= deadline:
+            if error is None:
+                return response
+            if isinstance(error, (httpx.TimeoutException, asyncio.TimeoutError)):
+                raise gr.Error(services[service] + " API did not answer within " + str(budget) + "s")
+            raise error
+
+        log.info(services[service] + " API call to " + path + " failed, retrying in " +
+                 str(round(delay * 1000)) + "ms: " + (str(error) if error is not None else str(response)))
+        retry_count.inc(service=service)
+        await asyncio.sleep(delay)
+
+
+async def send(service, method, address, path, timeout, **kwargs):
+    """
+    Send a single attempt of a request, recording its latency and status
+
+    Parameters:
+    service (str): The name of the backend API, used in metrics
+    method (str): The HTTP method to use
+    address (str): The address of the backend API
+    path (str): The path of the endpoint
+    timeout (float): The seconds left until the deadline
+    **kwargs: Passed on to httpx
+
+    Returns:
+    httpx.Response: The response from the backend API
+    """
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        # The httpx timeout bounds each phase, the wait bounds the whole attempt
+        response = await asyncio.wait_for(get_client().request(method, 'http://' + address + path,
+                                                               timeout=max(timeout, 0.001), **kwargs),
+                                          max(timeout, 0.001))
+        status = str(response.status_code)
+        return response
+    except (httpx.TimeoutException, asyncio.TimeoutError):
+        status = 'timeout'
+        raise
+    finally:
+        metrics.backend_seconds.observe(time.perf_counter() - start, service=service, endpoint=path)
+        metrics.backend_requests.inc(service=service, endpoint=path, status=status)
+
+
+class CircuitBreaker:
+    """
+    Fails calls to a backend API fast once it keeps failing. After the given
+    number of consecutive failures the breaker opens and calls are refused,
+    after the reset timeout a single probe call is let through. The breaker
+    closes again if the probe succeeds, and opens again if it fails. Every
+    call gets a token, so only the probe decides the half open state and
+    calls sent before the breaker last opened or closed are not counted.
+    """
+
+    def __init__(self, service, max_failures, reset_timeout):
+        """
+        Parameters:
+        service (str): The name of the backend API
+        max_failures (int): The consecutive failures that open the breaker
+        reset_timeout (int): The seconds the breaker stays open before probing
+        """
+        self.service = service
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0
+        self._issued = 0
+        self._since = 0 # First token issued in the current state
+        self._probe = None # Token of the probe in flight
+
+    def allow(self):
+        """
+        Check if a call may be sent, taking the probe slot when half open
+
+        Returns:
+        int: The token of the call, to record its outcome with, None if it may not be sent
+        """
+        if self.state == 'open':
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return None
+            self.state = 'half_open'
+            self._probe = None
+
+        if self.state == 'half_open' and self._probe is not None:
+            return None
+        self._issued += 1
+        if self.state == 'half_open':
+            self._probe = self._issued
+        return self._issued
+
+    def record(self, token, success):
+        """
+        Record the outcome of a call
+
+        Parameters:
+        token (int): The token allow gave the call
+        success (bool): False if the call failed or the service errored
+        """
+        if token == self._probe:
+            self._probe = None
+            if success:
+                log.info(services[self.service] + " API is back, closing its circuit breaker")
+                self._change('closed')
+            else:
+                self._open()
+            return
+
+        # Sent before the breaker last changed, it says nothing about the current state
+        if self.state != 'closed' or token < self._since:
+            return
+        if success:
+            self.failures = 0
+            return
+
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            self._open()
+
+    def release(self, token):
+        """
+        Give up the probe slot without an outcome
+
+        Parameters:
+        token (int): The token allow gave the call
+        """
+        if token == self._probe:
+            self._probe = None
+
+    def state_value(self):
+        """
+        Get the state as a number for the metrics
+
+        Returns:
+        int: 0 if closed, 1 if half open, 2 if open
+        """
+        return {'closed': 0, 'half_open': 1, 'open': 2}[self.state]
+
+    def _open(self):
+        log.warning(services[self.service] + " API is failing, opening its circuit breaker for " +
+                    str(self.reset_timeout) + "s")
+        self._change('open')
+        self.opened += 1
+        self._opened_at = time.monotonic()
+
+    def _change(self, state):
+        self.state = state
+        self.failures = 0
+        self._since = self._issued + 1
@@ -1,30 +1,38 @@
+import asyncio
 import logging
 import gradio as gr
+import pandas as pd
 from PIL import Image
-import interfaces as interfaces
+import interfaces.aio as aio
+import interfaces.classifier as classifier
+import interfaces.encoding as encoding
+import interfaces.imagecache as imagecache
+import interfaces.patient as patient
+import interfaces.prefetch as prefetch
+import interfaces.sessions as sessions
+import interfaces.tiers as tiers
+import interfaces.uploads as uploads
 
 log = logging.getLogger('web-api')
+batch_column_names = ["Image", "Classification", "Confidence"]
 
-def setup(classification_col, 
-          patient_col, 
-          current_patient_data_df, 
-          classification_refresh_flag):
+def setup(classification_col, session_id):
     """
-    Setup the account creation interface
+    Setup the classification interface, the transitions to and from other
+    views are wired by the view router in main
 
     Parameters:
     classification_col (gradio.Column): The column to add the interface to
-    patient_col (gradio.Column): The column to switch to when the cancel button is clicked
-    current_patient_data_df (gradio.Dataframe): The dataframe to update when a patient is selected
-    classification_refresh_flag (gradio.Number): The flag to refresh the classification view
+    session_id (gradio.Textbox): The hidden textbox holding the id of the session to keep the selection in
+
+    Returns:
+    dict: The components the view router needs, by name
     """
 
     # Setup classification interface
     with classification_col:
         log.debug("Setting up classification interface")
 
-        sel_image_path = gr.State()
-
         # Setu up a cancel button so we can swap easily between patient and 
         # classification view
         cancel_btn = gr.Button("X", 
@@ -46,7 +54,12 @@ def setup(classification_col,
                            placeholder="No notes attached")
                 reference_id_gal = gr.Gallery(label="Dermoscopy Images", 
                                               columns=3)
-                submit_btn = gr.Button("Submit")
+                with gr.Row():
+                    submit_btn = gr.Button("Submit")
+                    classify_all_btn = gr.Button("Classify All", variant="secondary")
+                    upload_btn = gr.UploadButton("Upload Image",
+                                                 file_types=["image"],
+                                                 variant="secondary")
 
             # Outputs
             with gr.Column():
@@ -54,117 +67,445 @@ def setup(classification_col,
                                            interactive=False)
                 output_label = gr.Label(label="Lesion Classification", 
                                         num_top_classes=3)
+                batch_results_df = gr.Dataframe(headers=batch_column_names,
+                                                datatype=["str", "str", "number"],
+                                                col_count=(3, "fixed"),
+                                                label="All Samples",
+                                                interactive=False,
+                                                visible=False)
 
         # Setup event handlers
-        classification_refresh_flag.change(lambda df: df.loc[:, df.columns != 'Notes'], 
-                                           inputs=current_patient_data_df,
-                                           outputs=curr_patient_df)
-        
-        classification_refresh_flag.change(lambda df: df['Notes'][0], 
-                                    inputs=current_patient_data_df,
-                                    outputs=notes_txt)
-        
-        classification_refresh_flag.change(get_reference_id_imgs,
-                                           inputs=current_patient_data_df,
-                                           outputs=reference_id_gal)
+        reference_id_gal.select(tiers.backend_io(update_sel_img),
+                                 inputs=session_id,
+                                 api_name="select_image")
         
-        reference_id_gal.select(update_sel_img,
-                                 inputs=reference_id_gal,
-                                 outputs=sel_image_path)
-        
-        submit_btn.click(classify,
-                         inputs=sel_image_path,
-                         outputs=[attribution_img, output_label])
-        
-        cancel_btn.click(reset, 
-                         outputs=[curr_patient_df, 
-                                  sel_image_path, 
-                                  attribution_img, 
-                                  output_label]) \
-                  .then(swap_to_patient_view, 
-                        outputs=[patient_col, classification_col])
+        upload_btn.upload(tiers.backend_io(upload_image),
+                          inputs=[session_id, curr_patient_df, upload_btn],
+                          outputs=[reference_id_gal, attribution_img, output_label],
+                          api_name="upload_image")
+
+        submit_btn.click(tiers.classify(classify, classify_queued),
+                         inputs=session_id,
+                         outputs=[attribution_img, output_label],
+                         api_name="classify")
+
+        classify_all_btn.click(tiers.classify(classify_all),
+                               inputs=session_id,
+                               outputs=batch_results_df,
+                               api_name="classify_all")
+
+        batch_results_df.select(show_batch_result,
+                                inputs=session_id,
+                                outputs=[attribution_img, output_label])
+
+    return {'cancel_btn': cancel_btn,
+            'curr_patient_df': curr_patient_df,
+            'notes_txt': notes_txt,
+            'reference_id_gal': reference_id_gal,
+            'attribution_img': attribution_img,
+            'output_label': output_label,
+            'batch_results_df': batch_results_df}
         
 
-def get_reference_id_imgs(df):
+async def open_patient(session_id, df):
+    """
+    Opens the classification view of the selected patient. The notes, the
+    images and any previous classifications are fetched at the same time, and
+    the view is shown once all of them are loaded.
+
+    Parameters:
+    session_id (str): The id of the session to keep the gallery in
+    df (gradio.Dataframe): The dataframe containing the selected patient
+
+    Returns:
+    gradio.Dataframe: The dataframe responsible for patient data
+    gradio.Textbox: The notes of the patient
+    gradio.Gallery: The reference thumbnails
+    gradio.Dataframe: The dataframe responsible for the batch results
+    """
+    reference_id = int(df["Reference ID"][0])
+    prefetched = prefetch.patients.get(reference_id)
+
+    notes, thumbnails, previous = await asyncio.gather(get_reference_id_notes(reference_id, prefetched),
+                                                       get_reference_id_imgs(session_id, reference_id, prefetched),
+                                                       classifier.previous_results(reference_id))
+
+    if previous:
+        image_ids = [(reference_id, image_id) for image_id, _ in previous]
+        results = [result for _, result in previous]
+        await sessions.save(session_id, 'batch_results', results)
+        batch_results = gr.update(value=batch_rows(image_ids, results), visible=True)
+    else:
+        batch_results = gr.update(value=None, visible=False)
+
+    return df, \
+           notes, \
+           thumbnails, \
+           batch_results
+
+
+async def prefetch_patient(reference_id, run_blocking):
+    """
+    Loads the notes and gallery thumbnails of a patient ahead of it being
+    opened, the thumbnails are kept in the thumbnail and encoded image caches
+
+    Parameters:
+    reference_id (int): The reference id of the patient
+    run_blocking (callable): Runs a blocking function in the prefetch thread pool
+
+    Returns:
+    dict: The notes and image ids of the patient
+    """
+    notes = await patient.get_reference_id_notes(reference_id)
+    image_ids = get_reference_id_image_ids(reference_id)
+    await asyncio.gather(*[run_blocking(get_encoded_thumbnail, reference_id, image_id)
+                           for image_id in image_ids])
+
+    return {'notes': notes, 'image_ids': image_ids}
+
+
+async def get_reference_id_notes(reference_id, prefetched=None):
+    """
+    Gets the notes of the given patient, prefetched notes are used first
+
+    Parameters:
+    reference_id (int): The reference id of the patient
+    prefetched (dict): The prefetched patient, if any
+
+    Returns:
+    str: The notes for the reference id
+    """
+    if prefetched is not None:
+        return prefetched['notes']
+    return await patient.get_reference_id_notes(reference_id)
+
+
+async def get_reference_id_imgs(session_id, reference_id, prefetched=None):
     """
-    Gets the reference images for the given patient
+    Gets the reference image thumbnails for the given patient, full resolution
+    images are only loaded once selected. The (reference id, image id) of each
+    thumbnail is kept in the session.
 
     Parameters:
-    df (gradio.Dataframe): The dataframe containing the patient data
+    session_id (str): The id of the session to keep the gallery in
+    reference_id (int): The reference id of the patient
+    prefetched (dict): The prefetched patient, if any
 
     Returns:
-    list: The list of reference images, as PIL.Image objects
+    list: The list of reference thumbnails, as paths of the encoded files
+    """
+    log.info("Getting reference images for: " + str(reference_id))
+
+    # Prefetched thumbnails are already in the thumbnail and encoded image caches
+    if prefetched is not None:
+        image_ids = prefetched['image_ids']
+    else:
+        image_ids = get_reference_id_image_ids(reference_id)
+
+    # Decoding and encoding are blocking, keep them off the event loop
+    thumbnails = await asyncio.gather(*[aio.run_blocking(get_encoded_thumbnail, reference_id, image_id)
+                                        for image_id in image_ids])
+
+    await sessions.save(session_id, 'gallery_image_ids', [(reference_id, image_id) for image_id in image_ids])
+    return list(thumbnails)
+
+
+def get_reference_id_image_ids(reference_id):
     """
-    log.info("Getting reference images for: " + str(df["Reference ID"][0]))
+    Gets the ids of the images attached to the given reference id
+
+    Parameters:
+    reference_id (int): The reference id to get images for
 
+    Returns:
+    list: The image ids
+    """
     # TODO, REPLACE WITH CDN ENDPOINT FOR GETTING IMAGES
-    images = [Image.open("./interfaces/resources/ISIC_0034525.jpg"),
-              Image.open("./interfaces/resources/ISIC_0034526.jpg"),
-              Image.open("./interfaces/resources/ISIC_0034527.jpg"),
-              Image.open("./interfaces/resources/ISIC_0034528.jpg"),
-              Image.open("./interfaces/resources/ISIC_0034529.jpg")]
+    return ["ISIC_0034525",
+            "ISIC_0034526",
+            "ISIC_0034527",
+            "ISIC_0034528",
+            "ISIC_0034529"]
 
-    return images
 
-def update_sel_img(imgs, evt: gr.SelectData):
+def get_reference_image_path(image_id):
     """
-    Updates the selected image
+    Gets the path of a reference image
 
     Parameters:
-    imgs (list): The list of images to select from
-    evt (gr.SelectData): The event data from the gallery
+    image_id (str): The id of the image
 
     Returns:
-    str: The path to the selected image
+    str: The path to the image
     """
-    return imgs[evt.index]['name']
+    if uploads.is_upload(image_id):
+        return uploads.path(image_id)
+
+    # TODO, REPLACE WITH CDN ENDPOINT FOR GETTING IMAGES
+    return "./interfaces/resources/" + image_id + ".jpg"
+
 
-def classify(img_path):
+def get_reference_thumbnail(reference_id, image_id):
     """
-    Classifies the given image
+    Gets a reference image thumbnail, from the thumbnail cache if possible
 
     Parameters:
-    img_path (str): The path to the image to classify
+    reference_id (int): The reference id the image belongs to
+    image_id (str): The id of the image
 
     Returns:
-    PIL.Image: The attribution image to display
-    dict: The labels and their respective confidence intervals
+    PIL.Image: The thumbnail
+    """
+    path = get_reference_image_path(image_id)
+    return imagecache.reference_thumbnails.get_or_load(reference_id, image_id,
+                                                       lambda: load_thumbnail(path, imagecache.thumbnail_size))
+
+
+def get_encoded_thumbnail(reference_id, image_id):
+    """
+    Gets a reference image thumbnail encoded for the gallery
+
+    Parameters:
+    reference_id (int): The reference id the image belongs to
+    image_id (str): The id of the image
+
+    Returns:
+    str: The path of the encoded thumbnail
+    """
+    return encoding.gallery.encode(get_reference_thumbnail(reference_id, image_id))
+
+
+def get_reference_image(reference_id, image_id):
+    """
+    Gets a decoded reference image, from the image cache if possible
+
+    Parameters:
+    reference_id (int): The reference id the image belongs to
+    image_id (str): The id of the image
+
+    Returns:
+    PIL.Image: The decoded image
+    """
+    path = get_reference_image_path(image_id)
+    return imagecache.reference_images.get_or_load(reference_id, image_id,
+                                                   lambda: load_image(path))
+
+
+def load_image(path):
+    """
+    Open and decode an image
+
+    Parameters:
+    path (str): The path to the image
+
+    Returns:
+    PIL.Image: The decoded image
+    """
+    image = Image.open(path)
+    image.load()
+    return image
+
+
+def load_thumbnail(path, size):
+    """
+    Open and decode a thumbnail of an image. JPEGs are decoded in draft mode,
+    so only a scaled down version of the image is ever decoded.
+
+    Parameters:
+    path (str): The path to the image
+    size (int): The max width and height of the thumbnail
+
+    Returns:
+    PIL.Image: The decoded thumbnail
+    """
+    image = Image.open(path)
+    image.draft('RGB', (size, size))
+    image.thumbnail((size, size))
+    return image
+
+async def update_sel_img(session_id, evt: gr.SelectData):
+    """
+    Updates the selected image kept in the session, and loads its full
+    resolution version
+
+    Parameters:
+    session_id (str): The id of the session holding the gallery
+    evt (gr.SelectData): The event data from the gallery
+    """
+    image_ids = await sessions.load(session_id, 'gallery_image_ids')
+    if image_ids is None:
+        raise gr.Error("Session expired, please log in again")
+
+    reference_id, image_id = image_ids[evt.index]
+    await sessions.save(session_id, 'sel_image', (reference_id, image_id))
+    await aio.run_blocking(get_reference_image, reference_id, image_id)
+
+async def upload_image(session_id, df, file):
+    """
+    Adds an uploaded image to the gallery of the patient and selects it, so it
+    can be classified like the reference images. The image is decoded and
+    scaled down in the upload preprocessing pool.
+
+    Parameters:
+    session_id (str): The id of the session holding the gallery
+    df (gradio.Dataframe): The dataframe containing the open patient
+    file (tempfile._TemporaryFileWrapper): The uploaded file
+
+    Returns:
+    list: The reference thumbnails, with the upload last
+    gradio.Image: The image responsible for the attribution
+    gradio.Label: The label responsible for the classification
+    """
+    if file is None:
+        return gr.update(), gr.update(), gr.update()
+
+    image_ids = await sessions.load(session_id, 'gallery_image_ids')
+    if image_ids is None:
+        raise gr.Error("Session expired, please log in again")
+
+    reference_id = int(df["Reference ID"][0])
+    log.info("Uploading image for: " + str(reference_id))
+    image_id = await uploads.preprocess(file.name)
+
+    if (reference_id, image_id) not in image_ids:
+        image_ids = list(image_ids) + [(reference_id, image_id)]
+        await sessions.save(session_id, 'gallery_image_ids', image_ids)
+    await sessions.save(session_id, 'sel_image', (reference_id, image_id))
+
+    thumbnails = await asyncio.gather(*[aio.run_blocking(get_encoded_thumbnail, reference_id, image_id)
+                                        for reference_id, image_id in image_ids])
+    return list(thumbnails), gr.update(value=None), gr.update(value=None)
+
+
+async def classify(session_id):
+    """
+    Classifies the image selected in the session, streaming each stage to the
+    display as it finishes: the labels as soon as the classifier answered, then
+    the attribution
+
+    Parameters:
+    session_id (str): The id of the session holding the selected image
+
+    Yields:
+    str: The path of the encoded attribution image to display
+    dict: The labels and their respective confidence intervals, or the status
     """
     log.info("Classifying image")
 
-    if img_path is None:
+    sel_image = await sessions.load(session_id, 'sel_image')
+    if sel_image is None:
         raise gr.Error("Please select an image to classify")
+
+    # Clear the previous result, so it is not mistaken for this one
+    yield gr.update(value=None), "Classifying..."
+
+    image = await aio.run_blocking(get_reference_image, *sel_image)
+    async for labels, attribution in classifier.classify_progressive(image, sel_image):
+        if attribution is None:
+            yield gr.update(), labels
+        else:
+            yield await aio.run_blocking(encoding.attribution.encode, attribution), labels
+
+
+def classify_queued(position):
+    """
+    Shows the position of a classification waiting for the classifier
+
+    Parameters:
+    position (int): The position of the classification in line
+
+    Returns:
+    gradio.Image: The image responsible for the attribution
+    str: The status shown by the label
+    """
+    return gr.update(value=None), "Waiting for the classifier, " + str(position) + " in line"
+
+
+async def classify_all(session_id):
+    """
+    Classifies every image of the patient in a single batch, the results are
+    kept in the session
+
+    Parameters:
+    session_id (str): The id of the session holding the gallery
+
+    Returns:
+    gradio.Dataframe: The top label and confidence of each image
+    """
+    log.info("Classifying all images")
+    ctx = aio.event_context()
+
+    image_ids = await sessions.load(session_id, 'gallery_image_ids')
+
+    if not image_ids:
+        raise gr.Error("No images to classify")
     else:
-        gr.Info("Classifiying image...")
-        log.info("Classifiying image...")
+        aio.restore_event_context(ctx)
+        gr.Info("Classifiying " + str(len(image_ids)) + " images...")
+
+    images = await asyncio.gather(*[aio.run_blocking(get_reference_image, reference_id, image_id)
+                                    for reference_id, image_id in image_ids])
+    results = await classifier.classify_batch(list(images), image_ids)
 
-    # TODO, REPLACE WITH CLASSIFICATION, only show top 3
-    labels = {
-        'Melanocytic nevi': 0.85,
-        'dermatofibroma': 0.27,
-        'Benign keratosis-like lesions': 0.12,
-        'Basal cell carcinoma': 0.03,
-        'Actinic keratoses': 0.002,
-        'Vascular lesions': 0.001,
-        'Dermatofibroma': 0.0001
-    }
+    await sessions.save(session_id, 'batch_results', results)
+    return gr.update(value=batch_rows(image_ids, results), visible=True)
 
-    return Image.open(img_path), labels
 
-def reset():
+def batch_rows(image_ids, results):
     """
-    Resets the display and all the inputs
+    Builds the results table of a batch
+
+    Parameters:
+    image_ids (list): The (reference id, image id) of each image
+    results (list): The (PIL.Image attribution, dict labels) of each image
+
+    Returns:
+    pd.DataFrame: The top label and confidence of each image
+    """
+    rows = []
+    for (_, image_id), (_, labels) in zip(image_ids, results):
+        top_label = max(labels, key=labels.get)
+        rows.append([image_id, top_label, labels[top_label]])
+    return pd.DataFrame(rows, columns=batch_column_names)
+
+
+def show_batch_result(session_id, evt: gr.SelectData):
+    """
+    Shows the attribution and labels of the selected batch result
+
+    Parameters:
+    session_id (str): The id of the session holding the batch results
+    evt (gr.SelectData): The event data from the results table
+
+    Returns:
+    str: The path of the encoded attribution image to display
+    dict: The labels and their respective confidence intervals
+    """
+    results = sessions.store.get(session_id, 'batch_results')
+    if results is None:
+        return gr.update(), gr.update()
+
+    attribution, labels = results[evt.index[0]]
+    return encoding.attribution.encode(attribution), labels
+
+def reset(session_id):
+    """
+    Resets the display and all the inputs, and frees the selection kept in the
+    session
+
+    Parameters:
+    session_id (str): The id of the session to reset
 
     Returns:
-    gradio.Column: The column responsible for patient data
-    gradio.Column: The column responsible for classification
     gradio.Dataframe: The dataframe responsible for patient data
-    gradio.Number: The flag to refresh the classification view
+    gradio.Image: The image responsible for the attribution
+    gradio.Label: The label responsible for the classification
+    gradio.Dataframe: The dataframe responsible for the batch results
     """
+    for key in ['sel_image', 'gallery_image_ids', 'batch_results']:
+        sessions.store.set(session_id, key, None)
+
     return gr.update(value=None), \
            gr.update(value=None), \
            gr.update(value=None), \
-           gr.update(value=None)
-
-def swap_to_patient_view():
-    return gr.update(visible=True), gr.update(visible=False)
\ No newline at end of file
+           gr.update(value=None, visible=False)
\ No newline at end of file
@@ -0,0 +1,187 @@
+import base64
+import io
+import logging
+import gradio as gr
+import httpx
+from PIL import Image
+import interfaces.aio as aio
+import interfaces.backend as backend
+import interfaces.inference as inference
+import interfaces.resultcache as resultcache
+
+log = logging.getLogger('web-api')
+
+# TODO, REPLACE WITH CLASSIFICATION, only show top 3
+placeholder_labels = {
+    'Melanocytic nevi': 0.85,
+    'dermatofibroma': 0.27,
+    'Benign keratosis-like lesions': 0.12,
+    'Basal cell carcinoma': 0.03,
+    'Actinic keratoses': 0.002,
+    'Vascular lesions': 0.001,
+    'Dermatofibroma': 0.0001
+}
+
+
+async def classify_batch(images, image_ids=None):
+    """
+    Classify a batch of images, only images without a cached result are sent
+    to the classifier API, in a single round trip
+
+    Parameters:
+    images (list): The PIL.Image objects to classify
+    image_ids (list): The (reference id, image id) of each image, if known, so
+                      the results can be found again by previous_results
+
+    Returns:
+    list: One (PIL.Image attribution, dict labels) tuple per image, in order
+    """
+    keys = await aio.run_blocking(lambda: [resultcache.results.key(image) for image in images])
+    cached = await aio.run_blocking(lambda: [resultcache.results.get(key) for key in keys])
+
+    missing = [i for i, result in enumerate(cached) if result is None]
+    log.debug("Classifying batch of " + str(len(images)) + " images, " + str(len(missing)) + " not cached")
+
+    if missing:
+        results = await request_classification([images[i] for i in missing])
+        for i, result in zip(missing, results):
+            cached[i] = result
+        await aio.run_blocking(lambda: [resultcache.results.put(keys[i], cached[i]) for i in missing])
+
+    if image_ids is not None:
+        for key, (reference_id, image_id) in zip(keys, image_ids):
+            resultcache.results.remember(reference_id, image_id, key)
+
+    return cached
+
+
+async def classify_progressive(image, image_id):
+    """
+    Classify a single image, yielding the labels as soon as the classifier
+    API answered and the attribution once it is decoded
+
+    Parameters:
+    image (PIL.Image): The image to classify
+    image_id (tuple): The (reference id, image id) of the image
+
+    Yields:
+    dict: The labels and their confidences
+    PIL.Image: The attribution, None until it is decoded
+    """
+    key = await aio.run_blocking(resultcache.results.key, image)
+    result = await aio.run_blocking(resultcache.results.get, key)
+
+    if result is None:
+        if inference.enabled():
+            # The model gives no attribution, the image is shown in its place
+            result = (image, (await inference.classify([image]))[0])
+        elif backend.classifier_api_bypassed():
+            result = (image, dict(placeholder_labels))
+        else:
+            raw = (await fetch_classification([image]))[0]
+            yield raw['labels'], None
+            result = (await aio.run_blocking(decode_results, [raw]))[0]
+        await aio.run_blocking(resultcache.results.put, key, result)
+
+    resultcache.results.remember(image_id[0], image_id[1], key)
+    attribution, labels = result
+    yield labels, attribution
+
+
+async def previous_results(reference_id):
+    """
+    Look up the classifications already made for the images of a patient
+
+    Parameters:
+    reference_id (int): The reference id of the patient
+
+    Returns:
+    list: The (image id, (PIL.Image attribution, dict labels)) of each classified image
+    """
+    return await aio.run_blocking(resultcache.results.previous, reference_id)
+
+
+async def request_classification(images):
+    """
+    Classify a batch of images in a single round trip to the classifier API,
+    or with the in-process inference engine if one is loaded
+
+    Parameters:
+    images (list): The PIL.Image objects to classify
+
+    Returns:
+    list: One (PIL.Image attribution, dict labels) tuple per image, in order
+    """
+    if inference.enabled():
+        return list(zip(images, await inference.classify(images)))
+    if backend.classifier_api_bypassed():
+        return [(image, dict(placeholder_labels)) for image in images]
+
+    results = await fetch_classification(images)
+    return await aio.run_blocking(decode_results, results)
+
+
+async def fetch_classification(images):
+    """
+    Send a batch of images to the classifier API
+
+    Parameters:
+    images (list): The PIL.Image objects to classify
+
+    Returns:
+    list: One result per image, in order, with the labels and the base64 encoded attribution
+    """
+    files = await aio.run_blocking(encode_images, images)
+
+    try:
+        response = await backend.classifier_api('POST', '/api/v1/classify', files=files)
+    except gr.Error:
+        raise # Deadline or circuit breaker, already clear
+    except httpx.ConnectError:
+        raise gr.Error("Classifier API connection error")
+    except Exception as e:
+        raise gr.Error("Classifier API error: " + str(e))
+
+    if response.status_code != 200:
+        raise gr.Error("Classifier API response not ok: " + str(response))
+
+    results = response.json().get('results', [])
+    if len(results) != len(images):
+        raise gr.Error("Classifier API returned " + str(len(results)) + " results for " + str(len(images)) + " images")
+    return results
+
+
+def encode_images(images):
+    """
+    Encode images as JPEG for uploading to the classifier API
+
+    Parameters:
+    images (list): The PIL.Image objects to encode
+
+    Returns:
+    list: The multipart files to send
+    """
+    files = []
+    for i, image in enumerate(images):
+        buffer = io.BytesIO()
+        image.convert('RGB').save(buffer, format='JPEG', quality=95)
+        files.append(('images', (str(i) + '.jpg', buffer.getvalue(), 'image/jpeg')))
+    return files
+
+
+def decode_results(results):
+    """
+    Decode the results returned by the classifier API
+
+    Parameters:
+    results (list): The results, each with labels and a base64 encoded attribution
+
+    Returns:
+    list: One (PIL.Image attribution, dict labels) tuple per result
+    """
+    decoded = []
+    for result in results:
+        attribution = Image.open(io.BytesIO(base64.b64decode(result['attribution'])))
+        attribution.load()
+        decoded.append((attribution, result['labels']))
+    return decoded
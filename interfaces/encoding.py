@@ -0,0 +1,278 @@
+import hashlib
+import io
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from PIL import features
+import interfaces.backend as backend
+import interfaces.metrics as metrics
+
+log = logging.getLogger('web-api')
+
+# The supported output formats, by name, with their file extension
+formats = {'webp': '.webp',
+           'jpeg': '.jpg',
+           'png': '.png'}
+
+# Gradio reads the type of file outputs from the extension
+mimetypes.add_type('image/webp', '.webp')
+
+# The encoders of the image outputs and the encoded files they share, set up in setup
+attribution = None
+gallery = None
+cache = None
+
+
+def setup():
+    """
+    Create the output encoders and the encoded image cache from env. Should be
+    called once at startup, after the .env has been loaded.
+    """
+    global attribution, gallery, cache
+
+    # Gradio serves and copies files from its temp dir, so outputs are written there
+    temp_dir = os.environ.get("GRADIO_TEMP_DIR") or os.path.join(tempfile.gettempdir(), "gradio")
+    cache = EncodedCache(temp_dir,
+                         backend.get_int_env("ENCODED_CACHE_ENTRIES", 1024),
+                         backend.get_int_env("ENCODED_FILE_GRACE_SECONDS", 3600))
+    metrics.register_cache('encoded_images', cache.stats)
+
+    attribution = get_encoder("ATTRIBUTION", 'webp', 85, 768)
+    gallery = get_encoder("GALLERY", 'webp', 80, 256)
+
+
+def get_encoder(prefix, default_format, default_quality, default_max_size):
+    """
+    Create the encoder of an output from its <PREFIX>_IMAGE_* env variables
+
+    Parameters:
+    prefix (str): The prefix of the env variables of the output
+    default_format (str): The format to use if not specified, webp, jpeg or png
+    default_quality (int): The quality to use if not specified, 1 to 100
+    default_max_size (int): The max width and height to use if not specified, 0 for no limit
+
+    Returns:
+    Encoder: The encoder
+    """
+    image_format = os.getenv(prefix + "_IMAGE_FORMAT", default_format).lower()
+    if image_format not in formats:
+        log.warning(prefix + "_IMAGE_FORMAT must be one of " + ", ".join(formats) + ", defaulting to " + default_format)
+        image_format = default_format
+    if image_format == 'webp' and not features.check('webp'):
+        log.warning("Pillow was built without WebP support, encoding " + prefix.lower() + " images as jpeg")
+        image_format = 'jpeg'
+
+    quality = backend.get_int_env(prefix + "_IMAGE_QUALITY", default_quality)
+    if not 1 <= quality <= 100:
+        log.warning(prefix + "_IMAGE_QUALITY must be between 1 and 100, defaulting to " + str(default_quality))
+        quality = default_quality
+
+    max_size = backend.get_int_env(prefix + "_IMAGE_MAX_SIZE", default_max_size)
+    log.info("Encoding " + prefix.lower() + " images as " + image_format + ", quality " + str(quality) +
+             ", max " + (str(max_size) + "px" if max_size > 0 else "size unlimited"))
+    return Encoder(image_format, quality, max_size, cache)
+
+
+class Encoder:
+    """
+    Encodes the images of one output, so gradio sends the file as is instead
+    of encoding a PNG for every response
+    """
+
+    def __init__(self, image_format, quality, max_size, encoded_cache):
+        """
+        Parameters:
+        image_format (str): The format, webp, jpeg or png
+        quality (int): The quality of lossy formats, 1 to 100
+        max_size (int): The max width and height, larger images are scaled down, 0 for no limit
+        encoded_cache (EncodedCache): The cache of the encoded files
+        """
+        self.image_format = image_format
+        self.quality = quality
+        self.max_size = max_size
+        self.cache = encoded_cache
+        self.settings = image_format + ':' + str(quality) + ':' + str(max_size)
+
+    def encode(self, image):
+        """
+        Get the encoded file of an image, from the cache if the same pixels
+        were encoded with the same settings before. Blocking.
+
+        Parameters:
+        image (PIL.Image): The image
+
+        Returns:
+        str: The path of the encoded file, for gradio image outputs
+        """
+        if image is None:
+            return None
+
+        digest = hashlib.sha256()
+        digest.update((self.settings + image.mode + str(image.size)).encode('utf-8'))
+        digest.update(image.tobytes())
+        key = digest.hexdigest()
+
+        path = self.cache.get(key)
+        if path is None:
+            path = self.cache.put(key, self.encode_bytes(image), formats[self.image_format])
+        return path
+
+    def encode_bytes(self, image):
+        """
+        Scale down and encode an image
+
+        Parameters:
+        image (PIL.Image): The image
+
+        Returns:
+        bytes: The encoded image
+        """
+        if self.max_size > 0 and max(image.size) > self.max_size:
+            image = image.copy()
+            image.thumbnail((self.max_size, self.max_size))
+
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        if self.image_format == 'jpeg' or not has_alpha:
+            image = image.convert('RGB') if image.mode != 'RGB' else image
+        elif image.mode != 'RGBA':
+            image = image.convert('RGBA')
+
+        buffer = io.BytesIO()
+        if self.image_format == 'webp':
+            image.save(buffer, 'WEBP', quality=self.quality, method=4)
+        elif self.image_format == 'jpeg':
+            image.save(buffer, 'JPEG', quality=self.quality, optimize=True, progressive=True)
+        else:
+            image.save(buffer, 'PNG')
+        return buffer.getvalue()
+
+
+class EncodedCache:
+    """
+    Bounded LRU of encoded image files, keyed by a hash of the pixels and the
+    encoder settings. Files are named by the hash of their content, the same
+    way gradio names the files it copies, so gradio serves them without
+    copying them again. Open pages and other workers may still serve the file
+    of an evicted entry, so it is only removed once it was not used for the
+    grace period. Using a file touches it.
+    """
+
+    def __init__(self, directory, max_entries, grace):
+        """
+        Parameters:
+        directory (str): The directory to write the files to
+        max_entries (int): The max number of files kept
+        grace (int): The seconds a file of an evicted entry must be unused for before it is removed
+        """
+        self.directory = directory
+        self.max_entries = max_entries
+        self.grace = grace
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._paths = OrderedDict()
+        self._expired = deque() # (evicted at, path) of files to remove once unused
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get the file of an encoded image
+
+        Parameters:
+        key (str): The hash of the pixels and encoder settings
+
+        Returns:
+        str: The path of the file, or None on a miss
+        """
+        with self._lock:
+            path = self._paths.get(key)
+            if path is not None:
+                self._paths.move_to_end(key)
+
+        # Touched so no worker removes it yet, another one may have removed it already
+        try:
+            if path is None:
+                raise FileNotFoundError(key)
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, key, data, extension):
+        """
+        Write an encoded image, evicting the least recently used files if the
+        cache is full
+
+        Parameters:
+        key (str): The hash of the pixels and encoder settings
+        data (bytes): The encoded image
+        extension (str): The file extension of the format
+
+        Returns:
+        str: The path of the file
+        """
+        directory = os.path.join(self.directory, hashlib.sha1(data).hexdigest())
+        path = os.path.abspath(os.path.join(directory, key[:16] + extension))
+        try:
+            os.utime(path)
+        except OSError:
+            os.makedirs(directory, exist_ok=True)
+            # Written under a per process name and renamed, so readers never see part of a file
+            temp_path = path + '.' + str(os.getpid()) + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+
+        if self.max_entries <= 0:
+            return path
+
+        now = time.time()
+        with self._lock:
+            self._paths[key] = path
+            self._paths.move_to_end(key)
+            while len(self._paths) > self.max_entries:
+                self._expired.append((now, self._paths.popitem(last=False)[1]))
+                self.evictions += 1
+
+            # Evicted in order, so only the front can be due
+            due = []
+            while self._expired and self._expired[0][0] + self.grace <= now:
+                due.append(self._expired.popleft()[1])
+
+        for expired_path in due:
+            self._remove(expired_path, now)
+        return path
+
+    def _remove(self, path, now):
+        try:
+            if os.stat(path).st_mtime + self.grace > now:
+                # Used since it was evicted, by this worker again or by another one, checked again later
+                with self._lock:
+                    self._expired.append((now, path))
+                return
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+        except OSError: # Already removed, or its directory holds other files
+            pass
+
+    def stats(self):
+        """
+        Get the cache counters
+
+        Returns:
+        dict: The hits, misses, evictions and entries held
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._paths)}
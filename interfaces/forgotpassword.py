@@ -1,8 +1,10 @@
 import gradio as gr
 import logging
-import requests
+import httpx
 import re
-import os
+import interfaces.aio as aio
+import interfaces.backend as backend
+import interfaces.tiers as tiers
 
 log = logging.getLogger('web-api')
 
@@ -56,7 +58,7 @@ def setup(forgot_passwd_col, login_col):
         # Event handlers
         cancel_btn.click(reset, outputs=[login_col, forgot_passwd_col, initial_forgot_col, validate_forgot_col, reset_pass_col, user_txt, valid1_num, valid2_num, valid3_num, valid4_num, valid5_num, valid6_num, new_pass_txt, c_new_pass_txt])
         
-        continue_initial_btn.click(send_forgot_passwd_request_email, 
+        continue_initial_btn.click(tiers.backend_io(send_forgot_passwd_request_email), 
                                    inputs=[user_txt], 
                                    outputs=[initial_forgot_col, validate_forgot_col])
         
@@ -64,34 +66,31 @@ def setup(forgot_passwd_col, login_col):
         continue_validate_btn.click(lambda: (gr.update(visible=False), gr.update(visible=True)),
                              outputs=[validate_forgot_col, reset_pass_col])
         
-def send_forgot_passwd_request_email(user_email):
+async def send_forgot_passwd_request_email(user_email):
     log.info("Starting reseting password for user")
+    ctx = aio.event_context()
 
     if user_email == "":
         gr.Warning("Please enter an email to reset password")
-        return [gr.update(visible=True), gr.update(visible=False), None]
+        return [gr.update(visible=True), gr.update(visible=False)]
     
     # Check if email is valid  by checking against this regex: ^..*@.*.\.(com|net|org)$
     if not re.match(r"^..*@.*.\.(com|net|org)$", user_email):
         gr.Warning("Email is not valid")
-        return [gr.update(visible=True), gr.update(visible=False), user_email]
+        return [gr.update(visible=True), gr.update(visible=False)]
 
-    # Get the login api address from env
-    address = os.getenv("LOGIN_API_ADDRESS")
-    if address is None:
-        log.warning("LOGIN_API_ADDRESS not specified in env, defaulting to 127.0.0.1:8084")
-        address = '127.0.0.1:8084'
-
-    if (address == 'None'):
+    if backend.login_api_bypassed():
         log.warning("Bypassing login API")
         success = True
     else:
         # Send the login request
         try:
             log.debug("Sending password reset request for email: " + user_email)
-            response = requests.post('http://' + address + '/api/v1/password-change-email', 
+            response = await backend.login_api('POST', '/api/v1/password-change-email', 
                                 params={'email': user_email})
-        except requests.exceptions.ConnectionError:
+        except gr.Error:
+            raise # Deadline or circuit breaker, already clear
+        except httpx.ConnectError:
             raise gr.Error("Login API connection error")
         except Exception as e:
             raise gr.Error("Login API error: " + str(e))
@@ -111,11 +110,12 @@ def send_forgot_passwd_request_email(user_email):
             raise gr.Error("Login API response not ok: " + str(response))
 
     # Inform user of login status
+    aio.restore_event_context(ctx)
     if success:
-        return [gr.update(visible=False), gr.update(visible=True), None]
+        return [gr.update(visible=False), gr.update(visible=True)]
     else:
         gr.Warning("Forgot password code not sent")
-        return [gr.update(visible=True), gr.update(visible=False), user_email]
+        return [gr.update(visible=True), gr.update(visible=False)]
 
 
 # def validate_forgot_passwd_code(valid1_num, valid2_num, valid3_num, valid4_num, valid5_num, valid6_num):
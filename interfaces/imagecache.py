@@ -0,0 +1,149 @@
+import logging
+import threading
+from collections import OrderedDict
+import interfaces.backend as backend
+import interfaces.metrics as metrics
+
+log = logging.getLogger('web-api')
+
+# Decoded reference images and thumbnails, shared by every session in the process
+reference_images = None
+reference_thumbnails = None
+thumbnail_size = 256
+
+
+def setup():
+    """
+    Create the process wide image caches from env. Should be called once at
+    startup, after the .env has been loaded.
+    """
+    global reference_images, reference_thumbnails, thumbnail_size
+
+    budget_mb = backend.get_int_env("IMAGE_CACHE_MB", 256)
+    reference_images = ImageCache("reference", budget_mb * 1024 * 1024)
+    log.info("Reference image cache: " + str(budget_mb) + "MB")
+
+    thumbnail_budget_mb = backend.get_int_env("THUMBNAIL_CACHE_MB", 32)
+    reference_thumbnails = ImageCache("thumbnail", thumbnail_budget_mb * 1024 * 1024)
+    thumbnail_size = backend.get_int_env("THUMBNAIL_SIZE", 256)
+    metrics.register_cache('reference_images', reference_images.stats)
+    metrics.register_cache('reference_thumbnails', reference_thumbnails.stats)
+    log.info("Thumbnail cache: " + str(thumbnail_budget_mb) + "MB, " + str(thumbnail_size) + "px")
+
+
+def image_size(image):
+    """
+    Estimate the memory held by a decoded image
+
+    Parameters:
+    image (PIL.Image): The decoded image
+
+    Returns:
+    int: The size of the image in bytes
+    """
+    return image.width * image.height * len(image.getbands())
+
+
+class ImageCache:
+    """
+    Bounded LRU cache for decoded images, keyed by reference id and image id.
+    Least recently used images are evicted once the byte budget is exceeded.
+    """
+
+    def __init__(self, name, max_bytes):
+        """
+        Parameters:
+        name (str): The name of the cache, used in logs
+        max_bytes (int): The byte budget of the cache
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, reference_id, image_id):
+        """
+        Get an image from the cache
+
+        Parameters:
+        reference_id (int): The reference id the image belongs to
+        image_id (str): The id of the image
+
+        Returns:
+        PIL.Image: The cached image, or None on a miss
+        """
+        key = (str(reference_id), str(image_id))
+        with self._lock:
+            entry = self._images.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._images.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, reference_id, image_id, image):
+        """
+        Add an image to the cache, evicting the least recently used images if
+        the budget is exceeded. Images bigger than the whole budget are skipped.
+
+        Parameters:
+        reference_id (int): The reference id the image belongs to
+        image_id (str): The id of the image
+        image (PIL.Image): The decoded image
+        """
+        key = (str(reference_id), str(image_id))
+        size = image_size(image)
+        if size > self.max_bytes:
+            log.debug("Image " + str(key) + " too big for " + self.name + " cache")
+            return
+
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+            self._images[key] = (image, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._images.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def get_or_load(self, reference_id, image_id, loader):
+        """
+        Get an image from the cache, loading and caching it on a miss
+
+        Parameters:
+        reference_id (int): The reference id the image belongs to
+        image_id (str): The id of the image
+        loader (callable): Called with no arguments to load the image on a miss
+
+        Returns:
+        PIL.Image: The decoded image
+        """
+        image = self.get(reference_id, image_id)
+        if image is None:
+            image = loader()
+            self.put(reference_id, image_id, image)
+        return image
+
+    def stats(self):
+        """
+        Get the cache counters
+
+        Returns:
+        dict: The hits, misses, evictions, entries and bytes held
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._images),
+                    'bytes': self.bytes}
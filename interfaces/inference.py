@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import gradio as gr
+import numpy as np
+from PIL import Image
+import interfaces.aio as aio
+import interfaces.backend as backend
+import interfaces.metrics as metrics
+try:
+    import onnxruntime
+except ImportError: # Optional, only needed for the onnx engine
+    onnxruntime = None
+
+log = logging.getLogger('web-api')
+
+# The labels of the model outputs, in order
+default_labels = ['Actinic keratoses',
+                  'Basal cell carcinoma',
+                  'Benign keratosis-like lesions',
+                  'Dermatofibroma',
+                  'Melanoma',
+                  'Melanocytic nevi',
+                  'Vascular lesions']
+
+# ImageNet statistics, the inputs most lesion models are trained on
+mean = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape(3, 1, 1)
+std = np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape(3, 1, 1)
+
+batch_sizes = metrics.Histogram('webapi_inference_batch_size',
+                                'Images per inference batch', buckets=(1, 2, 4, 8, 16, 32, 64))
+batch_seconds = metrics.Histogram('webapi_inference_batch_duration_seconds',
+                                  'Time the engine spent on a batch')
+
+# The in-process inference engines, by the name set in INFERENCE_ENGINE
+engines = {}
+
+# Set from env in setup, None while the classifier API classifies
+batcher = None
+labels = default_labels
+input_size = 224
+
+
+def setup():
+    """
+    Load the inference engine from env. Should be called once at startup in
+    the process serving events, after the .env has been loaded. The model is
+    only loaded if INFERENCE_ENGINE is set, the classifier API is used otherwise.
+    """
+    global batcher, labels, input_size
+
+    name = os.getenv("INFERENCE_ENGINE", "api").lower()
+    if name == "api":
+        log.info("Inference: classifier API")
+        return
+    if name not in engines:
+        log.warning("INFERENCE_ENGINE must be api or one of " + ", ".join(engines) + ", using the classifier API")
+        return
+
+    model_path = os.getenv("MODEL_PATH")
+    if model_path is None:
+        log.warning("MODEL_PATH not specified in env, using the classifier API")
+        return
+
+    # Every worker runs its own engine, split the cores between them
+    workers = max(1, backend.get_int_env("WEB_WORKERS", 1))
+    threads = backend.get_int_env("INFERENCE_THREADS", max(1, (os.cpu_count() or 1) // workers))
+    input_size = backend.get_int_env("MODEL_INPUT_SIZE", 224)
+    labels_env = os.getenv("MODEL_LABELS")
+    labels = [label.strip() for label in labels_env.split(",")] if labels_env else default_labels
+
+    start = time.perf_counter()
+    engine = engines[name](model_path, threads)
+
+    # A model exported with a fixed batch size cannot run larger batches
+    max_batch = max(1, backend.get_int_env("INFERENCE_MAX_BATCH", 16))
+    if engine.batch_size is not None and max_batch > engine.batch_size:
+        log.warning("The model takes batches of " + str(engine.batch_size) + " images, capping INFERENCE_MAX_BATCH of " +
+                    str(max_batch) + " to " + str(engine.batch_size))
+        max_batch = engine.batch_size
+
+    # A first run of a full batch allocates the buffers of the engine, and
+    # catches a model not taking the batch or not matching the labels
+    try:
+        outputs = engine.run(np.zeros((max_batch, 3, input_size, input_size), dtype=np.float32))
+    except Exception as e:
+        raise ValueError("The model failed a batch of " + str(max_batch) + " images of " + str(input_size) + "px, " +
+                         "check MODEL_INPUT_SIZE and INFERENCE_MAX_BATCH: " + str(e))
+    if outputs.shape[0] != max_batch:
+        raise ValueError("The model returned " + str(outputs.shape[0]) + " outputs for a batch of " + str(max_batch) +
+                         " images, set INFERENCE_MAX_BATCH to the batch size of the model")
+    if outputs.shape[-1] != len(labels):
+        raise ValueError("The model has " + str(outputs.shape[-1]) + " outputs, but MODEL_LABELS has " +
+                         str(len(labels)) + " labels")
+
+    batcher = MicroBatcher(engine,
+                           max_batch,
+                           backend.get_int_env("INFERENCE_BATCH_WINDOW_MS", 5) / 1000)
+    metrics.Callback('webapi_inference_pending', 'Images waiting for an inference batch', (),
+                     lambda: [((), len(batcher.pending))])
+    log.info("Inference: " + name + " engine, " + model_path + " loaded in " +
+             str(round((time.perf_counter() - start) * 1000)) + "ms, " + str(threads) + " threads, batches of up to " +
+             str(batcher.max_batch) + " within " + str(round(batcher.window * 1000)) + "ms")
+
+
+def enabled():
+    return batcher is not None
+
+
+async def classify(images):
+    """
+    Classify images with the in-process engine. Every image joins the next
+    batch, along with the images of other sessions classified at the same time.
+
+    Parameters:
+    images (list): The PIL.Image objects to classify
+
+    Returns:
+    list: One dict of labels and their confidences per image, in order
+    """
+    inputs = await aio.run_blocking(lambda: [preprocess(image) for image in images])
+    try:
+        outputs = await asyncio.gather(*[batcher.infer(array) for array in inputs])
+    except Exception: # Logged with the batch
+        raise gr.Error("Classification failed, please try again")
+    return [dict(zip(labels, probabilities(output).tolist())) for output in outputs]
+
+
+def preprocess(image):
+    """
+    Convert an image to the normalized input of the model
+
+    Parameters:
+    image (PIL.Image): The image
+
+    Returns:
+    numpy.ndarray: The float32 input, channels first
+    """
+    # Uploads are already resized in the upload preprocessing pool
+    image = image.convert('RGB')
+    if image.size != (input_size, input_size):
+        image = image.resize((input_size, input_size), Image.BILINEAR)
+    array = np.asarray(image, dtype=np.float32).transpose(2, 0, 1) / 255.0
+    return (array - mean) / std
+
+
+def probabilities(output):
+    """
+    Get the class probabilities of a model output, applying a softmax unless
+    the model already outputs probabilities
+
+    Parameters:
+    output (numpy.ndarray): The output of the model for one image
+
+    Returns:
+    numpy.ndarray: The probabilities
+    """
+    output = output.astype(np.float64).ravel()
+    if output.min() >= 0 and abs(output.sum() - 1) < 1e-3:
+        return output
+    exp = np.exp(output - output.max())
+    return exp / exp.sum()
+
+
+class OnnxEngine:
+    """
+    Runs an ONNX model with ONNX Runtime on the CPU. The intra-op threads are
+    pinned to the configured count and do not spin between batches, so the
+    engine leaves the rest of the cores to the service. Smaller batches of a
+    model exported with a fixed batch size are padded to it.
+    """
+
+    def __init__(self, model_path, threads):
+        """
+        Parameters:
+        model_path (str): The path of the .onnx model
+        threads (int): The number of threads running a batch
+        """
+        if onnxruntime is None:
+            raise RuntimeError("INFERENCE_ENGINE is onnx, but onnxruntime is not installed")
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.add_session_config_entry('session.intra_op.allow_spinning', '0')
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+
+        # A dynamic batch dimension is a name or None, a fixed one a number
+        batch_dim = model_input.shape[0] if model_input.shape else None
+        self.batch_size = batch_dim if isinstance(batch_dim, int) and batch_dim > 0 else None
+
+    def run(self, batch):
+        """
+        Run a batch through the model
+
+        Parameters:
+        batch (numpy.ndarray): The inputs, stacked on the first axis
+
+        Returns:
+        numpy.ndarray: The outputs, one row per input
+        """
+        count = len(batch)
+        if self.batch_size is not None and count < self.batch_size:
+            padding = np.zeros((self.batch_size - count,) + batch.shape[1:], dtype=batch.dtype)
+            batch = np.concatenate([batch, padding])
+        return self.session.run(None, {self.input_name: batch})[0][:count]
+
+
+engines['onnx'] = OnnxEngine
+
+
+class MicroBatcher:
+    """
+    Gathers inference requests into batches. A batch runs once it is full, or
+    once its oldest request waited for the batch window, so requests that
+    waited for the previous batch do not wait again. Batches run one at a time
+    on a dedicated thread.
+    """
+
+    def __init__(self, engine, max_batch, window):
+        """
+        Parameters:
+        engine (object): The engine, with a run method taking a stacked batch
+        max_batch (int): The max number of inputs per batch
+        window (float): The seconds to wait for a batch to fill
+        """
+        self.engine = engine
+        self.max_batch = max(1, max_batch)
+        self.window = window
+        self.pending = []
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='inference')
+
+        # Created on the event loop, only touched there
+        self._ready = None
+        self._full = None
+        self._task = None
+
+    async def infer(self, array):
+        """
+        Run an input in the next batch
+
+        Parameters:
+        array (numpy.ndarray): The input
+
+        Returns:
+        numpy.ndarray: The output of the model for the input
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None:
+            self._ready = asyncio.Event()
+            self._full = asyncio.Event()
+            self._task = loop.create_task(self.run())
+
+        future = loop.create_future()
+        self.pending.append((array, future, loop.time()))
+        self._ready.set()
+        if len(self.pending) >= self.max_batch:
+            self._full.set()
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._ready.wait()
+
+            # Wait for the batch to fill, at most until the oldest input waited the window
+            remaining = self.pending[0][2] + self.window - loop.time()
+            if remaining > 0 and len(self.pending) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            if not self.pending:
+                self._ready.clear()
+            if len(self.pending) < self.max_batch:
+                self._full.clear()
+
+            # Inputs whose handler gave up are dropped
+            batch = [entry for entry in batch if not entry[1].done()]
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            try:
+                outputs = await loop.run_in_executor(self._executor, self.engine.run,
+                                                     np.stack([array for array, _, _ in batch]))
+            except Exception as e:
+                log.error("Inference batch of " + str(len(batch)) + " failed: " + str(e))
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            batch_sizes.observe(len(batch))
+            batch_seconds.observe(time.perf_counter() - start)
+            for (_, future, _), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
@@ -1,26 +1,28 @@
 import hashlib
 import logging
-import os
 import gradio as gr
-import requests
-import interfaces as interfaces
+import httpx
+import interfaces.aio as aio
+import interfaces.backend as backend
+import interfaces.metrics as metrics
+import interfaces.prefetch as prefetch
+import interfaces.sessions as sessions
 
 log = logging.getLogger('web-api')
 
-def setup(login_col, patient_col, acc_creation_col, forgot_passwd_col, current_user, patient_refresh_flag):
+def setup(login_col, acc_creation_col, forgot_passwd_col):
     """
-    Sets up the login interface with the given columns for account creation, password recovery, and patient view.
+    Sets up the login interface with the given columns for account creation and password recovery. The transition
+    to the patient view is wired by the view router in main.
     
     Parameters:
     login_col (gradio.Column): The column where the login interface will be displayed.
-    patient_col (gradio.Column): The column where the patient view will be displayed after successful login.
     acc_creation_col (gradio.Column): The column where the account creation interface will be displayed after clicking the "Create an account" button.
     forgot_passwd_col (gradio.Column): The column where the password recovery interface will be displayed after clicking the "Forgot Password?" button.
-    current_user (gradio.State): The state where the current user will be stored.
-    patient_refresh_flag (gradio.State): The state where the patient view's refresh flag will be stored.
+
+    Returns:
+    dict: The components the view router needs, by name.
     """
-    
-    login_status = gr.State(False) # True if login successful, False otherwise
 
     # Setup login interface
     with login_col:
@@ -61,13 +63,10 @@ def setup(login_col, patient_col, acc_creation_col, forgot_passwd_col, current_u
     
     forgot_btn.click(lambda: (gr.update(visible=False), gr.update(visible=True)),
                     outputs=[login_col, forgot_passwd_col])
-    
-    login_btn.click(send_login_request, 
-              inputs=[user_txt, passw_txt], 
-              outputs=[login_status, current_user]) \
-             .then(swap_to_patient_view, 
-             inputs=login_status, 
-             outputs=[login_col, patient_col, patient_refresh_flag])
+
+    return {'login_btn': login_btn,
+            'user_txt': user_txt,
+            'passw_txt': passw_txt}
 
 
 def validate_input(user, passw):
@@ -97,34 +96,31 @@ def validate_input(user, passw):
     return user_elem, passw_elem
 
 
-def send_login_request(user, passw):
+@metrics.timed('send_login_request')
+async def send_login_request(session_id, user, passw):
     """
-    Send login request to backend
+    Send login request to backend, the username is stored in the session
 
     Parameters:
+    session_id (str): The id of the session to store the login in.
     user (str): The username inputted by the user.
-    passw (str): The password inputted by the user.\
-    
+    passw (str): The password inputted by the user.
+
     Returns:
-    bool: The login status.
-    str: The username.
+    bool: True if the login was successful.
     """
     log.info("Logging in user")
+    ctx = aio.event_context()
+    prefetch.patients.cancel(session_id)
     user_elem, passw_elem = validate_input(user, passw)
 
     if (user_elem is not None) or (passw_elem is not None):
-        return False, ""
+        return False
 
     # Encrypt the password
     encrypted_passw = hashlib.sha256(passw.encode('utf-8')).hexdigest()
 
-    # Get the login api address from env
-    address = os.getenv("LOGIN_API_ADDRESS")
-    if address is None:
-        print("WARNING: LOGIN_API_ADDRESS not specified in env, defaulting to 127.0.0.1:8084")
-        address = '127.0.0.1:8084'
-
-    if (address == 'None'):
+    if backend.login_api_bypassed():
         log.warning("Bypassing login API")
         success = True
         name = 'Admin'
@@ -132,9 +128,11 @@ def send_login_request(user, passw):
         # Send the login request
         try:
             log.debug("Sending login request: " + str(user) + ", " + str(encrypted_passw))
-            response = requests.get('http://' + address + '/api/v1/signin', 
+            response = await backend.login_api('GET', '/api/v1/signin', 
                                 params={'username': user, 'password_hash': encrypted_passw})
-        except requests.exceptions.ConnectionError:
+        except gr.Error:
+            raise # Deadline or circuit breaker, already clear
+        except httpx.ConnectError:
             raise gr.Error("Login API connection error")
         except Exception as e:
             raise gr.Error("Login API error: " + str(e))
@@ -149,26 +147,10 @@ def send_login_request(user, passw):
             raise gr.Error("Login API response not ok: " + str(response))
 
     # Inform user of login status
+    aio.restore_event_context(ctx)
     gr.Info("Login successful") if success else gr.Warning("Login unsuccessful")
 
     # Make sure to update doctor name 
-    return success, name
-
-
-def swap_to_patient_view(login_status):
-    """
-    Toggle visibility of the login interface
-
-    Parameters:
-    login_status (bool): The login status returned from the login request.
-
-    Returns:
-    gradio.Column: The login column.
-    gradio.Column: The patient view column.
-    gradio.Column: The patient view column's refresh flag.
-    """
-    if login_status:
-        log.debug("Swapping to patient view")
-        return gr.update(visible=False), gr.update(visible=True), gr.update(value=1)
-    else:
-        return gr.update(visible=True), gr.update(visible=False), gr.update(value=0)
\ No newline at end of file
+    if success:
+        await sessions.save(session_id, 'user', name)
+    return success
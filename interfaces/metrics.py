@@ -0,0 +1,452 @@
+import asyncio
+import functools
+import inspect
+import logging
+import threading
+import time
+from collections import OrderedDict
+import httpx
+from fastapi import Request
+from fastapi.responses import PlainTextResponse
+import interfaces.aio as aio
+
+log = logging.getLogger('web-api')
+
+# Every metric exposed on the metrics route, by name
+registry = OrderedDict()
+registry_lock = threading.Lock()
+
+# Max seconds to wait for the metrics of another worker
+scrape_timeout = 2
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values):
+    """
+    Format the labels of a sample in the Prometheus text format
+
+    Parameters:
+    names (tuple): The label names
+    values (tuple): The label values
+
+    Returns:
+    str: The labels, empty if there are none
+    """
+    if not names:
+        return ''
+    escaped = [str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values]
+    return '{' + ','.join(name + '="' + value + '"' for name, value in zip(names, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A named metric with a fixed set of label names, registered on creation
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        Parameters:
+        name (str): The name of the metric
+        documentation (str): The help text of the metric
+        labels (tuple): The label names
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        with registry_lock:
+            registry[name] = self
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self):
+        """
+        Render the metric in the Prometheus text format
+
+        Returns:
+        list: The lines of the metric
+        """
+        lines = ['# HELP ' + self.name + ' ' + self.documentation,
+                 '# TYPE ' + self.name + ' ' + self.kind]
+        for suffix, names, values, value in self.samples():
+            lines.append(self.name + suffix + format_labels(names, values) + ' ' + format_value(value))
+        return lines
+
+    def samples(self):
+        return []
+
+
+class Counter(Metric):
+    """
+    A value that only goes up
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        """
+        Increment the counter
+
+        Parameters:
+        amount (float): The amount to add
+        **labels: The label values
+        """
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [('', self.labels, key, value) for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    """
+    Counts observations into cumulative buckets
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=default_buckets):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        """
+        Record an observation
+
+        Parameters:
+        value (float): The observed value
+        **labels: The label values
+        """
+        key = self.key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+
+        samples = []
+        names = self.labels + ('le',)
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(('_bucket', names, key + (format_value(bound),), cumulative))
+            samples.append(('_sum', self.labels, key, total))
+            samples.append(('_count', self.labels, key, cumulative))
+        return samples
+
+
+class Callback(Metric):
+    """
+    A gauge or counter read from the application when scraped
+    """
+
+    def __init__(self, name, documentation, labels, collect, kind='gauge'):
+        """
+        Parameters:
+        name (str): The name of the metric
+        documentation (str): The help text of the metric
+        labels (tuple): The label names
+        collect (callable): Returns a list of (label values, value)
+        kind (str): The metric type, gauge or counter
+        """
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        try:
+            return [('', self.labels, tuple(values), value) for values, value in self.collect()]
+        except Exception as e:
+            log.warning("Could not collect metric " + self.name + ": " + str(e))
+            return []
+
+
+handler_seconds = Histogram('webapi_handler_duration_seconds',
+                            'Time spent in event handlers', ('handler',))
+handler_errors = Counter('webapi_handler_errors_total',
+                         'Event handlers that raised', ('handler',))
+backend_seconds = Histogram('webapi_backend_request_duration_seconds',
+                            'Time spent in backend API calls', ('service', 'endpoint'))
+backend_requests = Counter('webapi_backend_requests_total',
+                           'Backend API calls by response status', ('service', 'endpoint', 'status'))
+queue_wait_seconds = Histogram('webapi_queue_wait_seconds',
+                               'Time events wait in the queue before they are processed')
+
+# Cache counters, registered by the caches in their setup
+caches = OrderedDict()
+
+
+def register_cache(name, stats):
+    """
+    Expose the hits, misses and hit ratio of a cache
+
+    Parameters:
+    name (str): The name of the cache
+    stats (callable): Returns a dict with at least hits and misses
+    """
+    caches[name] = stats
+
+
+def collect_caches(key):
+    samples = []
+    for name, stats in list(caches.items()):
+        values = stats()
+        if key == 'ratio':
+            lookups = values['hits'] + values['misses']
+            samples.append(((name,), values['hits'] / lookups if lookups else 0.0))
+        else:
+            samples.append(((name,), values[key]))
+    return samples
+
+
+Callback('webapi_cache_hits_total', 'Cache lookups that hit', ('cache',),
+         functools.partial(collect_caches, 'hits'), kind='counter')
+Callback('webapi_cache_misses_total', 'Cache lookups that missed', ('cache',),
+         functools.partial(collect_caches, 'misses'), kind='counter')
+Callback('webapi_cache_hit_ratio', 'Fraction of cache lookups that hit', ('cache',),
+         functools.partial(collect_caches, 'ratio'))
+
+
+def render():
+    """
+    Render every registered metric in the Prometheus text format
+
+    Returns:
+    str: The exposition
+    """
+    with registry_lock:
+        metrics = list(registry.values())
+
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def label_worker(line, worker):
+    """
+    Add the worker label to a sample line of the Prometheus text format
+
+    Parameters:
+    line (str): The sample line
+    worker (str): The index of the worker the sample is from
+
+    Returns:
+    str: The sample line with the worker label first
+    """
+    end = min(i for i in (line.find('{'), line.find(' ')) if i >= 0)
+    label = 'worker="' + worker + '"'
+    if line[end] == '{':
+        return line[:end] + '{' + label + ',' + line[end + 1:]
+    return line[:end] + '{' + label + '}' + line[end:]
+
+
+def merge(expositions):
+    """
+    Merge the metrics of several workers, labelling every sample with the
+    worker it is from, so counters of different workers are separate series
+
+    Parameters:
+    expositions (list): The index of each worker and its metrics in the Prometheus text format
+
+    Returns:
+    str: The merged exposition
+    """
+    families = OrderedDict()
+    for worker, text in expositions:
+        name = None
+        for line in text.splitlines():
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                name = line.split(' ', 3)[2]
+                family = families.setdefault(name, {'HELP': None, 'TYPE': None, 'samples': []})
+                family[line[2:6]] = family[line[2:6]] or line
+            elif line and not line.startswith('#') and name is not None:
+                families[name]['samples'].append(label_worker(line, str(worker)))
+
+    lines = []
+    for family in families.values():
+        lines.extend(line for line in (family['HELP'], family['TYPE']) if line is not None)
+        lines.extend(family['samples'])
+    return '\n'.join(lines) + '\n'
+
+
+async def scrape(url):
+    """
+    Get the metrics of another worker
+
+    Parameters:
+    url (str): The url of the metrics route of the worker
+
+    Returns:
+    str: The metrics in the Prometheus text format, None if the worker did not answer
+    """
+    try:
+        async with httpx.AsyncClient(timeout=scrape_timeout) as client:
+            response = await client.get(url, params={'scope': 'worker'})
+            response.raise_for_status()
+            return response.text
+    except httpx.HTTPError as e: # Restarting, its next scrape covers it again
+        log.warning("Could not scrape the metrics of " + url + ": " + str(e))
+        return None
+
+
+def timed(name):
+    """
+    Decorator recording the duration and errors of a handler. Works for sync,
+    async and generator handlers, and keeps the signature gradio inspects.
+
+    Parameters:
+    name (str): The handler label
+
+    Returns:
+    callable: The decorator
+    """
+    def decorator(fn):
+        def record(start, failed):
+            handler_seconds.observe(time.perf_counter() - start, handler=name)
+            if failed:
+                handler_errors.inc(handler=name)
+
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                start, failed = time.perf_counter(), True
+                try:
+                    async for value in fn(*args, **kwargs):
+                        yield value
+                    failed = False
+                finally:
+                    record(start, failed)
+        elif inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                start, failed = time.perf_counter(), True
+                try:
+                    result = await fn(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    record(start, failed)
+        elif inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start, failed = time.perf_counter(), True
+                try:
+                    yield from fn(*args, **kwargs)
+                    failed = False
+                finally:
+                    record(start, failed)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start, failed = time.perf_counter(), True
+                try:
+                    result = fn(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    record(start, failed)
+
+        wrapper.timed = True
+        return wrapper
+    return decorator
+
+
+def instrument(demo):
+    """
+    Time every event handler of an interface and the queue it runs on. Should
+    be called after the queue is enabled, before launching.
+
+    Parameters:
+    demo (gradio.Blocks): The interface
+    """
+    for block_fn in demo.fns:
+        fn = block_fn.fn
+        if fn is None:
+            continue
+
+        # Time the handler itself, the wait for a tier slot has its own metric
+        tier = getattr(fn, 'tier', None)
+        queued = getattr(fn, 'queued', None)
+        if tier is not None:
+            fn = fn.__wrapped__
+        if not getattr(fn, 'timed', False):
+            fn = timed(block_fn.name)(fn)
+        block_fn.fn = tier(fn, queued) if tier is not None else fn
+
+    queue = demo._queue
+    if queue is None:
+        return
+
+    Callback('webapi_queue_depth', 'Events waiting in the queue', (),
+             lambda: [((), len(queue.event_queue))])
+    Callback('webapi_queue_active_jobs', 'Events being processed', (),
+             lambda: [((), queue.get_active_worker_count())])
+
+    # Gradio does not keep when an event joined the queue, stamp it on push
+    push = queue.push
+    process_events = queue.process_events
+
+    def timed_push(event, *args, **kwargs):
+        event.joined_at = time.monotonic()
+        return push(event, *args, **kwargs)
+
+    async def timed_process_events(events, *args, **kwargs):
+        now = time.monotonic()
+        for event in events:
+            if hasattr(event, 'joined_at'):
+                queue_wait_seconds.observe(now - event.joined_at)
+        return await process_events(events, *args, **kwargs)
+
+    queue.push = timed_push
+    queue.process_events = timed_process_events
+
+
+def mount(app, path, peers=None):
+    """
+    Add the metrics route to the app gradio launched. With several workers
+    every scrape covers all of them, whichever worker answers it, and
+    ?scope=worker only covers the worker that answers.
+
+    Parameters:
+    app (fastapi.FastAPI): The app
+    path (str): The path of the route
+    peers (callable): Returns the index and private url of every worker, the url None for this one
+    """
+    @app.get(path, response_class=PlainTextResponse)
+    async def metrics_route(request: Request):
+        # The session stores read their stats from the database or server
+        workers = peers() if peers is not None else []
+        if not workers or request.query_params.get('scope') == 'worker':
+            text = await aio.run_blocking(render)
+        else:
+            texts = await asyncio.gather(*[scrape(url + path) if url is not None else aio.run_blocking(render)
+                                           for _, url in workers])
+            text = merge([(worker, text) for (worker, _), text in zip(workers, texts) if text is not None])
+        return PlainTextResponse(text, media_type='text/plain; version=0.0.4; charset=utf-8')
+
+    log.info("Metrics exposed on " + path)
@@ -1,31 +1,50 @@
+import asyncio
+import hashlib
+import json
 import logging
+import secrets
 import gradio as gr
+import httpx
 import pandas as pd
+import interfaces.aio as aio
+import interfaces.assets as assets
+import interfaces.backend as backend
+import interfaces.metrics as metrics
+import interfaces.patientcache as patientcache
+import interfaces.prefetch as prefetch
+import interfaces.searchindex as searchindex
+import interfaces.sessions as sessions
+import interfaces.tiers as tiers
 
 log = logging.getLogger('web-api')
 column_names = ["Name", "Reference ID", "Samples", "Date"]
+sort_orders = ["Ascending", "Descending"]
+page_size = 25 # Set from env in setup
+search_limit = 100 # Set from env in setup
+search_debounce = 0.25 # Set from env in setup
 
-def setup(patient_col, 
-          current_user, 
-          patient_refresh_flag, 
-          classification_col, 
-          current_patient_data_df, 
-          classification_refresh_flag):
+# TODO, remove once the patient API is live
+placeholder_patients = {"Name":{"0":"John Doe","1":"Jane Doe","2":"Greg Smith","3":"Alice Smith","4":"John Johnson","5":"Jane Johnson","6":"Thomas Williams","7":"Nicole Williams","8":"John Brown","9":"Jane Brown","10":"Adam Jones","11":"Keith Jones","12":"Ian Miller","13":"Jane Miller","14":"John Davis","15":"Jane Davis","16":"John Garcia","17":"Jane Garcia","18":"John Rodriguez"},"Reference ID":{"0":1000,"1":1001,"2":1002,"3":1003,"4":1004,"5":1005,"6":1006,"7":1007,"8":1008,"9":1009,"10":1010,"11":1011,"12":1012,"13":1013,"14":1014,"15":1015,"16":1016,"17":1017,"18":1018},"Samples":{"0":1,"1":2,"2":3,"3":4,"4":5,"5":6,"6":7,"7":8,"8":9,"9":10,"10":11,"11":12,"12":13,"13":14,"14":15,"15":16,"16":17,"17":18,"18":19},"Date":{"0":"2021-01-01","1":"2021-01-01","2":"2021-01-01","3":"2021-01-01","4":"2021-01-01","5":"2021-01-01","6":"2021-01-01","7":"2021-01-01","8":"2021-01-01","9":"2021-01-01","10":"2021-01-01","11":"2021-01-01","12":"2021-01-01","13":"2021-01-01","14":"2021-01-01","15":"2021-01-01","16":"2021-01-01","17":"2021-01-01","18":"2021-01-01"}}
+
+def setup(patient_col, session_id):
     """
-    Setup the patient list interface
+    Setup the patient list interface, the transitions to and from other views
+    are wired by the view router in main
 
     Parameters:
     patient_col (gradio.Column): The column to add the interface to
-    current_user (gradio.State): The state to get the current user from
-    patient_refresh_flag (gradio.Number): The flag to refresh the patient list
-    classification_col (gradio.Column): The column to switch to when a patient is selected
-    current_patient_data_df (gradio.Dataframe): The dataframe to update when a patient is selected
-    classification_refresh_flag (gradio.Number): The flag to refresh the classification view
+    session_id (gradio.Textbox): The hidden textbox holding the id of the session to get the current user from
+
+    Returns:
+    dict: The components the view router needs, by name
     """
+    global page_size, search_limit, search_debounce
+    page_size = backend.get_int_env("PATIENT_PAGE_SIZE", 25)
+    search_limit = backend.get_int_env("PATIENT_SEARCH_LIMIT", 100)
+    search_debounce = backend.get_int_env("PATIENT_SEARCH_DEBOUNCE_MS", 250) / 1000
+
     # Setup patient list interface
     with patient_col:
-        backup_df = gr.State() # Backup dataframe for searching
-
         # Header
         with gr.Row(elem_id="patientheader"):
             gr.Markdown("<h1 style=\"font-size: 48px; margin-bottom:0px;\">Patients</h1>")
@@ -34,13 +53,13 @@ def setup(patient_col,
         # Patient list with search and refresh
         with gr.Row():
             refresh_btn = gr.Button("",
-                                    icon="./interfaces/resources/arrows-rotate-solid.svg",
+                                    icon=assets.path("arrows-rotate-solid.svg"),
                                     variant="primary", 
                                     elem_id="iconbutton", 
                                     scale=0)
             
             search_btn = gr.Button("",
-                                   icon="./interfaces/resources/magnifying-glass-solid.svg",
+                                   icon=assets.path("magnifying-glass-solid.svg"),
                                    variant="primary", 
                                    elem_id="iconbutton", 
                                    scale=0)
@@ -71,53 +90,203 @@ def setup(patient_col,
                 interactive=False
             )
 
-        # Workaround for automatic stateful change (States dont have eventlistenrs)
-        # Event Handlers
-        patient_refresh_flag.change(get_patient_data, 
-                               inputs=current_user, 
-                               outputs=[patient_data_df, backup_df])
-        
-        patient_refresh_flag.change(update_doctor_name,
-                                    inputs=current_user,
-                                    outputs=doctor_name_md)
+        # Paging and sorting, only the page on screen is fetched
+        with gr.Row(elem_id="pagecontrols"):
+            prev_btn = gr.Button("<", variant="secondary", size="sm", scale=0)
+            page_md = gr.Markdown("<p style=\"text-align: center; margin: 0px;\">Page 1 of 1</p>")
+            next_btn = gr.Button(">", variant="secondary", size="sm", scale=0)
+            sort_column_dropdown = gr.Dropdown(value=column_names[0], 
+                                               choices=column_names, 
+                                               interactive=True,
+                                               label="Sort by",
+                                               container=False,
+                                               scale=0)
+            sort_order_dropdown = gr.Dropdown(value=sort_orders[0], 
+                                              choices=sort_orders, 
+                                              interactive=True,
+                                              label="Order",
+                                              container=False,
+                                              scale=0)
 
-        refresh_btn.click(get_patient_data, 
-                          inputs=current_user, 
-                          outputs=[patient_data_df, backup_df])
-
-        search_btn.click(search_name, 
-                         inputs=[backup_df, search_txt, search_column_dropdown], 
+        # Event Handlers
+        refresh_btn.click(tiers.backend_io(get_patient_data), 
+                          inputs=[session_id, sort_column_dropdown, sort_order_dropdown], 
+                          outputs=[patient_data_df, page_md])
+
+        sort_column_dropdown.change(tiers.backend_io(get_patient_data), 
+                                    inputs=[session_id, sort_column_dropdown, sort_order_dropdown], 
+                                    outputs=[patient_data_df, page_md])
+
+        sort_order_dropdown.change(tiers.backend_io(get_patient_data), 
+                                   inputs=[session_id, sort_column_dropdown, sort_order_dropdown], 
+                                   outputs=[patient_data_df, page_md])
+
+        prev_btn.click(tiers.backend_io(prev_patient_page),
+                       inputs=session_id,
+                       outputs=[patient_data_df, page_md])
+
+        next_btn.click(tiers.backend_io(next_patient_page),
+                       inputs=session_id,
+                       outputs=[patient_data_df, page_md])
+
+        search_btn.click(tiers.backend_io(search_name), 
+                         inputs=[session_id, search_txt, search_column_dropdown], 
+                         outputs=patient_data_df,
+                         api_name="search")
+
+        search_txt.submit(tiers.backend_io(search_name), 
+                          inputs=[session_id, search_txt, search_column_dropdown], 
+                          outputs=patient_data_df)
+
+        # Type-ahead only searches the loaded pages, so it runs in the UI tier
+        search_txt.input(search_as_you_type, 
+                         inputs=[session_id, search_txt, search_column_dropdown], 
                          outputs=patient_data_df)
         
         search_column_dropdown.select(update_placeholder_searchtxt, 
                                       outputs=search_txt)
-        
-        patient_data_df.select(swap_to_classification_view,
-                               inputs=[patient_data_df, classification_refresh_flag],
-                               outputs=[patient_col, 
-                                        classification_col, 
-                                        current_patient_data_df,
-                                        classification_refresh_flag])
+
+    return {'doctor_name_md': doctor_name_md,
+            'patient_data_df': patient_data_df,
+            'page_md': page_md,
+            'sort_column_dropdown': sort_column_dropdown,
+            'sort_order_dropdown': sort_order_dropdown}
 
 
-def search_name(df, inp, col):
+async def search_name(session_id, inp, col):
     """
-    Search for a name in the patient list
+    Search for a name in the patient list. Searched in the loaded pages if
+    they hold every patient, by the patient API otherwise. The result is
+    dropped if the user searched again while it was loading.
 
     Parameters:
-    df (pd.DataFrame): The dataframe to search
+    session_id (str): The id of the session holding the search index
     inp (str): The string to search for
     col (str): The column to search in
 
     Returns:
     pd.DataFrame: The filtered dataframe
     """
-    result = df[df[col].str.contains(inp)]
-    if result.empty:
+    ctx = aio.event_context()
+    token = await start_search(session_id)
+    page_state = await sessions.load(session_id, 'page_state')
+    if page_state is None:
+        return gr.update()
+    index = await load_search_index(session_id, page_state)
+
+    # An empty search shows the current page, like clearing the search box
+    if inp.strip() == "":
+        return render_patients(index.frame(page_state['keys']))
+
+    if len(index) >= page_state['total']:
+        result_df = index.frame(index.search(col, inp))
+    else:
+        result_df = await search_patients(session_id, page_state, inp, col)
+        if not await is_latest_search(session_id, token):
+            return gr.update()
+
+    aio.restore_event_context(ctx)
+    if result_df.empty:
         gr.Warning("No results found")
-        return df
+        return render_patients(index.frame(page_state['keys']))
+    else:
+        prefetch.patients.schedule(session_id, result_df["Reference ID"].tolist()[:prefetch.rows])
+        return render_patients(result_df)
+
+
+async def search_as_you_type(session_id, inp, col):
+    """
+    Search the loaded pages while the user is typing, going back to the
+    current page once the search is cleared. Waits for the user to stop
+    typing first, and drops the result if another key was typed meanwhile.
+    Patients that are not loaded yet are only searched on submit.
+
+    Parameters:
+    session_id (str): The id of the session holding the search index
+    inp (str): The string to search for
+    col (str): The column to search in
+
+    Returns:
+    pd.DataFrame: The filtered dataframe
+    """
+    token = await start_search(session_id)
+    await asyncio.sleep(search_debounce)
+    if not await is_latest_search(session_id, token):
+        return gr.update()
+
+    page_state = await sessions.load(session_id, 'page_state')
+    if page_state is None:
+        return gr.update()
+    index = await load_search_index(session_id, page_state)
+
+    if inp.strip() == "":
+        keys = page_state['keys']
     else:
-        return df[df[col].str.contains(inp)]
+        keys = index.search(col, inp)
+    if not await is_latest_search(session_id, token):
+        return gr.update()
+
+    prefetch.patients.schedule(session_id, keys[:prefetch.rows])
+    return render_patients(index.frame(keys))
+
+
+async def start_search(session_id):
+    """
+    Make a search the latest one of the session, so results of earlier
+    searches still loading can be dropped
+
+    Parameters:
+    session_id (str): The id of the session searching
+
+    Returns:
+    str: The token of the search
+    """
+    token = secrets.token_hex(8)
+    await sessions.save(session_id, 'search_token', token)
+    return token
+
+
+async def is_latest_search(session_id, token):
+    """
+    Check that no search was started in the session after this one
+
+    Parameters:
+    session_id (str): The id of the session searching
+    token (str): The token of the search
+
+    Returns:
+    bool: True if the search is still the latest one
+    """
+    return await sessions.load(session_id, 'search_token') == token
+
+
+@metrics.timed('search_patients')
+async def search_patients(session_id, page_state, inp, col):
+    """
+    Search every patient of the doctor with the patient API, in the order of
+    the patient list
+
+    Parameters:
+    session_id (str): The id of the session of the doctor to search patients of
+    page_state (dict): The page state, for the sort order
+    inp (str): The string to search for
+    col (str): The column to search in
+
+    Returns:
+    pd.DataFrame: The typed matching patients, at most the search limit
+    """
+    ctx = aio.event_context()
+    doctor_name = await sessions.load(session_id, 'user')
+    if doctor_name is None:
+        raise gr.Error("Session expired, please log in again")
+
+    log.debug("Searching patients of doctor: " + doctor_name)
+    result_df, total, _ = await request_patient_page(doctor_name, 0, search_limit, page_state['sort_by'],
+                                                     page_state['descending'], search=(col, inp.strip()))
+    aio.restore_event_context(ctx)
+    if total > len(result_df):
+        gr.Info("Showing the first " + str(len(result_df)) + " of " + str(total) + " matches")
+    return typed_patients(result_df)
 
 
 def update_placeholder_searchtxt(evt: gr.SelectData):
@@ -133,42 +302,334 @@ def update_placeholder_searchtxt(evt: gr.SelectData):
     return gr.Textbox.update(placeholder="Search by " + evt.value)
 
 
-def update_doctor_name(name):
+async def update_doctor_name(session_id):
     """
     Update doctor name in patient list
 
     Parameters:
-    name (str): The name of the doctor to update to
+    session_id (str): The id of the session holding the name of the doctor to update to
 
     Returns:
     gradio.Markdown: The markdown element to update
     """
+    name = await sessions.load(session_id, 'user', "")
     return gr.Markdown.update(value="<h3 style=\"text-align: right; margin-bottom:0px;\">Profile: " + name + "</h3>")
 
 
-def get_patient_data(doctor_name):
+@metrics.timed('get_patient_data')
+async def get_patient_data(session_id, sort_by, order):
+    """
+    Get the first page of patient data from server, resetting any pages that
+    were already loaded
+
+    Parameters:
+    session_id (str): The id of the session of the doctor to get patient data for
+    sort_by (str): The column to sort by
+    order (str): The sort order, Ascending or Descending
+
+    Returns:
+    pd.DataFrame: The patient data on the first page
+    gradio.Markdown: The page label
     """
-    Get patient data from server
+    descending = order == sort_orders[1]
+    page_state = await sessions.load(session_id, 'page_state')
+
+    # With only the first page loaded in this order, an unchanged page keeps the rows, see load_patient_page
+    if page_state is None or (page_state['sort_by'], page_state['descending']) != (sort_by, descending) or \
+            list(page_state['etags']) != ['0']:
+        page_state = {'page': 0, 'sort_by': sort_by, 'descending': descending, 'total': 0, 'keys': [],
+                      'doctor': None, 'etags': {}, 'version': None}
+    return await load_patient_page(session_id, dict(page_state, page=0), True)
+
+
+async def prev_patient_page(session_id):
+    """
+    Move to the previous page of patient data
 
     Parameters:
-    doctor_name (str): The name of the doctor to get patient data for
+    session_id (str): The id of the session of the doctor to get patient data for
 
     Returns:
-    pd.DataFrame: The patient data (twice)
+    See change_patient_page
+    """
+    return await change_patient_page(session_id, -1)
+
+
+async def next_patient_page(session_id):
     """
+    Move to the next page of patient data
 
-    # Get patients from server
-    # Include some data about doctor, so we only get data for the logged in doctor
-    # patients = requests.get("http://localhost:8085/patients").json()
-    log.debug("Getting patient data for doctor: " + doctor_name)
+    Parameters:
+    session_id (str): The id of the session of the doctor to get patient data for
 
-    raw_json = {"Name":{"0":"John Doe","1":"Jane Doe","2":"Greg Smith","3":"Alice Smith","4":"John Johnson","5":"Jane Johnson","6":"Thomas Williams","7":"Nicole Williams","8":"John Brown","9":"Jane Brown","10":"Adam Jones","11":"Keith Jones","12":"Ian Miller","13":"Jane Miller","14":"John Davis","15":"Jane Davis","16":"John Garcia","17":"Jane Garcia","18":"John Rodriguez"},"Reference ID":{"0":1000,"1":1001,"2":1002,"3":1003,"4":1004,"5":1005,"6":1006,"7":1007,"8":1008,"9":1009,"10":1010,"11":1011,"12":1012,"13":1013,"14":1014,"15":1015,"16":1016,"17":1017,"18":1018},"Samples":{"0":1,"1":2,"2":3,"3":4,"4":5,"5":6,"6":7,"7":8,"8":9,"9":10,"10":11,"11":12,"12":13,"13":14,"14":15,"15":16,"16":17,"17":18,"18":19},"Date":{"0":"2021-01-01","1":"2021-01-01","2":"2021-01-01","3":"2021-01-01","4":"2021-01-01","5":"2021-01-01","6":"2021-01-01","7":"2021-01-01","8":"2021-01-01","9":"2021-01-01","10":"2021-01-01","11":"2021-01-01","12":"2021-01-01","13":"2021-01-01","14":"2021-01-01","15":"2021-01-01","16":"2021-01-01","17":"2021-01-01","18":"2021-01-01"}}
+    Returns:
+    See change_patient_page
+    """
+    return await change_patient_page(session_id, 1)
 
-    patients_df = pd.DataFrame(raw_json)
-    patients_df = patients_df.astype(str)
-    return patients_df, patients_df
 
-def get_reference_id_notes(reference_id):
+async def change_patient_page(session_id, step):
+    """
+    Move to another page of patient data, fetching it from server on demand
+
+    Parameters:
+    session_id (str): The id of the session of the doctor to get patient data for
+    step (int): The number of pages to move by
+
+    Returns:
+    pd.DataFrame: The patient data on the new page
+    gradio.Markdown: The page label
+    """
+    page_state = await sessions.load(session_id, 'page_state')
+    if page_state is None:
+        return gr.update(), gr.update()
+
+    page = page_state['page'] + step
+    if page < 0 or page >= page_count(page_state['total']):
+        return gr.update(), gr.update()
+
+    return await load_patient_page(session_id, dict(page_state, page=page), False)
+
+
+async def load_search_index(session_id, page_state):
+    """
+    Get the search index over the patient rows loaded in a session. The
+    session only holds the rows, the index built from them is kept by this
+    process until a page load changes them.
+
+    Parameters:
+    session_id (str): The id of the session holding the patient rows
+    page_state (dict): The page state, for the version of the rows
+
+    Returns:
+    SearchIndex: The search index over the loaded patient rows
+    """
+    index = searchindex.indexes.get(session_id, page_state['version'])
+    if index is not None:
+        return index
+
+    # Loaded by another worker, or evicted from the cache of this one
+    rows = await sessions.load(session_id, 'patient_rows')
+    index = searchindex.SearchIndex(column_names, "Reference ID")
+    if rows is not None:
+        await aio.run_blocking(index.add, rows)
+    searchindex.indexes.put(session_id, page_state['version'], index)
+    return index
+
+
+async def load_patient_page(session_id, page_state, reset):
+    """
+    Load a page of patient data from server, the page state and patient rows
+    are kept in the session and the search index over them by this process.
+    The page state has the ETag of every page loaded, so a page the session
+    already holds the same version of leaves the rows, their version and the
+    search index of every worker as they are.
+
+    Parameters:
+    session_id (str): The id of the session of the doctor to get patient data for
+    page_state (dict): The page state of the page to load
+    reset (bool): True to start over from this page if it changed, dropping the other pages loaded
+
+    Returns:
+    pd.DataFrame: The patient data on the page
+    gradio.Markdown: The page label
+    """
+    doctor_name = await sessions.load(session_id, 'user')
+    if doctor_name is None:
+        raise gr.Error("Session expired, please log in again")
+
+    log.debug("Getting patient data page " + str(page_state['page']) + " for doctor: " + doctor_name)
+
+    page_df, total, etag = await fetch_patient_page(doctor_name,
+                                                    page_state['page'] * page_size,
+                                                    page_size,
+                                                    page_state['sort_by'],
+                                                    page_state['descending'])
+    page = str(page_state['page'])
+    page_state = dict(page_state, total=total, keys=page_df["Reference ID"].tolist())
+
+    unchanged = etag is not None and page_state['doctor'] == doctor_name and page_state['etags'].get(page) == etag
+    if not unchanged:
+        # Index every page loaded so far, so search is not limited to what is on screen
+        if reset:
+            index = searchindex.SearchIndex(column_names, "Reference ID")
+            etags = {}
+        else:
+            index = await load_search_index(session_id, page_state)
+            etags = dict(page_state['etags'])
+        index.add(page_df)
+        etags[page] = etag
+
+        # A new version tells every worker to rebuild its search index from the rows
+        page_state = dict(page_state, doctor=doctor_name, etags=etags, version=secrets.token_hex(8))
+        await sessions.save(session_id, 'patient_rows', index.rows)
+        searchindex.indexes.put(session_id, page_state['version'], index)
+    await sessions.save(session_id, 'page_state', page_state)
+
+    # Warm the top of the page, the rows most likely to be opened next
+    prefetch.patients.schedule(session_id, page_state['keys'][:prefetch.rows])
+    return render_patients(page_df), page_label(page_state)
+
+
+async def fetch_patient_page(doctor_name, offset, limit, sort_by, descending):
+    """
+    Fetch a page of patients, revalidating the cached page with the patient
+    API so an unchanged page is neither downloaded nor rebuilt
+
+    Parameters:
+    doctor_name (str): The name of the doctor to get patients for
+    offset (int): The index of the first patient on the page
+    limit (int): The max number of patients on the page
+    sort_by (str): The column to sort by
+    descending (bool): True to sort in descending order
+
+    Returns:
+    pd.DataFrame: The patients on the page
+    int: The total number of patients of the doctor
+    str: The ETag of the page, which only changes with the page, None if the patient API sent none
+    """
+    key = (doctor_name, offset, limit, sort_by, descending)
+    cached = patientcache.pages.get(key)
+
+    result = await request_patient_page(doctor_name, offset, limit, sort_by, descending,
+                                        cached[0] if cached is not None else None)
+    patientcache.pages.record(result is None)
+    if result is None:
+        log.debug("Patient data page not modified, using cached page")
+        etag, (page_df, total) = cached
+        return page_df, total, etag
+
+    page_df, total, etag = result
+    page_df = typed_patients(page_df)
+    patientcache.pages.put(key, etag, (page_df, total))
+    return page_df, total, etag
+
+
+async def request_patient_page(doctor_name, offset, limit, sort_by, descending, etag=None, search=None):
+    """
+    Request a page of patients for a doctor from the patient API, so only the
+    rows on screen are sent. A search is filtered by the patient API, so it
+    covers the patients of pages not loaded yet.
+
+    Parameters:
+    doctor_name (str): The name of the doctor to get patients for
+    offset (int): The index of the first patient on the page
+    limit (int): The max number of patients on the page
+    sort_by (str): The column to sort by
+    descending (bool): True to sort in descending order
+    etag (str): The ETag of the cached page, if any
+    search (tuple): The column to search in and the string to search for, None for every patient
+
+    Returns:
+    tuple: The patients on the page, the total number of patients of the
+           doctor or matching the search and the ETag of the page, or None if
+           the page was not modified
+    """
+    if backend.patient_api_bypassed():
+        version = hashlib.sha1(json.dumps(placeholder_patients, sort_keys=True).encode('utf-8')).hexdigest()
+        if version == etag and search is None:
+            return None
+
+        # Typed once by fetch_patient_page, like the pages of the patient API
+        patients_df = pd.DataFrame(placeholder_patients)
+        if search is not None:
+            column, query = search
+            query = searchindex.normalize(query)
+            patients_df = patients_df[[query in searchindex.normalize(value) for value in patients_df[column]]]
+        patients_df = patients_df.sort_values(sort_by, ascending=not descending, kind="stable")
+        return patients_df.iloc[offset:offset + limit], len(patients_df), version
+
+    params = {'doctor': doctor_name,
+              'offset': offset,
+              'limit': limit,
+              'sort': sort_by,
+              'order': 'desc' if descending else 'asc'}
+    if search is not None:
+        params.update(search_column=search[0], search=search[1])
+    headers = {'If-None-Match': etag} if etag is not None else None
+    try:
+        response = await backend.patient_api('GET', '/api/v1/patients', params=params, headers=headers)
+    except gr.Error:
+        raise # Deadline or circuit breaker, already clear
+    except httpx.ConnectError:
+        raise gr.Error("Patient API connection error")
+    except Exception as e:
+        raise gr.Error("Patient API error: " + str(e))
+
+    if response.status_code == 304:
+        return None
+    if response.status_code != 200:
+        raise gr.Error("Patient API response not ok: " + str(response))
+
+    # Prefer the ETag header, fall back to a version token in the body
+    data = response.json()
+    etag = response.headers.get('ETag', data.get('version'))
+    return pd.DataFrame(data.get('patients', []), columns=column_names), int(data.get('total', 0)), etag
+
+
+def typed_patients(df):
+    """
+    Convert patient data to compact native dtypes, so it can be sorted and
+    filtered vectorized. Values are only formatted for display by
+    render_patients.
+
+    Parameters:
+    df (pd.DataFrame): The patient data as returned by the patient API
+
+    Returns:
+    pd.DataFrame: The typed patient data
+    """
+    return pd.DataFrame({"Name": df["Name"].astype("category"),
+                         "Reference ID": pd.to_numeric(df["Reference ID"]).astype("int32"),
+                         "Samples": pd.to_numeric(df["Samples"]).astype("int16"),
+                         "Date": pd.to_datetime(df["Date"])},
+                        columns=column_names)
+
+
+def render_patients(df):
+    """
+    Format typed patient data for the patient list table
+
+    Parameters:
+    df (pd.DataFrame): The typed patient data
+
+    Returns:
+    pd.DataFrame: The patient data ready to display
+    """
+    return pd.DataFrame({"Name": df["Name"].astype(str),
+                         "Reference ID": df["Reference ID"],
+                         "Samples": df["Samples"],
+                         "Date": pd.to_datetime(df["Date"]).dt.strftime("%Y-%m-%d")},
+                        columns=column_names)
+
+
+def page_count(total):
+    """
+    Get the number of pages needed to show every patient
+
+    Parameters:
+    total (int): The total number of patients
+
+    Returns:
+    int: The number of pages, at least 1
+    """
+    return max(1, -(-total // page_size))
+
+
+def page_label(page_state):
+    """
+    Get the label shown between the page buttons
+
+    Parameters:
+    page_state (dict): The current page state
+
+    Returns:
+    gradio.Markdown: The markdown element to update
+    """
+    return gr.Markdown.update(value="<p style=\"text-align: center; margin: 0px;\">Page " + str(page_state['page'] + 1) +
+                                    " of " + str(page_count(page_state['total'])) + "</p>")
+
+async def get_reference_id_notes(reference_id):
     """
     Gets the notes for a specific reference id from the CDN service
 
@@ -183,23 +644,15 @@ def get_reference_id_notes(reference_id):
     # TODO REPLACE WITH CDN ENDPOINT FOR GETTING NOTES
     return "Assistant: Karen\nUser stated that the lesion was itchy and had been growing for the past 2 months. They seeked out advice from their faimly doctor Dr.Smith. Patient does not have insurance.\nPatient was reffered by Dr. Smith. at Altair Hospital."
 
-def swap_to_classification_view(df, refresh_flag, evt: gr.SelectData):
+def selected_patient(df, evt: gr.SelectData):
     """
-    Swap to the classification view
+    Get the patient selected in the patient list
 
     Parameters:
     df (pd.DataFrame): The patient list dataframe
-    refresh_flag (gradio.Number): The refresh flag
     evt (gr.SelectData): The event data from the patient list
 
     Returns:
-    gradio.Column: The patient list column
-    gradio.Column: The classification column
-    gradio.Dataframe: The dataframe to update
-    gradio.Number: The refresh flag to update
+    pd.DataFrame: The row of the selected patient
     """
-
-    df = pd.DataFrame(df.iloc[[evt.index[0]]])
-    df['Notes'] = get_reference_id_notes(df['Reference ID'])
-
-    return gr.update(visible=False), gr.update(visible=True), df, gr.update(value=False) if refresh_flag else gr.update(value=True)
\ No newline at end of file
+    return df.iloc[[evt.index[0]]].reset_index(drop=True)
\ No newline at end of file
@@ -0,0 +1,101 @@
+import logging
+import threading
+from collections import OrderedDict
+import interfaces.backend as backend
+import interfaces.metrics as metrics
+
+log = logging.getLogger('web-api')
+
+# Patient list pages per doctor, shared by every session in the process
+pages = None
+
+
+def setup():
+    """
+    Create the patient list cache from env. Should be called once at startup,
+    after the .env has been loaded.
+    """
+    global pages
+
+    max_entries = backend.get_int_env("PATIENT_CACHE_ENTRIES", 1024)
+    pages = RevalidationCache(max_entries)
+    metrics.register_cache('patient_pages', pages.stats)
+    log.info("Patient list cache: " + str(max_entries) + " pages")
+
+
+class RevalidationCache:
+    """
+    Bounded LRU of patient list pages and the ETag or version token they were
+    served with. Entries are never trusted as is, the token is sent back to the
+    backend, which only sends the page again if it changed.
+    """
+
+    def __init__(self, max_entries):
+        """
+        Parameters:
+        max_entries (int): The max number of pages to keep
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get a cached page
+
+        Parameters:
+        key (tuple): The doctor and page parameters
+
+        Returns:
+        tuple: The (etag, value) of the page, or None if not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, etag, value):
+        """
+        Cache a page with the token it was served with
+
+        Parameters:
+        key (tuple): The doctor and page parameters
+        etag (str): The ETag or version token of the page
+        value (object): The page
+        """
+        if etag is None:
+            return
+
+        with self._lock:
+            self._entries[key] = (etag, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record(self, not_modified):
+        """
+        Count a revalidation
+
+        Parameters:
+        not_modified (bool): True if the backend said the cached page is still valid
+        """
+        with self._lock:
+            if not_modified:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        """
+        Get the cache counters
+
+        Returns:
+        dict: The not modified hits, misses and entries held
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries)}
@@ -0,0 +1,199 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import interfaces.backend as backend
+import interfaces.metrics as metrics
+
+log = logging.getLogger('web-api')
+
+# Patients likely to be opened next, shared by every session in the process
+patients = None
+rows = 0 # Set from env in setup, 0 disables prefetching
+
+
+def setup(loader):
+    """
+    Create the patient prefetcher from env. Should be called once at startup,
+    after the .env has been loaded. Prefetching is opt-in.
+
+    Parameters:
+    loader (callable): The async function loading a patient, see Prefetcher
+    """
+    global patients, rows
+
+    rows = backend.get_int_env("PREFETCH_ROWS", 0)
+    workers = backend.get_int_env("PREFETCH_WORKERS", 4) if rows > 0 else 0
+    patients = Prefetcher(loader,
+                          workers,
+                          backend.get_int_env("PREFETCH_ENTRIES", 256),
+                          backend.get_int_env("PREFETCH_TTL", 300))
+    metrics.register_cache('prefetch', patients.stats)
+
+    if rows > 0:
+        log.info("Patient prefetch: " + str(rows) + " rows, " + str(workers) + " workers")
+    else:
+        log.info("Patient prefetch disabled")
+
+
+class Prefetcher:
+    """
+    Loads patients in the background before they are opened, and keeps them in
+    a bounded per-reference cache with a TTL. Each session has at most one
+    batch of prefetches in flight, scheduling a new batch cancels the previous
+    one. Blocking work runs in a dedicated bounded thread pool, so prefetching
+    never takes threads away from the handlers.
+    """
+
+    def __init__(self, loader, max_workers, max_entries, ttl):
+        """
+        Parameters:
+        loader (callable): Async function taking a reference id and a run_blocking
+                           function, returning the value to cache
+        max_workers (int): The max number of patients loaded at once, 0 to disable prefetching
+        max_entries (int): The max number of patients kept
+        ttl (int): The number of seconds a prefetched patient is valid for
+        """
+        self.loader = loader
+        self.max_workers = max_workers
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.cancelled = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Only touched on the event loop
+        self._loop = None
+        self._slots = None
+        self._tasks = {}
+
+        self._pool = None
+        if max_workers > 0:
+            self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix='prefetch')
+
+    def get(self, reference_id):
+        """
+        Get a prefetched patient
+
+        Parameters:
+        reference_id (int): The reference id of the patient
+
+        Returns:
+        object: The value returned by the loader, or None if not prefetched
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(str(reference_id))
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(str(reference_id))
+                self.hits += 1
+                return entry[1]
+
+            self._entries.pop(str(reference_id), None)
+            self.misses += 1
+            return None
+
+    def schedule(self, session_id, reference_ids):
+        """
+        Prefetch patients for a session, cancelling what the session was still
+        prefetching. Can be called from async and sync handlers.
+
+        Parameters:
+        session_id (str): The id of the session
+        reference_ids (list): The reference ids of the patients, most likely first
+        """
+        if self._pool is None or not session_id:
+            return
+        self._call(self._start, session_id, [str(reference_id) for reference_id in reference_ids])
+
+    def cancel(self, session_id):
+        """
+        Cancel what a session is still prefetching, on navigation or logout
+
+        Parameters:
+        session_id (str): The id of the session
+        """
+        if self._pool is None:
+            return
+        self._call(self._cancel, session_id)
+
+    def stats(self):
+        """
+        Get the prefetch counters
+
+        Returns:
+        dict: The hits, misses, cancelled prefetches and patients held
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'cancelled': self.cancelled,
+                    'entries': len(self._entries)}
+
+    def _call(self, fn, *args):
+        # Sync handlers run in worker threads, hand the call over to the loop
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is not None:
+            self._loop = loop
+            fn(*args)
+        elif self._loop is not None:
+            self._loop.call_soon_threadsafe(fn, *args)
+
+    def _start(self, session_id, reference_ids):
+        self._cancel(session_id)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+
+        with self._lock:
+            now = time.monotonic()
+            reference_ids = [reference_id for reference_id in reference_ids
+                             if reference_id not in self._entries or self._entries[reference_id][0] <= now]
+
+        tasks = set()
+        for reference_id in reference_ids:
+            task = self._loop.create_task(self._prefetch(reference_id))
+            task.add_done_callback(functools.partial(self._done, session_id))
+            tasks.add(task)
+        if tasks:
+            self._tasks[session_id] = tasks
+
+    def _cancel(self, session_id):
+        for task in self._tasks.pop(session_id, ()):
+            if task.cancel():
+                with self._lock:
+                    self.cancelled += 1
+
+    def _done(self, session_id, task):
+        tasks = self._tasks.get(session_id)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self._tasks[session_id]
+
+    async def _prefetch(self, reference_id):
+        async with self._slots:
+            try:
+                value = await self.loader(int(reference_id), self._run_blocking)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.debug("Prefetching patient " + reference_id + " failed: " + str(e))
+                return
+
+        with self._lock:
+            self._entries[reference_id] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(reference_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _run_blocking(self, fn, *args):
+        return self._loop.run_in_executor(self._pool, functools.partial(fn, *args))
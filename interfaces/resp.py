@@ -0,0 +1,188 @@
+import logging
+import socket
+import threading
+from urllib.parse import urlparse
+
+log = logging.getLogger('web-api')
+
+
+class RespError(Exception):
+    """
+    An error reply from the server
+    """
+    pass
+
+
+class RespClient:
+    """
+    Minimal client for servers speaking the Redis protocol (RESP2). Every thread
+    gets its own connection, commands can be sent one at a time or pipelined.
+    A dropped connection is reopened once, but commands are only sent again if
+    none of them could have reached the server, so no command runs twice.
+    """
+
+    def __init__(self, url, timeout=2.0):
+        """
+        Parameters:
+        url (str): The server url, redis://[:password@]host[:port][/db]
+        timeout (float): The connect and read timeout in seconds
+        """
+        parsed = urlparse(url)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.strip('/') or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def execute(self, *args):
+        """
+        Send a command and wait for its reply
+
+        Parameters:
+        *args: The command and its arguments
+
+        Returns:
+        object: The reply, bytes for strings, a list for arrays
+        """
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands):
+        """
+        Send several commands at once and wait for all of their replies
+
+        Parameters:
+        commands (list): The commands, each a tuple of the command and its arguments
+
+        Returns:
+        list: The replies, in order
+        """
+        payload = memoryview(b''.join(encode(command) for command in commands))
+        for attempt in range(2):
+            sent = 0
+            try:
+                sock, reader = self._connection()
+                while sent < len(payload):
+                    sent += sock.send(payload[sent:])
+                return self._read(reader, len(commands))
+            except (OSError, EOFError) as e:
+                self.close()
+                # Once part of the payload was sent the server may have run it,
+                # and running HINCRBY or EXPIRE again would corrupt the session
+                if sent or attempt:
+                    raise
+                log.debug("Session store connection lost, reconnecting: " + str(e))
+
+    def close(self):
+        """
+        Close the connection of the current thread
+        """
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            connection[0].close()
+
+    def _read(self, reader, count):
+        replies = [read_reply(reader) for _ in range(count)]
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            if self._is_open(connection[0]):
+                return connection
+            self.close()
+
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = (sock, sock.makefile('rb'))
+        self._local.connection = connection
+
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            sock.sendall(b''.join(encode(command) for command in setup))
+            for _ in setup:
+                reply = read_reply(connection[1])
+                if isinstance(reply, RespError):
+                    self.close()
+                    raise reply
+        return connection
+
+    def _is_open(self, sock):
+        # A server that closed an idle connection is noticed before anything is
+        # sent on it, so the commands can go to a new connection instead
+        try:
+            sock.setblocking(False)
+            return sock.recv(1, socket.MSG_PEEK) != b''
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.settimeout(self.timeout)
+
+
+def encode(command):
+    """
+    Encode a command as a RESP array of bulk strings
+
+    Parameters:
+    command (tuple): The command and its arguments
+
+    Returns:
+    bytes: The encoded command
+    """
+    parts = [b'*' + str(len(command)).encode('ascii') + b'\r\n']
+    for arg in command:
+        if isinstance(arg, bytes):
+            value = arg
+        elif isinstance(arg, float):
+            value = repr(arg).encode('ascii')
+        else:
+            value = str(arg).encode('utf-8')
+        parts.append(b'$' + str(len(value)).encode('ascii') + b'\r\n' + value + b'\r\n')
+    return b''.join(parts)
+
+
+def read_reply(reader):
+    """
+    Read one reply
+
+    Parameters:
+    reader (io.BufferedReader): The connection to read from
+
+    Returns:
+    object: The reply, a RespError for error replies
+    """
+    line = reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise EOFError("Connection closed")
+
+    kind, value = line[:1], line[1:-2]
+    if kind == b'+':
+        return value
+    if kind == b'-':
+        return RespError(value.decode('utf-8', 'replace'))
+    if kind == b':':
+        return int(value)
+    if kind == b'$':
+        length = int(value)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise EOFError("Connection closed")
+        return data[:-2]
+    if kind == b'*':
+        length = int(value)
+        if length < 0:
+            return None
+        return [read_reply(reader) for _ in range(length)]
+    raise EOFError("Unexpected reply " + repr(line[:16]))
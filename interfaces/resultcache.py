@@ -0,0 +1,268 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from PIL import Image
+import interfaces.backend as backend
+import interfaces.metrics as metrics
+
+log = logging.getLogger('web-api')
+
+# Classification results, shared by every session in the process
+results = None
+
+
+def setup():
+    """
+    Create the classification result cache from env. Should be called once at
+    startup, after the .env has been loaded.
+    """
+    global results
+
+    model_version = os.getenv("MODEL_VERSION")
+    if model_version is None:
+        log.warning("MODEL_VERSION not specified in env, defaulting to placeholder")
+        model_version = 'placeholder'
+
+    cache_dir = os.getenv("RESULT_CACHE_DIR")
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'web-api-results')
+    elif cache_dir == 'None':
+        cache_dir = None
+
+    results = ResultCache(model_version,
+                          backend.get_int_env("RESULT_CACHE_ENTRIES", 256),
+                          backend.get_int_env("RESULT_CACHE_TTL", 86400),
+                          cache_dir,
+                          backend.get_int_env("RESULT_CACHE_DISK_ENTRIES", 4096))
+    metrics.register_cache('results', cache_stats)
+    log.info("Result cache: model " + model_version + ", disk tier " + str(cache_dir))
+
+
+def cache_stats():
+    """
+    Get the result cache counters for metrics, hits on either tier count as hits
+
+    Returns:
+    dict: The hits and misses
+    """
+    stats = results.stats()
+    return {'hits': stats['hits'] + stats['disk_hits'], 'misses': stats['misses']}
+
+
+class ResultCache:
+    """
+    Two tier cache of classification results, keyed by a hash of the image and
+    the model version. Results are kept in an in-memory LRU, backed by a local
+    on-disk tier, and expire after a TTL.
+    """
+
+    def __init__(self, model_version, max_entries, ttl, cache_dir=None, max_disk_entries=0):
+        """
+        Parameters:
+        model_version (str): The model version, part of every key
+        max_entries (int): The max number of results kept in memory
+        ttl (int): The number of seconds a result is valid for
+        cache_dir (str): The directory of the disk tier, None to disable it
+        max_disk_entries (int): The max number of results kept on disk
+        """
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._references = OrderedDict()
+        self._lock = threading.Lock()
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, image):
+        """
+        Get the content address of an image for the current model version
+
+        Parameters:
+        image (PIL.Image): The image to classify
+
+        Returns:
+        str: The hex digest of the image pixels and model version
+        """
+        digest = hashlib.sha256()
+        digest.update(self.model_version.encode('utf-8'))
+        digest.update((image.mode + str(image.size)).encode('utf-8'))
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Get a result, checking memory first and then disk
+
+        Parameters:
+        key (str): The key returned from key()
+
+        Returns:
+        tuple: The (PIL.Image attribution, dict labels), or None on a miss
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                expires, result = entry
+                if expires > now:
+                    self._results.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self._results[key]
+
+        result, expires = self._read_disk(key, now)
+        if result is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+        self._put_memory(key, result, expires)
+        return result
+
+    def put(self, key, result):
+        """
+        Add a result to both tiers
+
+        Parameters:
+        key (str): The key returned from key()
+        result (tuple): The (PIL.Image attribution, dict labels)
+        """
+        expires = time.time() + self.ttl
+        self._put_memory(key, result, expires)
+        self._write_disk(key, result, expires)
+
+    def remember(self, reference_id, image_id, key):
+        """
+        Remember which result belongs to an image of a patient, so previous
+        classifications can be found without the image
+
+        Parameters:
+        reference_id (int): The reference id the image belongs to
+        image_id (str): The id of the image
+        key (str): The key of the result
+        """
+        with self._lock:
+            keys = self._references.setdefault(str(reference_id), {})
+            keys[str(image_id)] = key
+            self._references.move_to_end(str(reference_id))
+            while len(self._references) > self.max_entries:
+                self._references.popitem(last=False)
+
+    def previous(self, reference_id):
+        """
+        Get the results still cached for the images of a patient
+
+        Parameters:
+        reference_id (int): The reference id of the patient
+
+        Returns:
+        list: The (image id, (PIL.Image attribution, dict labels)) of each image
+        """
+        with self._lock:
+            keys = dict(self._references.get(str(reference_id), {}))
+
+        previous = []
+        for image_id, key in keys.items():
+            result = self.get(key)
+            if result is not None:
+                previous.append((image_id, result))
+        return previous
+
+    def stats(self):
+        """
+        Get the cache counters
+
+        Returns:
+        dict: The memory hits, disk hits, misses and entries held in memory
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'entries': len(self._results)}
+
+    def _put_memory(self, key, result, expires):
+        with self._lock:
+            self._results[key] = (expires, result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.json', base + '.png'
+
+    def _read_disk(self, key, now):
+        if self.cache_dir is None:
+            return None, None
+
+        labels_path, attribution_path = self._paths(key)
+        try:
+            with open(labels_path) as f:
+                entry = json.load(f)
+            if entry['expires'] <= now:
+                self._remove_disk(key)
+                return None, None
+
+            attribution = Image.open(attribution_path)
+            attribution.load()
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+        return (attribution, entry['labels']), entry['expires']
+
+    def _write_disk(self, key, result, expires):
+        if self.cache_dir is None:
+            return
+
+        attribution, labels = result
+        labels_path, attribution_path = self._paths(key)
+        try:
+            # Write the image first, so a labels file always has its image. The
+            # temp files are per process, workers may write the same result
+            suffix = '.' + str(os.getpid()) + '.tmp'
+            attribution.save(attribution_path + suffix, format='PNG')
+            os.replace(attribution_path + suffix, attribution_path)
+            with open(labels_path + suffix, 'w') as f:
+                json.dump({'expires': expires, 'labels': labels}, f)
+            os.replace(labels_path + suffix, labels_path)
+        except OSError as e:
+            log.warning("Could not write classification result to disk cache: " + str(e))
+            return
+
+        self._prune_disk()
+
+    def _remove_disk(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _prune_disk(self):
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.json')]
+        except OSError:
+            return
+
+        if len(entries) <= self.max_disk_entries:
+            return
+
+        # Oldest results go first
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_disk_entries]:
+            self._remove_disk(entry.name[:-len('.json')])
@@ -0,0 +1,86 @@
+import logging
+import gradio as gr
+import interfaces.aio as aio
+import interfaces.classification as classification
+import interfaces.login as login
+import interfaces.patient as patient
+import interfaces.prefetch as prefetch
+
+log = logging.getLogger('web-api')
+
+# Each transition between views is a single event, producing every output of
+# the view it opens, instead of a flag fanning out to one event per output.
+
+
+async def open_patient_list(session_id, user, passw, sort_by, order):
+    """
+    Log in and open the patient list
+
+    Parameters:
+    session_id (str): The id of the session to store the login in
+    user (str): The username inputted by the user
+    passw (str): The password inputted by the user
+    sort_by (str): The column the patient list is sorted by
+    order (str): The sort order, Ascending or Descending
+
+    Returns:
+    gradio.Column: The login column
+    gradio.Column: The patient view column
+    gradio.Markdown: The doctor name
+    pd.DataFrame: The first page of patients
+    gradio.Markdown: The page label
+    """
+    ctx = aio.event_context()
+    if not await login.send_login_request(session_id, user, passw):
+        return gr.update(visible=True), gr.update(visible=False), gr.update(), gr.update(), gr.update()
+
+    log.debug("Swapping to patient view")
+    try:
+        patients, label = await patient.get_patient_data(session_id, sort_by, order)
+    except gr.Error as e:
+        # Still open the list, it can be refreshed once the patient API is back
+        aio.restore_event_context(ctx)
+        gr.Warning(e.message)
+        patients, label = gr.update(), gr.update()
+
+    return gr.update(visible=False), \
+           gr.update(visible=True), \
+           await patient.update_doctor_name(session_id), \
+           patients, \
+           label
+
+
+async def open_patient(session_id, df, evt: gr.SelectData):
+    """
+    Open the classification view of the patient selected in the patient list
+
+    Parameters:
+    session_id (str): The id of the session to keep the gallery in
+    df (pd.DataFrame): The patient list dataframe
+    evt (gr.SelectData): The event data from the patient list
+
+    Returns:
+    gradio.Column: The patient view column
+    gradio.Column: The classification column
+    See classification.open_patient
+    """
+    # The rest of the list is not needed while a patient is open
+    prefetch.patients.cancel(session_id)
+    outputs = await classification.open_patient(session_id, patient.selected_patient(df, evt))
+    return (gr.update(visible=False), gr.update(visible=True)) + outputs
+
+
+def close_patient(session_id):
+    """
+    Reset the classification view and go back to the patient list
+
+    Parameters:
+    session_id (str): The id of the session to reset
+
+    Returns:
+    gradio.Column: The patient view column
+    gradio.Column: The classification column
+    See classification.reset
+    """
+    prefetch.patients.cancel(session_id)
+    return (gr.update(visible=True), gr.update(visible=False)) + classification.reset(session_id)
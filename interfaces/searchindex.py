@@ -0,0 +1,294 @@
+import logging
+import sys
+import threading
+from collections import OrderedDict
+import pandas as pd
+from pandas.api.types import union_categoricals
+import interfaces.backend as backend
+import interfaces.metrics as metrics
+
+log = logging.getLogger('web-api')
+
+gram_size = 3
+
+# The search indexes of the sessions this process served, set up in setup
+indexes = None
+
+
+def setup():
+    """
+    Create the search index cache from env. Should be called once at startup,
+    after the .env has been loaded.
+    """
+    global indexes
+
+    max_entries = backend.get_int_env("SEARCH_INDEX_ENTRIES", 256)
+    indexes = IndexCache(max_entries)
+    metrics.register_cache('search_indexes', indexes.stats)
+    log.info("Search index cache: " + str(max_entries) + " sessions")
+
+
+def normalize(value):
+    """
+    Normalize a value for case insensitive searching
+
+    Parameters:
+    value (object): The value to normalize
+
+    Returns:
+    str: The lowercase string of the value
+    """
+    return str(value).strip().casefold()
+
+
+def texts(values):
+    """
+    Get the normalized text of typed values as they are displayed, dates
+    without their time
+
+    Parameters:
+    values (pd.Series): The values
+
+    Returns:
+    list: The normalized text of every value
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        values = values.dt.strftime("%Y-%m-%d")
+    return [normalize(value) for value in values.tolist()]
+
+
+def grams(text):
+    """
+    Get every substring of text up to the gram size, so queries up to the gram
+    size are a single lookup and longer queries intersect their grams
+
+    Parameters:
+    text (str): The normalized text
+
+    Returns:
+    set: The grams of the text
+    """
+    result = set()
+    for size in range(1, gram_size + 1):
+        for i in range(len(text) - size + 1):
+            result.add(text[i:i + size])
+    return result
+
+
+def concat(frames):
+    """
+    Concatenate typed dataframes, keeping categorical columns categorical
+    when their categories differ
+
+    Parameters:
+    frames (list): The dataframes, with the same columns
+
+    Returns:
+    pd.DataFrame: The rows of every dataframe, by row position
+    """
+    frame = pd.concat(frames, ignore_index=True)
+    for column in frame.columns:
+        if all(isinstance(f[column].dtype, pd.CategoricalDtype) for f in frames):
+            frame[column] = union_categoricals([f[column] for f in frames])
+    return frame
+
+
+class SearchIndex:
+    """
+    Per-session n-gram index over the loaded patient rows. The rows are kept
+    as one typed dataframe and the grams point at their row positions. Rows
+    are keyed by reference id, so loading a page again replaces its rows in
+    place instead of adding duplicates. Lookups only touch the rows that
+    share grams with the query, so search time does not grow with the size
+    of the patient list.
+    """
+
+    def __init__(self, columns, key_column):
+        """
+        Parameters:
+        columns (list): The columns to index, in display order
+        key_column (str): The column that uniquely identifies a row
+        """
+        self.columns = columns
+        self.key_column = key_column
+        self.rows = None
+        self.positions = {}
+        self.index = {column: {} for column in columns}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def nbytes(self):
+        """
+        Estimate the memory held by the index
+
+        Returns:
+        int: The estimated size in bytes
+        """
+        row_bytes = int(self.rows.memory_usage(deep=True).sum()) if self.rows is not None else 0
+        key_bytes = sum(sys.getsizeof(key) + sys.getsizeof(position) for key, position in self.positions.items())
+        gram_bytes = sum(sys.getsizeof(gram) + sys.getsizeof(positions)
+                         for column_index in self.index.values() for gram, positions in column_index.items())
+        return row_bytes + key_bytes + gram_bytes
+
+    def add(self, df):
+        """
+        Add or replace rows in the index
+
+        Parameters:
+        df (pd.DataFrame): The typed rows to add
+        """
+        df = df[self.columns].reset_index(drop=True)
+        keys = [str(key) for key in df[self.key_column].tolist()]
+        if self.rows is None:
+            self.rows = df.iloc[:0]
+
+        # Replaced rows keep their position, new rows go after the loaded ones
+        offset = len(self.rows)
+        take = list(range(offset))
+        added = []
+        replaced = []
+        for i, key in enumerate(keys):
+            position = self.positions.get(key)
+            if position is not None:
+                replaced.append(position)
+                take[position] = offset + i
+            else:
+                position = len(take)
+                self.positions[key] = position
+                take.append(offset + i)
+            added.append(position)
+        self._remove(replaced)
+
+        self.rows = concat([self.rows, df]).iloc[take].reset_index(drop=True)
+        for column in self.columns:
+            column_index = self.index[column]
+            for position, text in zip(added, texts(df[column])):
+                for gram in grams(text):
+                    column_index.setdefault(gram, set()).add(position)
+
+    def search(self, column, query):
+        """
+        Find the rows whose column contains the query, ignoring case
+
+        Parameters:
+        column (str): The column to search in
+        query (str): The text to search for
+
+        Returns:
+        list: The keys of the matching rows, in the order they were loaded
+        """
+        query = normalize(query)
+        column_index = self.index[column]
+        if self.rows is None:
+            return []
+
+        if len(query) <= gram_size:
+            matches = column_index.get(query, set())
+        else:
+            # Start from the rarest gram, then confirm with a substring check
+            candidates = sorted((column_index.get(query[i:i + gram_size], set())
+                                 for i in range(len(query) - gram_size + 1)), key=len)
+            matches = sorted(set(candidates[0]).intersection(*candidates[1:]))
+            matches = [position for position, text in zip(matches, texts(self.rows[column].iloc[matches]))
+                       if query in text]
+
+        keys = self.rows[self.key_column]
+        return [str(keys.iat[position]) for position in sorted(matches)]
+
+    def frame(self, keys):
+        """
+        Get the typed rows of the given keys
+
+        Parameters:
+        keys (list): The keys of the rows
+
+        Returns:
+        pd.DataFrame: The rows
+        """
+        if self.rows is None:
+            return pd.DataFrame(columns=self.columns)
+        positions = [self.positions[str(key)] for key in keys if str(key) in self.positions]
+        return self.rows.iloc[positions].reset_index(drop=True)
+
+    def _remove(self, positions):
+        for column in self.columns:
+            column_index = self.index[column]
+            for position, text in zip(positions, texts(self.rows[column].iloc[positions])):
+                for gram in grams(text):
+                    gram_positions = column_index.get(gram)
+                    if gram_positions is not None:
+                        gram_positions.discard(position)
+                        if not gram_positions:
+                            del column_index[gram]
+
+
+class IndexCache:
+    """
+    Bounded LRU of the search indexes of sessions. Sessions only hold the
+    typed rows, which are compact to store and send to a shared store, so
+    every process builds the index of a session once and keeps it until the
+    rows change. The rows are versioned, so an index built from rows another
+    worker has since replaced is never used.
+    """
+
+    def __init__(self, max_entries):
+        """
+        Parameters:
+        max_entries (int): The max number of indexes to keep
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id, version):
+        """
+        Get the index of a session
+
+        Parameters:
+        session_id (str): The id of the session
+        version (str): The version of the rows of the session
+
+        Returns:
+        SearchIndex: The index, or None if not cached for this version
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, session_id, version, index):
+        """
+        Cache the index of a session
+
+        Parameters:
+        session_id (str): The id of the session
+        version (str): The version of the rows the index was built from
+        index (SearchIndex): The index
+        """
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[session_id] = (version, index)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        Get the cache counters
+
+        Returns:
+        dict: The hits, misses and indexes held
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries)}
@@ -0,0 +1,799 @@
+import base64
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
+from PIL import Image
+import interfaces.aio as aio
+import interfaces.backend as backend
+import interfaces.metrics as metrics
+import interfaces.resp as resp
+
+log = logging.getLogger('web-api')
+
+# Per-user state of every browser tab, shared by every interface
+store = None
+
+
+def setup():
+    """
+    Create the session store from env. Should be called once at startup, after
+    the .env has been loaded.
+    """
+    global store
+
+    max_sessions = backend.get_int_env("SESSION_MAX", 1000)
+    max_session_mb = backend.get_int_env("SESSION_MAX_MB", 64)
+    idle_timeout = backend.get_int_env("SESSION_IDLE_TIMEOUT", 1800)
+    workers = backend.get_int_env("WEB_WORKERS", 1)
+
+    # Workers can only serve each other's sessions from a shared store
+    kind = os.getenv("SESSION_STORE")
+    if kind is None:
+        kind = "memory" if workers <= 1 else "sqlite"
+        log.warning("SESSION_STORE not specified in env, defaulting to " + kind)
+    if kind == "memory" and workers > 1:
+        log.warning("The memory session store is not shared, sessions will be lost when " +
+                    "another worker handles their events")
+
+    if kind == "memory":
+        store = SessionStore(max_sessions, max_session_mb * 1024 * 1024, idle_timeout)
+    elif kind == "sqlite":
+        path = os.getenv("SESSION_STORE_PATH")
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), 'web-api-sessions.sqlite')
+        store = SqliteSessionStore(path, max_sessions, max_session_mb * 1024 * 1024, idle_timeout)
+        kind = "sqlite " + path
+    elif kind.startswith("redis://"):
+        store = RedisSessionStore(resp.RespClient(kind), max_sessions, max_session_mb * 1024 * 1024, idle_timeout)
+        kind = "redis " + store.client.host + ":" + str(store.client.port)
+    else:
+        log.warning("SESSION_STORE " + kind + " is not memory, sqlite or a redis:// url, defaulting to memory")
+        store = SessionStore(max_sessions, max_session_mb * 1024 * 1024, idle_timeout)
+        kind = "memory"
+
+    metrics.Callback('webapi_sessions', 'Live sessions', (),
+                     lambda: [((), store.stats()['sessions'])])
+    metrics.Callback('webapi_session_bytes', 'Estimated memory held by sessions', (),
+                     lambda: [((), size) for size in [store.stats()['bytes']] if size is not None])
+    metrics.Callback('webapi_session_evictions_total', 'Evicted sessions and session values', ('reason',),
+                     lambda: [((reason,), count) for reason, count in store.stats()['evictions'].items()],
+                     kind='counter')
+    log.info("Session store: " + kind + ", " + str(max_sessions) + " sessions, " + str(max_session_mb) +
+             "MB per session, " + str(idle_timeout) + "s idle timeout")
+
+
+def new_session():
+    """
+    Start a new session, called when a browser tab loads the interface
+
+    Returns:
+    str: The id of the new session
+    """
+    return store.create()
+
+
+async def load(session_id, key, default=None):
+    """
+    Get a value from a session in an async handler. A shared store waits on
+    its database or server, so it is read in the default executor instead of
+    on the event loop.
+
+    Parameters:
+    session_id (str): The id of the session
+    key (str): The name of the value
+    default (object): Returned if the session or value does not exist
+
+    Returns:
+    object: The value
+    """
+    if not store.shared:
+        return store.get(session_id, key, default)
+    return await aio.run_blocking(store.get, session_id, key, default)
+
+
+async def save(session_id, key, value):
+    """
+    Set a value in a session in an async handler, see load
+
+    Parameters:
+    session_id (str): The id of the session
+    key (str): The name of the value
+    value (object): The value, None removes it
+    """
+    if not store.shared:
+        store.set(session_id, key, value)
+    else:
+        await aio.run_blocking(store.set, session_id, key, value)
+
+
+def estimate_size(value, depth=0):
+    """
+    Estimate the memory held by a session value
+
+    Parameters:
+    value (object): The value to estimate
+    depth (int): The current depth into nested containers
+
+    Returns:
+    int: The estimated size in bytes
+    """
+    if hasattr(value, 'memory_usage'): # pandas
+        return int(value.memory_usage(deep=True).sum())
+    if hasattr(value, 'nbytes') and callable(value.nbytes):
+        return int(value.nbytes())
+    if hasattr(value, 'getbands'): # PIL
+        return value.width * value.height * len(value.getbands())
+
+    size = sys.getsizeof(value)
+    if depth > 4:
+        return size
+    if isinstance(value, dict):
+        size += sum(estimate_size(k, depth + 1) + estimate_size(v, depth + 1) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(estimate_size(v, depth + 1) for v in value)
+    return size
+
+
+def encode(value):
+    """
+    Convert a session value to JSON types. Tuples, typed dataframes and images
+    are tagged with a single $ key, so decode can build them again.
+
+    Parameters:
+    value (object): The value, of the types sessions hold
+
+    Returns:
+    object: The value as JSON types
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, list):
+        return [encode(v) for v in value]
+    if isinstance(value, tuple):
+        return {'$tuple': [encode(v) for v in value]}
+    if isinstance(value, dict):
+        if any(not isinstance(k, str) or k.startswith('$') for k in value):
+            raise TypeError("Session dicts must have string keys not starting with $")
+        return {k: encode(v) for k, v in value.items()}
+    if isinstance(value, pd.DataFrame):
+        # Dates as nanoseconds, categories as their values, the dtypes restore both
+        columns = [value[c].astype('int64') if pd.api.types.is_datetime64_any_dtype(value[c]) else value[c]
+                   for c in value.columns]
+        return {'$frame': {'columns': [str(c) for c in value.columns],
+                           'dtypes': [str(value[c].dtype) for c in value.columns],
+                           'values': [column.astype(object).tolist() for column in columns]}}
+    if isinstance(value, Image.Image):
+        # Raw pixels, compressing them would cost more than sending them
+        return {'$image': {'mode': value.mode,
+                           'size': list(value.size),
+                           'pixels': base64.b64encode(value.tobytes()).decode('ascii')}}
+    raise TypeError("Session values of type " + type(value).__name__ + " cannot be stored in a shared store")
+
+
+def decode(value):
+    """
+    Build a session value from the JSON types returned by encode
+
+    Parameters:
+    value (object): The value as JSON types
+
+    Returns:
+    object: The value
+    """
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if '$tuple' in value:
+        return tuple(decode(v) for v in value['$tuple'])
+    if '$frame' in value:
+        frame = value['$frame']
+        return pd.DataFrame({column: pd.Series(values).astype(dtype)
+                             for column, dtype, values in zip(frame['columns'], frame['dtypes'], frame['values'])},
+                            columns=frame['columns'])
+    if '$image' in value:
+        image = value['$image']
+        return Image.frombytes(image['mode'], tuple(image['size']), base64.b64decode(image['pixels']))
+    return {k: decode(v) for k, v in value.items()}
+
+
+def serialize(value):
+    """
+    Serialize a session value for a shared store. Values are stored as JSON,
+    so reading a session another process wrote never runs code.
+
+    Parameters:
+    value (object): The value
+
+    Returns:
+    bytes: The encoded value
+    """
+    return json.dumps(encode(value), separators=(',', ':')).encode('utf-8')
+
+
+def deserialize(data, key, default):
+    """
+    Deserialize a session value read from a shared store
+
+    Parameters:
+    data (bytes): The encoded value
+    key (str): The name of the value, for logging
+    default (object): Returned if the value cannot be read
+
+    Returns:
+    object: The value
+    """
+    try:
+        return decode(json.loads(data))
+    except Exception as e:
+        # Written by another version of the service, treat it as missing
+        log.warning("Could not read session value " + key + ": " + str(e))
+        return default
+
+
+class Session:
+    """
+    The values of one session and the bytes they hold
+    """
+
+    def __init__(self):
+        self.values = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.last_access = time.monotonic()
+
+
+class SessionStore:
+    """
+    Bounded in-memory store of per-session state. Sessions are evicted when idle
+    for longer than the idle timeout, or least recently used first once the
+    global cap is reached. Each session has its own memory limit, past which its
+    least recently set values are dropped.
+    """
+
+    # Only this process can read it, without blocking
+    shared = False
+
+    def __init__(self, max_sessions, max_session_bytes, idle_timeout):
+        """
+        Parameters:
+        max_sessions (int): The max number of live sessions
+        max_session_bytes (int): The memory limit of a single session
+        idle_timeout (int): The number of seconds a session may be idle for
+        """
+        self.max_sessions = max_sessions
+        self.max_session_bytes = max_session_bytes
+        self.idle_timeout = idle_timeout
+        self.evictions = {'idle': 0, 'capacity': 0, 'memory': 0}
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def create(self):
+        """
+        Create a new, empty session
+
+        Returns:
+        str: The id of the session
+        """
+        session_id = secrets.token_urlsafe(16)
+        with self._lock:
+            self._add(session_id)
+        return session_id
+
+    def get(self, session_id, key, default=None):
+        """
+        Get a value from a session
+
+        Parameters:
+        session_id (str): The id of the session
+        key (str): The name of the value
+        default (object): Returned if the session or value does not exist
+
+        Returns:
+        object: The value
+        """
+        with self._lock:
+            session = self._touch(session_id)
+            if session is None:
+                return default
+            return session.values.get(key, default)
+
+    def set(self, session_id, key, value):
+        """
+        Set a value in a session, creating the session if it was evicted
+
+        Parameters:
+        session_id (str): The id of the session
+        key (str): The name of the value
+        value (object): The value, None removes it
+        """
+        if not session_id:
+            return
+
+        size = estimate_size(value) if value is not None else 0
+        with self._lock:
+            self._sweep()
+            session = self._touch(session_id)
+            if session is None:
+                session = self._add(session_id)
+
+            self._remove_value(session, key)
+            if value is None:
+                return
+            if size > self.max_session_bytes:
+                log.warning("Session value " + key + " is over the session memory limit, not stored")
+                self.evictions['memory'] += 1
+                return
+
+            session.values[key] = value
+            session.sizes[key] = size
+            session.bytes += size
+
+            # Drop the least recently set values until the session fits again
+            while session.bytes > self.max_session_bytes:
+                oldest = next(iter(session.values))
+                self._remove_value(session, oldest)
+                self.evictions['memory'] += 1
+
+    def end(self, session_id):
+        """
+        End a session, freeing all of its values
+
+        Parameters:
+        session_id (str): The id of the session
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self):
+        """
+        Get the store metrics
+
+        Returns:
+        dict: The live sessions, bytes held and evictions by reason
+        """
+        with self._lock:
+            self._sweep()
+            return {'sessions': len(self._sessions),
+                    'bytes': sum(session.bytes for session in self._sessions.values()),
+                    'evictions': dict(self.evictions)}
+
+    def _add(self, session_id):
+        while len(self._sessions) >= self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions['capacity'] += 1
+
+        session = Session()
+        self._sessions[session_id] = session
+        return session
+
+    def _touch(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+
+        now = time.monotonic()
+        if now - session.last_access > self.idle_timeout:
+            del self._sessions[session_id]
+            self.evictions['idle'] += 1
+            return None
+
+        session.last_access = now
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def _remove_value(self, session, key):
+        if key in session.values:
+            del session.values[key]
+            session.bytes -= session.sizes.pop(key)
+
+    def _sweep(self):
+        # Sessions are kept in access order, so idle ones are at the front
+        now = time.monotonic()
+        if now - self._last_sweep < min(60, self.idle_timeout):
+            return
+
+        self._last_sweep = now
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_access <= self.idle_timeout:
+                break
+            del self._sessions[session_id]
+            self.evictions['idle'] += 1
+
+
+class SqliteSessionStore:
+    """
+    Session store in a local SQLite database, shared by every worker process
+    on the host. Values are serialized, and follow the same idle timeout,
+    global cap and per-session memory limit as the in-memory store, measured
+    on the serialized size.
+    """
+
+    shared = True
+
+    # Seconds between last access updates of a session, so reads stay reads
+    touch_interval = 1
+
+    def __init__(self, path, max_sessions, max_session_bytes, idle_timeout):
+        """
+        Parameters:
+        path (str): The path of the database, created if missing
+        max_sessions (int): The max number of live sessions
+        max_session_bytes (int): The memory limit of a single session
+        idle_timeout (int): The number of seconds a session may be idle for
+        """
+        self.path = path
+        self.max_sessions = max_sessions
+        self.max_session_bytes = max_session_bytes
+        self.idle_timeout = idle_timeout
+        self._local = threading.local()
+        self._last_sweep = 0
+
+        db = self._db()
+        db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, last_access REAL NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access)")
+        db.execute("CREATE TABLE IF NOT EXISTS session_values (session_id TEXT NOT NULL, key TEXT NOT NULL, " +
+                   "value BLOB NOT NULL, size INTEGER NOT NULL, set_at REAL NOT NULL, PRIMARY KEY (session_id, key))")
+        db.execute("CREATE TABLE IF NOT EXISTS session_evictions (reason TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+
+    def create(self):
+        """
+        Create a new, empty session
+
+        Returns:
+        str: The id of the session
+        """
+        session_id = secrets.token_urlsafe(16)
+        with self._transaction() as db:
+            self._add(db, session_id, time.time())
+        return session_id
+
+    def get(self, session_id, key, default=None):
+        """
+        Get a value from a session
+
+        Parameters:
+        session_id (str): The id of the session
+        key (str): The name of the value
+        default (object): Returned if the session or value does not exist
+
+        Returns:
+        object: The value
+        """
+        db = self._db()
+        row = db.execute("SELECT last_access FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            return default
+
+        now = time.time()
+        if now - row[0] > self.idle_timeout:
+            with self._transaction() as db:
+                self._remove(db, [session_id], 'idle')
+            return default
+        if now - row[0] > self.touch_interval:
+            db.execute("UPDATE sessions SET last_access = ? WHERE id = ?", (now, session_id))
+
+        row = db.execute("SELECT value FROM session_values WHERE session_id = ? AND key = ?",
+                         (session_id, key)).fetchone()
+        if row is None:
+            return default
+        return deserialize(row[0], key, default)
+
+    def set(self, session_id, key, value):
+        """
+        Set a value in a session, creating the session if it was evicted
+
+        Parameters:
+        session_id (str): The id of the session
+        key (str): The name of the value
+        value (object): The value, None removes it
+        """
+        if not session_id:
+            return
+
+        data = serialize(value) if value is not None else None
+        now = time.time()
+        with self._transaction() as db:
+            self._sweep(db, now)
+            row = db.execute("SELECT last_access FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is not None and now - row[0] > self.idle_timeout:
+                self._remove(db, [session_id], 'idle')
+                row = None
+            if row is None:
+                self._add(db, session_id, now)
+            else:
+                db.execute("UPDATE sessions SET last_access = ? WHERE id = ?", (now, session_id))
+
+            db.execute("DELETE FROM session_values WHERE session_id = ? AND key = ?", (session_id, key))
+            if data is None:
+                return
+            if len(data) > self.max_session_bytes:
+                log.warning("Session value " + key + " is over the session memory limit, not stored")
+                self._count(db, 'memory', 1)
+                return
+
+            db.execute("INSERT INTO session_values VALUES (?, ?, ?, ?, ?)",
+                       (session_id, key, sqlite3.Binary(data), len(data), now))
+
+            # Drop the least recently set values until the session fits again
+            total = db.execute("SELECT SUM(size) FROM session_values WHERE session_id = ?",
+                               (session_id,)).fetchone()[0]
+            while total > self.max_session_bytes:
+                oldest, size = db.execute("SELECT key, size FROM session_values WHERE session_id = ? " +
+                                          "ORDER BY set_at LIMIT 1", (session_id,)).fetchone()
+                db.execute("DELETE FROM session_values WHERE session_id = ? AND key = ?", (session_id, oldest))
+                self._count(db, 'memory', 1)
+                total -= size
+
+    def end(self, session_id):
+        """
+        End a session, freeing all of its values
+
+        Parameters:
+        session_id (str): The id of the session
+        """
+        with self._transaction() as db:
+            self._remove(db, [session_id], None)
+
+    def stats(self):
+        """
+        Get the store metrics, over every worker
+
+        Returns:
+        dict: The live sessions, bytes held and evictions by reason
+        """
+        with self._transaction() as db:
+            self._sweep(db, time.time())
+        db = self._db()
+        evictions = {'idle': 0, 'capacity': 0, 'memory': 0}
+        evictions.update(db.execute("SELECT reason, count FROM session_evictions").fetchall())
+        return {'sessions': db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0],
+                'bytes': db.execute("SELECT COALESCE(SUM(size), 0) FROM session_values").fetchone()[0],
+                'evictions': evictions}
+
+    def _db(self):
+        # sqlite3 connections cannot be shared between threads
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _transaction(self):
+        return SqliteTransaction(self._db())
+
+    def _add(self, db, session_id, now):
+        count = db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        if count >= self.max_sessions:
+            oldest = db.execute("SELECT id FROM sessions ORDER BY last_access LIMIT ?",
+                                (count - self.max_sessions + 1,)).fetchall()
+            self._remove(db, [row[0] for row in oldest], 'capacity')
+        db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?)", (session_id, now))
+
+    def _remove(self, db, session_ids, reason):
+        for session_id in session_ids:
+            db.execute("DELETE FROM session_values WHERE session_id = ?", (session_id,))
+            db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        if reason is not None and session_ids:
+            self._count(db, reason, len(session_ids))
+
+    def _count(self, db, reason, amount):
+        db.execute("INSERT OR IGNORE INTO session_evictions VALUES (?, 0)", (reason,))
+        db.execute("UPDATE session_evictions SET count = count + ? WHERE reason = ?", (amount, reason))
+
+    def _sweep(self, db, now):
+        # Every worker sweeps on its own schedule, a sweep covers all of them
+        if now - self._last_sweep < min(60, self.idle_timeout):
+            return
+
+        self._last_sweep = now
+        idle = db.execute("SELECT id FROM sessions WHERE last_access < ?", (now - self.idle_timeout,)).fetchall()
+        self._remove(db, [row[0] for row in idle], 'idle')
+
+
+class SqliteTransaction:
+    """
+    Write transaction on a connection in autocommit mode. Takes the write lock
+    up front, so concurrent workers wait for each other instead of failing.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+
+class RedisSessionStore:
+    """
+    Session store on a server speaking the Redis protocol, shared by every
+    worker process that can reach it. Each session is a hash of serialized
+    values with a hash of their sizes next to it, both expiring after the idle
+    timeout. A sorted set of last accesses finds the least recently used
+    sessions once the global cap is reached.
+    """
+
+    shared = True
+    prefix = 'web-api:session:'
+    sessions_key = 'web-api:sessions'
+    evictions_key = 'web-api:session-evictions'
+
+    # Seconds between last access updates of a session, so reads stay reads
+    touch_interval = 1
+
+    def __init__(self, client, max_sessions, max_session_bytes, idle_timeout):
+        """
+        Parameters:
+        client (resp.RespClient): The client of the server
+        max_sessions (int): The max number of live sessions
+        max_session_bytes (int): The memory limit of a single session
+        idle_timeout (int): The number of seconds a session may be idle for
+        """
+        self.client = client
+        self.max_sessions = max_sessions
+        self.max_session_bytes = max_session_bytes
+        self.idle_timeout = idle_timeout
+        self._last_sweep = 0
+
+    def create(self):
+        """
+        Create a new, empty session
+
+        Returns:
+        str: The id of the session
+        """
+        session_id = secrets.token_urlsafe(16)
+        self._add(session_id, time.time())
+        return session_id
+
+    def get(self, session_id, key, default=None):
+        """
+        Get a value from a session
+
+        Parameters:
+        session_id (str): The id of the session
+        key (str): The name of the value
+        default (object): Returned if the session or value does not exist
+
+        Returns:
+        object: The value
+        """
+        if not session_id:
+            return default
+
+        last_access, data = self.client.pipeline([('ZSCORE', self.sessions_key, session_id),
+                                                  ('HGET', self.prefix + session_id, key)])
+        if last_access is None:
+            return default
+
+        now = time.time()
+        if now - float(last_access) > self.idle_timeout:
+            self._remove([session_id], 'idle')
+            return default
+        if now - float(last_access) > self.touch_interval:
+            self.client.pipeline(self._touch(session_id, now))
+
+        if data is None:
+            return default
+        return deserialize(data, key, default)
+
+    def set(self, session_id, key, value):
+        """
+        Set a value in a session, creating the session if it was evicted
+
+        Parameters:
+        session_id (str): The id of the session
+        key (str): The name of the value
+        value (object): The value, None removes it
+        """
+        if not session_id:
+            return
+
+        data = serialize(value) if value is not None else None
+        now = time.time()
+        self._sweep(now)
+
+        last_access = self.client.execute('ZSCORE', self.sessions_key, session_id)
+        if last_access is not None and now - float(last_access) > self.idle_timeout:
+            self._remove([session_id], 'idle')
+            last_access = None
+        if last_access is None:
+            self._add(session_id, now)
+
+        commands = [('HDEL', self.prefix + session_id, key),
+                    ('HDEL', self.prefix + session_id + ':sizes', key)]
+        if data is not None and len(data) > self.max_session_bytes:
+            log.warning("Session value " + key + " is over the session memory limit, not stored")
+            commands.append(('HINCRBY', self.evictions_key, 'memory', 1))
+        elif data is not None:
+            commands += [('HSET', self.prefix + session_id, key, data),
+                         ('HSET', self.prefix + session_id + ':sizes', key, repr(now) + ' ' + str(len(data)))]
+        commands += self._touch(session_id, now)
+        commands.append(('HGETALL', self.prefix + session_id + ':sizes'))
+        sizes = self.client.pipeline(commands)[-1]
+
+        # Drop the least recently set values until the session fits again
+        entries = sorted((float(entry.split()[0]), int(entry.split()[1]), name.decode('utf-8'))
+                         for name, entry in zip(sizes[::2], sizes[1::2]))
+        total = sum(size for _, size, _ in entries)
+        for _, size, oldest in entries:
+            if total <= self.max_session_bytes:
+                break
+            self.client.pipeline([('HDEL', self.prefix + session_id, oldest),
+                                  ('HDEL', self.prefix + session_id + ':sizes', oldest),
+                                  ('HINCRBY', self.evictions_key, 'memory', 1)])
+            total -= size
+
+    def end(self, session_id):
+        """
+        End a session, freeing all of its values
+
+        Parameters:
+        session_id (str): The id of the session
+        """
+        self._remove([session_id], None)
+
+    def stats(self):
+        """
+        Get the store metrics, over every worker. The server accounts for its
+        own memory, so the bytes held are not tracked.
+
+        Returns:
+        dict: The live sessions, None for the bytes held and evictions by reason
+        """
+        self._sweep(time.time())
+        sessions, counts = self.client.pipeline([('ZCARD', self.sessions_key),
+                                                 ('HGETALL', self.evictions_key)])
+        evictions = {'idle': 0, 'capacity': 0, 'memory': 0}
+        evictions.update((name.decode('utf-8'), int(count)) for name, count in zip(counts[::2], counts[1::2]))
+        return {'sessions': sessions, 'bytes': None, 'evictions': evictions}
+
+    def _touch(self, session_id, now):
+        return [('ZADD', self.sessions_key, repr(now), session_id),
+                ('EXPIRE', self.prefix + session_id, self.idle_timeout),
+                ('EXPIRE', self.prefix + session_id + ':sizes', self.idle_timeout)]
+
+    def _add(self, session_id, now):
+        count = self.client.pipeline([('ZADD', self.sessions_key, repr(now), session_id),
+                                      ('ZCARD', self.sessions_key)])[1]
+        if count > self.max_sessions:
+            # The new session has the latest access, so it is never among the oldest
+            oldest = self.client.execute('ZRANGE', self.sessions_key, 0, count - self.max_sessions - 1)
+            self._remove([session_id.decode('utf-8') for session_id in oldest], 'capacity')
+
+    def _remove(self, session_ids, reason):
+        if not session_ids:
+            return
+
+        commands = []
+        for session_id in session_ids:
+            commands += [('DEL', self.prefix + session_id, self.prefix + session_id + ':sizes'),
+                         ('ZREM', self.sessions_key, session_id)]
+        if reason is not None:
+            commands.append(('HINCRBY', self.evictions_key, reason, len(session_ids)))
+        self.client.pipeline(commands)
+
+    def _sweep(self, now):
+        # The values expire on their own, this drops the sessions from the cap
+        if now - self._last_sweep < min(60, self.idle_timeout):
+            return
+
+        self._last_sweep = now
+        idle = self.client.execute('ZRANGEBYSCORE', self.sessions_key, '-inf', repr(now - self.idle_timeout))
+        self._remove([session_id.decode('utf-8') for session_id in idle], 'idle')
@@ -4,6 +4,7 @@ from typing import Iterable
 
 from gradio.themes.base import Base
 from gradio.themes.utils import colors, fonts, sizes
+import interfaces.assets as assets
 
 
 class SoftCustom(Base):
@@ -19,7 +20,7 @@ class SoftCustom(Base):
         font: fonts.Font
         | str
         | Iterable[fonts.Font | str] = (
-            fonts.GoogleFont("Montserrat"),
+            assets.LocalFont("Montserrat"),
             "ui-sans-serif",
             "system-ui",
             "sans-serif",
@@ -27,7 +28,7 @@ class SoftCustom(Base):
         font_mono: fonts.Font
         | str
         | Iterable[fonts.Font | str] = (
-            fonts.GoogleFont("IBM Plex Mono"),
+            assets.LocalFont("IBM Plex Mono"),
             "ui-monospace",
             "Consolas",
             "monospace",
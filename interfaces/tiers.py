@@ -0,0 +1,191 @@
+import asyncio
+import contextlib
+import functools
+import inspect
+import logging
+import time
+import gradio as gr
+import httpx
+import interfaces.aio as aio
+import interfaces.backend as backend
+import interfaces.metrics as metrics
+
+log = logging.getLogger('web-api')
+
+# Concurrency tiers, set from env in setup. Cheap UI events are only bound by
+# the queue workers, backend and classify events run in their own pools.
+ui_concurrency = 32
+backend_io = None
+classify = None
+
+wait_seconds = metrics.Histogram('webapi_tier_wait_seconds',
+                                 'Time events wait for a slot in their tier', ('tier',))
+
+
+def setup():
+    """
+    Create the concurrency tiers from env. Should be called once at startup,
+    after the .env has been loaded.
+    """
+    global ui_concurrency, backend_io, classify
+
+    ui_concurrency = backend.get_int_env("UI_CONCURRENCY", 32)
+    backend_io = Tier("backend",
+                      backend.get_int_env("BACKEND_CONCURRENCY", 32),
+                      backend.get_int_env("BACKEND_MAX_WAITING", 64),
+                      "The service is busy, please try again in a moment")
+    classify = Tier("classify",
+                    backend.get_int_env("CLASSIFY_CONCURRENCY", 4),
+                    backend.get_int_env("CLASSIFY_MAX_WAITING", 8),
+                    "The classifier is busy, please try again in a moment")
+
+    tiers = [backend_io, classify]
+    metrics.Callback('webapi_tier_active', 'Events running in a tier', ('tier',),
+                     lambda: [((tier.name,), tier.active) for tier in tiers])
+    metrics.Callback('webapi_tier_waiting', 'Events waiting for a slot in a tier', ('tier',),
+                     lambda: [((tier.name,), tier.waiting) for tier in tiers])
+    metrics.Callback('webapi_tier_rejected_total', 'Events turned away because a tier was full', ('tier',),
+                     lambda: [((tier.name,), tier.rejected) for tier in tiers],
+                     kind='counter')
+
+    log.info("Concurrency tiers: ui " + str(ui_concurrency) + ", " +
+             ", ".join(tier.name + " " + str(tier.concurrency) + " (" + str(tier.max_waiting) + " waiting)"
+                       for tier in tiers))
+
+
+def worker_count():
+    """
+    Get the number of queue workers needed so no tier can starve another. A
+    tier holds a worker while its events run or wait, so every tier gets room
+    for both on top of the UI workers.
+
+    Returns:
+    int: The queue concurrency count
+    """
+    return ui_concurrency + sum(tier.concurrency + tier.max_waiting for tier in [backend_io, classify])
+
+
+def lift_queue_timeout(demo):
+    """
+    Let queued events run for as long as they need. Gradio runs them through a
+    request to its own predict route with a 5s read timeout, so an event
+    waiting for a tier slot past that fails with an empty error. Should be
+    called after the queue is enabled, before launching.
+
+    Parameters:
+    demo (gradio.Blocks): The interface
+    """
+    queue = demo._queue
+    start = queue.start
+
+    async def start_without_timeout(ssl_verify=True):
+        await start(ssl_verify)
+        client = queue.queue_client
+        queue.queue_client = httpx.AsyncClient(verify=ssl_verify, timeout=None)
+        await client.aclose()
+
+    queue.start = start_without_timeout
+
+
+class Tier:
+    """
+    A bounded pool for a class of events. At most concurrency events run at
+    once, at most max_waiting wait for a slot, anything past that is turned
+    away with a busy message instead of piling up in the queue.
+    """
+
+    def __init__(self, name, concurrency, max_waiting, busy_message):
+        """
+        Parameters:
+        name (str): The name of the tier, used in metrics
+        concurrency (int): The max number of events running at once
+        max_waiting (int): The max number of events waiting for a slot
+        busy_message (str): The error shown when the tier is full
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.busy_message = busy_message
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+        # Created on the event loop, only touched there
+        self._slots = None
+
+    def __call__(self, fn, queued=None):
+        """
+        Run an async handler in this tier
+
+        Parameters:
+        fn (callable): The coroutine or async generator function
+        queued (callable): For async generators, called with the position of
+                           the event when it has to wait for a slot, the
+                           outputs it returns are shown while waiting
+
+        Returns:
+        callable: The wrapped handler, with the same signature
+        """
+        # Other events overwrite the gradio event context while this one waits
+        # for a slot, capture it first and restore it before the handler runs
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                ctx = aio.event_context()
+                if queued is not None and self.full():
+                    yield queued(self.waiting + 1)
+                async with self.slot():
+                    aio.restore_event_context(ctx)
+                    async for value in fn(*args, **kwargs):
+                        yield value
+                        aio.restore_event_context(ctx)
+        elif inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                ctx = aio.event_context()
+                async with self.slot():
+                    aio.restore_event_context(ctx)
+                    return await fn(*args, **kwargs)
+        else:
+            raise TypeError("The " + self.name + " tier only runs async handlers, not " + fn.__name__)
+
+        wrapper.tier = self
+        wrapper.queued = queued
+        return wrapper
+
+    def full(self):
+        """
+        Check if an event would have to wait for a slot
+
+        Returns:
+        bool: True if every slot is taken
+        """
+        return self._slots is not None and self._slots.locked()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """
+        Hold a slot of the tier, waiting for one if needed
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+
+        if self._slots.locked() and self.waiting >= self.max_waiting:
+            self.rejected += 1
+            log.warning("Tier " + self.name + " is full, turning an event away")
+            raise gr.Error(self.busy_message)
+
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        wait_seconds.observe(time.perf_counter() - start, tier=self.name)
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._slots.release()
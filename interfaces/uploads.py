@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import gradio as gr
+from PIL import Image
+import uploadworker
+import interfaces.aio as aio
+import interfaces.backend as backend
+
+log = logging.getLogger('web-api')
+
+# Image ids of uploads start with this, the rest is the hash of the uploaded file and its size
+prefix = uploadworker.prefix
+
+# Set from env in setup
+workers = 2
+max_bytes = 32 * 1024 * 1024
+image_size = 224
+upload_dir = None
+
+# The preprocessing pool of this process, created on first use so every worker gets its own
+pool = None
+pool_pid = None
+pool_lock = threading.Lock()
+
+
+def setup():
+    """
+    Configure the upload preprocessing from env and start its pool in the
+    background. Should be called once at startup in the process serving
+    events, after the .env has been loaded.
+    """
+    global workers, max_bytes, image_size, upload_dir
+
+    workers = max(1, backend.get_int_env("UPLOAD_WORKERS", 2))
+    max_bytes = backend.get_int_env("UPLOAD_MAX_MB", 32) * 1024 * 1024
+    # Uploads are resized to the model input, like the inference engine does
+    image_size = backend.get_int_env("MODEL_INPUT_SIZE", 224)
+
+    # In gradio's temp dir, which every worker can serve files from
+    temp_dir = os.environ.get("GRADIO_TEMP_DIR") or os.path.join(tempfile.gettempdir(), "gradio")
+    upload_dir = os.path.join(temp_dir, 'uploads')
+    os.makedirs(upload_dir, exist_ok=True)
+
+    # Starting the processes blocks until they are up, which would hold up
+    # startup, so a thread starts them while the interface is built
+    threading.Thread(target=start_pool, name='upload-pool', daemon=True).start()
+    log.info("Uploads: " + str(workers) + " preprocessing processes, resized to " + str(image_size) + "px")
+
+
+def is_upload(image_id):
+    return str(image_id).startswith(prefix)
+
+
+def path(image_id):
+    """
+    Get the path of a preprocessed upload
+
+    Parameters:
+    image_id (str): The image id returned from preprocess
+
+    Returns:
+    str: The path to the image
+    """
+    return os.path.join(upload_dir, image_id + '.png')
+
+
+def get_pool():
+    global pool, pool_pid
+
+    with pool_lock:
+        if pool is None or pool_pid != os.getpid():
+            # Started from a clean process instead of forking this one, which
+            # has the event loop and handler threads running. The processes
+            # only import uploadworker, which does not import gradio.
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            if 'forkserver' in methods:
+                context.set_forkserver_preload(['uploadworker'])
+            pool = ProcessPoolExecutor(workers, mp_context=context, initializer=uploadworker.init_worker,
+                                       initargs=(os.getpid(),))
+            pool_pid = os.getpid()
+        return pool
+
+
+def start_pool():
+    try:
+        get_pool().submit(int).result()
+    except Exception as e: # Started again by the first upload
+        log.warning("Could not start the upload preprocessing pool: " + str(e))
+
+
+async def preprocess(file_path):
+    """
+    Decode, orient and resize an uploaded image to the model input in the
+    preprocessing pool, so neither the event loop nor the queue workers spend CPU on it
+
+    Parameters:
+    file_path (str): The path of the uploaded file
+
+    Returns:
+    str: The image id of the preprocessed upload
+    """
+    global pool
+
+    size = await aio.run_blocking(os.path.getsize, file_path)
+    if size > max_bytes:
+        raise gr.Error("Images must be smaller than " + str(max_bytes // (1024 * 1024)) + "MB")
+
+    try:
+        # The first upload starts the pool processes, which blocks, so it is submitted off the event loop
+        future = await aio.run_blocking(lambda: get_pool().submit(uploadworker.preprocess_file,
+                                                                  file_path, upload_dir, image_size))
+        return await asyncio.wrap_future(future)
+    except BrokenProcessPool:
+        log.error("Upload preprocessing process died, starting a new pool")
+        with pool_lock:
+            pool = None
+        raise gr.Error("Could not process the image, please try again")
+    except (OSError, Image.DecompressionBombError) as e:
+        log.info("Could not read upload: " + str(e))
+        raise gr.Error("Could not read the image, please upload a JPEG or PNG photo")
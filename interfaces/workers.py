@@ -0,0 +1,163 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import tempfile
+import gradio as gr
+import uvicorn
+
+log = logging.getLogger('web-api')
+
+# Seconds a worker gets to finish its events before it is killed
+shutdown_timeout = 30
+
+# Set in every worker, the private ports of all workers are shared through an array
+worker_index = None
+private_ports = None
+
+
+def serve(count, host, port, start_worker):
+    """
+    Serve the app from several worker processes sharing one listening socket.
+    The kernel spreads connections over the workers, and crashed workers are
+    started again. Returns once the service is stopped.
+
+    Parameters:
+    count (int): The number of worker processes
+    host (str): The address to listen on
+    port (int): The port to listen on
+    start_worker (callable): Called with the listening socket in every worker, runs the app
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    # Forked, so workers skip importing gradio again
+    context = multiprocessing.get_context("fork")
+    ports = context.Array('i', count, lock=False)
+    stopping = []
+
+    def start(i):
+        process = context.Process(target=run_worker, args=(start_worker, sock, i, ports), name="worker-" + str(i),
+                                  daemon=False)
+        process.start()
+        log.info("Started worker " + str(i) + " as process " + str(process.pid))
+        return process
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    processes = [start(i) for i in range(count)]
+    previous = {signum: signal.signal(signum, stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+    log.info("Serving on http://" + host + ":" + str(port) + " with " + str(count) + " workers")
+
+    try:
+        while not stopping:
+            multiprocessing.connection.wait([process.sentinel for process in processes], timeout=1)
+            for i, process in enumerate(processes):
+                if not stopping and not process.is_alive():
+                    log.warning("Worker " + str(i) + " exited with code " + str(process.exitcode) + ", restarting it")
+                    processes[i] = start(i)
+    finally:
+        log.info("Stopping workers")
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(shutdown_timeout)
+            if process.is_alive():
+                process.kill()
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        sock.close()
+
+
+def run_worker(start_worker, sock, index, ports):
+    global worker_index, private_ports
+
+    worker_index = index
+    private_ports = ports
+
+    # Forked with the supervisor's handlers, uvicorn installs its own once running
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    start_worker(sock)
+
+
+def create_app(demo):
+    """
+    Create the app of a worker, the same one gradio launches. Gradio runs
+    queued events by calling its own predict route, so every worker also
+    listens on a private loopback port for those calls to stay in the worker
+    that holds the event.
+
+    Parameters:
+    demo (gradio.Blocks): The interface, with its queue enabled
+
+    Returns:
+    fastapi.FastAPI: The app
+    socket.socket: The private socket of the worker
+    """
+    private = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    private.bind(("127.0.0.1", 0))
+    private.listen(2048)
+    url = "http://127.0.0.1:" + str(private.getsockname()[1]) + "/"
+    if private_ports is not None:
+        private_ports[worker_index] = private.getsockname()[1]
+
+    # Files written by one worker are served by whichever worker gets the request
+    temp_dir = os.environ.get("GRADIO_TEMP_DIR") or os.path.join(tempfile.gettempdir(), "gradio")
+
+    demo.dev_mode = False
+    demo.show_api = False
+    demo.allowed_paths = [temp_dir]
+    demo.blocked_paths = []
+    demo.validate_queue_settings()
+    demo.config = demo.get_config_file()
+    demo.max_threads = max(demo._queue.max_thread_count, 40)
+
+    app = gr.routes.App.create_app(demo)
+    demo.server_app = app
+    demo.local_url = url
+    demo.is_running = True
+    demo._queue.set_url(url)
+
+    @app.on_event("startup")
+    async def start_queue():
+        demo.startup_events()
+        app.startup_events_triggered = True
+
+    return app, private
+
+
+def peers():
+    """
+    Get the private url of every worker, for the routes that answer for the
+    whole service, such as the metrics
+
+    Returns:
+    list: The index and private url of every started worker, the url is None for this worker
+    """
+    if private_ports is None:
+        return []
+    return [(i, None if i == worker_index else "http://127.0.0.1:" + str(port))
+            for i, port in enumerate(private_ports) if port]
+
+
+def run(app, sockets):
+    """
+    Run the app of a worker until it is stopped
+
+    Parameters:
+    app (fastapi.FastAPI): The app
+    sockets (list): The listening sockets to serve
+    """
+    config = uvicorn.Config(app=app,
+                            log_level="warning",
+                            ws_max_size=1024 * 1024 * 1024) # Same as gradio
+    log.info("Worker " + str(os.getpid()) + " ready, queue at " + app.get_blocks().local_url)
+    uvicorn.Server(config=config).run(sockets=sockets)
@@ -1,4 +1,8 @@
+import time
+started = time.perf_counter() # Before the imports, so they show up in the startup profile
+
 import os
+import functools
 import logging
 import gradio as gr
 from dotenv import load_dotenv
@@ -9,23 +13,120 @@ log = logging.getLogger('web-api')
 # Main function
 def main():
     print("Starting Login-API microservice...")
+    phases = [("imports", time.perf_counter())]
 
     load_dotenv(verbose=True, override=True) # Loads .env if present
     setup_logging()
-
-    # Readin css
-    with open("interfaces/main.css") as f:
-        css = f.read()
-        f.close()
-
-    demo = setup_main_interface(css)
+    phases.append(("env and logging", time.perf_counter()))
 
     port = os.getenv("APP_PORT") # Default to 8082
     if port is None:
         logging.warning("APP_PORT not specified in env, default to 8082")
         port = "8082"
 
-    demo.queue(api_open=False).launch(server_port=int(port), share=False, show_api=False)
+    # Several processes behind the one port, each builds its own interface
+    workers = interfaces.backend.get_int_env("WEB_WORKERS", 1)
+    if workers > 1:
+        host = os.getenv("GRADIO_SERVER_NAME", "127.0.0.1")
+        interfaces.workers.serve(workers, host, int(port), functools.partial(start_worker, phases))
+        return
+
+    demo, metrics_path = setup_service(phases)
+
+    demo.launch(server_port=int(port), share=False, show_api=False, prevent_thread_lock=True)
+    interfaces.assets.mount(demo.server_app)
+    if metrics_path != "None":
+        interfaces.metrics.mount(demo.server_app, metrics_path)
+    phases.append(("launch", time.perf_counter()))
+
+    if os.getenv("STARTUP_PROFILE", "False").lower() == "true":
+        log_startup_profile(phases)
+
+    demo.block_thread()
+
+
+def start_worker(phases, sock):
+    """
+    Build and run the service in a worker process
+
+    Parameters:
+    phases (list): The startup phases so far
+    sock (socket.socket): The listening socket shared by every worker
+    """
+    demo, metrics_path = setup_service(phases)
+
+    app, private = interfaces.workers.create_app(demo)
+    interfaces.assets.mount(app)
+    if metrics_path != "None":
+        interfaces.metrics.mount(app, metrics_path, interfaces.workers.peers)
+    phases.append(("app", time.perf_counter()))
+
+    if os.getenv("STARTUP_PROFILE", "False").lower() == "true":
+        log_startup_profile(phases)
+
+    interfaces.workers.run(app, [sock, private])
+
+
+def setup_service(phases):
+    """
+    Create the caches and pools and build the interface with its queue
+
+    Parameters:
+    phases (list): The startup phases so far, the phases of the setup are added
+
+    Returns:
+    gradio.Blocks: The interface
+    str: The path of the metrics, None if disabled
+    """
+    interfaces.backend.setup()
+    interfaces.imagecache.setup()
+    interfaces.encoding.setup()
+    interfaces.uploads.setup()
+    interfaces.resultcache.setup()
+    interfaces.patientcache.setup()
+    interfaces.searchindex.setup()
+    interfaces.sessions.setup()
+    interfaces.tiers.setup()
+    interfaces.inference.setup()
+    interfaces.prefetch.setup(interfaces.classification.prefetch_patient)
+    phases.append(("caches and pools", time.perf_counter()))
+
+    # Bundle the css, icons and fonts, then build the theme once, before any interface is built
+    interfaces.assets.setup()
+    theme = interfaces.SoftCustom(primary_hue="blue", secondary_hue="blue")
+    css = interfaces.assets.import_css("main.css")
+    phases.append(("theme and css", time.perf_counter()))
+
+    demo = setup_main_interface(css, theme)
+    phases.append(("interface", time.perf_counter()))
+
+    # Enough workers for every tier, the tiers bound themselves
+    demo.queue(api_open=False, concurrency_count=interfaces.tiers.worker_count())
+    interfaces.tiers.lift_queue_timeout(demo)
+
+    # Prometheus metrics, served by the app gradio launches
+    metrics_path = os.getenv("METRICS_PATH")
+    if metrics_path is None:
+        log.warning("METRICS_PATH not specified in env, defaulting to /metrics")
+        metrics_path = "/metrics"
+
+    if metrics_path != "None":
+        interfaces.metrics.instrument(demo)
+    return demo, metrics_path
+
+
+def log_startup_profile(phases):
+    """
+    Log how long each startup phase took, and the total time to ready
+
+    Parameters:
+    phases (list): The (name, time.perf_counter() at the end) of each phase, in order
+    """
+    previous = started
+    for name, end in phases:
+        log.info("Startup phase " + name + ": " + str(round((end - previous) * 1000)) + "ms")
+        previous = end
+    log.info("Startup ready in " + str(round((previous - started) * 1000)) + "ms")
 
 def setup_logging():
     """
@@ -57,24 +158,22 @@ def setup_logging():
     log.info("LOG_LEVEL: " + logging.getLevelName(numeric_level))
 
 
-def setup_main_interface(css):
+def setup_main_interface(css, theme):
     """
     Setup the main interface
 
     Parameters:
     css (str): The css to apply to the interface
+    theme (gradio.themes.Base): The theme to apply to the interface
     """
     
     log.info("Setting up interface")
-    with gr.Blocks(css=css, theme=interfaces.SoftCustom(primary_hue="blue",
-                                                 secondary_hue="blue")) as demo:
+    # No telemetry, gradio would phone home from startup threads
+    with gr.Blocks(css=css, theme=theme, analytics_enabled=False) as demo:
         
-        # Setup doctor name
-        current_user = gr.State("")
-        current_patient_data_df = gr.Dataframe(visible=False)
-
-        patient_refresh_flag = gr.Number(0, visible=False)
-        classification_refresh_flag = gr.Number(0, visible=False)
+        # Setup session, holds the doctor name and all other per-user state
+        session_id = gr.Textbox(visible=False)
+        demo.load(interfaces.sessions.new_session, outputs=session_id, api_name="new_session")
 
         # Setup columns
         login_col = gr.Column(elem_id="userinput", visible=True)
@@ -84,28 +183,54 @@ def setup_main_interface(css):
         classification_col = gr.Column(visible=False)
 
         # Setup interfaces
-        interfaces.patient.setup(patient_col, 
-                                 current_user, 
-                                 patient_refresh_flag, 
-                                 classification_col, 
-                                 current_patient_data_df,
-                                 classification_refresh_flag)
-        interfaces.login.setup(login_col, 
-                               patient_col,
-                               acc_creation_col, 
-                               forgot_passwd_col,
-                               current_user, 
-                               patient_refresh_flag)
+        patient_view = interfaces.patient.setup(patient_col, 
+                                                session_id)
+        login_view = interfaces.login.setup(login_col, 
+                                            acc_creation_col, 
+                                            forgot_passwd_col)
         interfaces.accountcreate.setup(acc_creation_col,
                                        login_col)
         interfaces.forgotpassword.setup(forgot_passwd_col,
                                         login_col)
-        interfaces.classification.setup(classification_col,
-                                        patient_col,
-                                        current_patient_data_df,
-                                        classification_refresh_flag)
+        classification_view = interfaces.classification.setup(classification_col,
+                                                              session_id)
+
+        # Route between views, every transition is a single event
+        login_view['login_btn'].click(interfaces.tiers.backend_io(interfaces.router.open_patient_list),
+                                      inputs=[session_id,
+                                              login_view['user_txt'],
+                                              login_view['passw_txt'],
+                                              patient_view['sort_column_dropdown'],
+                                              patient_view['sort_order_dropdown']],
+                                      outputs=[login_col,
+                                               patient_col,
+                                               patient_view['doctor_name_md'],
+                                               patient_view['patient_data_df'],
+                                               patient_view['page_md']],
+                                      api_name="login")
+
+        patient_view['patient_data_df'].select(interfaces.tiers.backend_io(interfaces.router.open_patient),
+                                               inputs=[session_id, patient_view['patient_data_df']],
+                                               outputs=[patient_col,
+                                                        classification_col,
+                                                        classification_view['curr_patient_df'],
+                                                        classification_view['notes_txt'],
+                                                        classification_view['reference_id_gal'],
+                                                        classification_view['batch_results_df']],
+                                               api_name="open_patient")
+
+        classification_view['cancel_btn'].click(interfaces.router.close_patient,
+                                                inputs=session_id,
+                                                outputs=[patient_col,
+                                                         classification_col,
+                                                         classification_view['curr_patient_df'],
+                                                         classification_view['attribution_img'],
+                                                         classification_view['output_label'],
+                                                         classification_view['batch_results_df']],
+                                                api_name="close_patient")
         log.info("Interface setup complete")
     return demo
 
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""
+The work of the upload preprocessing processes. Kept outside the interfaces
+package and importing only PIL, so starting a process does not import gradio.
+"""
+import hashlib
+import os
+import threading
+import time
+from PIL import Image, ImageOps
+
+# Image ids of uploads start with this, the rest is the hash of the uploaded file and its size
+prefix = 'upload-'
+
+
+def init_worker(owner_pid):
+    # Preprocessing yields the CPU to the processes serving events
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+    # Pool processes wait for work forever, even once the process that owns
+    # the pool was killed, so they watch it and exit with it
+    threading.Thread(target=watch_owner, args=(owner_pid,), name='watch-owner', daemon=True).start()
+
+
+def watch_owner(owner_pid):
+    while True:
+        time.sleep(1)
+        try:
+            os.kill(owner_pid, 0)
+        except ProcessLookupError:
+            os._exit(0)
+        except PermissionError: # Still exists, owned by another user
+            pass
+
+
+def preprocess_file(file_path, directory, size):
+    """
+    Decode an uploaded image, apply its EXIF orientation and resize it to the
+    input of the model, the same way the inference engine does. The result is
+    written losslessly, so classifying it decodes a small image and neither
+    resizes nor recompresses it again. It is named by the hash of the upload
+    and the size, so uploading the same file again skips the work.
+
+    Parameters:
+    file_path (str): The path of the uploaded file
+    directory (str): The directory to write the preprocessed image to
+    size (int): The width and height of the model input
+
+    Returns:
+    str: The image id of the preprocessed upload
+    """
+    digest = hashlib.sha256(str(size).encode('utf-8'))
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    image_id = prefix + digest.hexdigest()[:16]
+    destination = os.path.join(directory, image_id + '.png')
+    if os.path.isfile(destination):
+        return image_id
+
+    with Image.open(file_path) as image:
+        # JPEGs are decoded at the smallest scale still larger than the target
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGB').resize((size, size), Image.BILINEAR)
+
+        # Written under a per process name and renamed, so readers never see part of a file
+        temp_path = destination + '.' + str(os.getpid()) + '.tmp'
+        image.save(temp_path, 'PNG', compress_level=1)
+        os.replace(temp_path, destination)
+    return image_id